@@ -2,3 +2,14 @@
 from zope.i18nmessageid import MessageFactory as BaseMessageFactory
 
 MessageFactory = BaseMessageFactory('collective.portlet.calendar')
+
+
+def initialize(context):
+    """Registers the index of the event ranges, see rangeindex.py"""
+    from collective.portlet.calendar import rangeindex
+    context.registerClass(
+        rangeindex.EventRangeIndex,
+        permission='Add Pluggable Index',
+        constructors=(rangeindex.manage_addEventRangeIndexForm,
+                      rangeindex.manage_addEventRangeIndex),
+        visibility=None)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Render cache backend shared by the instances of a cluster.
+
+Rendered calendars are stored in memcached, so a calendar is rendered once
+per cluster after an invalidation rather than once per instance. The
+invalidation counters are stored in the ZODB and are shared already.
+
+Statistics by assignment are counted by each instance, while occupancy is
+the one reported by the memcached servers, for all their content.
+
+Requires the python-memcached package (``memcached`` extra).
+"""
+import json
+import threading
+from collective.portlet.calendar.config import get_setting
+from collective.portlet.calendar.interfaces import IRenderCacheBackend
+from hashlib import md5
+from zope.interface import implements
+
+try:
+    import memcache
+except ImportError:
+    memcache = None
+
+KEY_PREFIX = 'collective.portlet.calendar:'
+
+
+class MemcachedBackend(object):
+    """Rendered calendars in memcached, see the ``memcached-servers``
+    setting
+    """
+    implements(IRenderCacheBackend)
+
+    def __init__(self, servers=None):
+        self._servers = servers
+        self._client = None
+        self._client_servers = None
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def servers(self):
+        return self._servers or get_setting('memcached-servers').split()
+
+    def client(self):
+        servers = self.servers()
+        with self._lock:
+            if self._client is None or self._client_servers != servers:
+                if memcache is None:
+                    raise ImportError('The memcached render cache backend '
+                                      'requires python-memcached')
+                # clients are thread local, one connection per thread
+                self._client = memcache.Client(servers)
+                self._client_servers = servers
+            return self._client
+
+    def _key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return KEY_PREFIX + md5(key).hexdigest()
+
+    def get(self, key):
+        data = self.client().get(self._key(key))
+        if not data:
+            return None
+        try:
+            freshness, html, stale_since, assignment = json.loads(data)
+        except ValueError:
+            return None
+        return freshness, html, stale_since
+
+    def set(self, key, freshness, html, stale_since=None, assignment=None):
+        data = json.dumps([freshness, html, stale_since, assignment])
+        self.client().set(self._key(key), data)
+
+    def count(self, assignment, name):
+        with self._lock:
+            stats = self.stats.setdefault(
+                assignment, dict(hits=0, misses=0, evictions=0))
+            stats[name] += 1
+
+    def occupancy(self):
+        entries = size = max_bytes = 0
+        for server, stats in self.client().get_stats():
+            entries += int(stats.get('curr_items', 0))
+            size += int(stats.get('bytes', 0))
+            max_bytes += int(stats.get('limit_maxbytes', 0))
+        with self._lock:
+            assignments = dict([
+                (assignment, dict(stats, entries=0, bytes=0))
+                for assignment, stats in self.stats.items()])
+        return dict(entries=entries, bytes=size, max_entries=0,
+                    max_bytes=max_bytes, assignments=assignments)
+
+    def clear(self):
+        # entries are left to expire, the servers may be shared
+        with self._lock:
+            self.stats = {}
+
+
+memcached = MemcachedBackend()
@@ -0,0 +1,132 @@
+/* - calendar.js - */
+/* Previous/next month navigation of the Extended Calendar portlet: month
+ * data is loaded as JSON from @@calendar-month-data and the calendar table
+ * is rebuilt in place.
+ *
+ * Calendars rendered without tooltips (lazy-tooltips setting) load them
+ * from the URL of their data-tooltips attribute when first hovered.
+ */
+(function ($) {
+    "use strict";
+
+    var months = {};
+
+    function escape(text) {
+        return $('<div/>').text(String(text)).html();
+    }
+
+    function dataURL(portlethash, year, month) {
+        var base = $('base').attr('href') || window.location.href;
+        base = base.split('?')[0].replace(/\/$/, '');
+        return base + '/@@calendar-month-data?portlethash=' + portlethash +
+               '&year=' + year + '&month=' + month;
+    }
+
+    function dayCell(day, today) {
+        var number, css;
+        if (!day) {
+            return '<td></td>';
+        }
+        if ($.isArray(day)) {
+            number = day[0];
+            css = number === today ? 'todayevent' : 'event';
+            if (day[3]) {
+                css += ' density' + day[3];
+            }
+            return '<td class="' + css + '"><strong><a href="' +
+                   escape(day[2]) + '" title="' + escape(day[1]) + '">' +
+                   number + '</a></strong></td>';
+        }
+        if (day === today) {
+            return '<td class="todaynoevent"><strong>' + day +
+                   '</strong></td>';
+        }
+        return '<td>' + day + '</td>';
+    }
+
+    function updateLink(link, target) {
+        if (!target) {
+            link.css('visibility', 'hidden');
+            return;
+        }
+        link.css('visibility', '');
+        link.data('year', target[0]).data('month', target[1]);
+        link.attr('data-year', target[0]).attr('data-month', target[1]);
+        link.attr('href', (link.attr('href') || '')
+            .replace(/month:int=\d+/, 'month:int=' + target[1])
+            .replace(/year:int=\d+/, 'year:int=' + target[0]));
+    }
+
+    function render(portlet, data) {
+        var rows = $.map(data.weeks, function (week) {
+            return '<tr>' + $.map(week, function (day) {
+                return dayCell(day, data.today);
+            }).join('') + '</tr>';
+        });
+        // month data has its tooltips
+        portlet.find('table.ploneCalendar').removeAttr('data-tooltips');
+        portlet.find('table.ploneCalendar tbody').html(rows.join(''));
+        portlet.find('.calendarTitle').text(data.title);
+        portlet.find('table.ploneCalendar caption').text(data.title);
+        updateLink(portlet.find('a.calendarPrev'), data.prev);
+        updateLink(portlet.find('a.calendarNext'), data.next);
+    }
+
+    function navigate(event) {
+        var link = $(this),
+            portlet = link.closest('.portletCalendarEx'),
+            wrapper = link.closest('.portletWrapper'),
+            portlethash, url;
+        if (!wrapper.length ||
+                portlet.find('table.ploneCalendar').length > 1) {
+            // not rendered by a portlet manager, or showing several
+            // months: reload the page
+            return;
+        }
+        event.preventDefault();
+        portlethash = wrapper.attr('id').substring('portletwrapper-'.length);
+        url = dataURL(portlethash, link.data('year'), link.data('month'));
+        $.ajax({
+            url: url,
+            dataType: 'json',
+            ifModified: true,
+            success: function (data, status) {
+                if (status === 'notmodified') {
+                    data = months[url];
+                } else {
+                    months[url] = data;
+                }
+                if (data) {
+                    render(portlet, data);
+                }
+            }
+        });
+    }
+
+    function loadTooltips() {
+        var table = $(this),
+            url = table.attr('data-tooltips');
+        if (!url) {
+            return;
+        }
+        table.removeAttr('data-tooltips');
+        $.getJSON(url, function (tooltips) {
+            table.find('tbody a').each(function () {
+                var link = $(this),
+                    tooltip = tooltips[$.trim(link.text())];
+                if (tooltip) {
+                    link.attr('title', tooltip);
+                }
+            });
+        });
+    }
+
+    $(document).ready(function () {
+        $('.portletCalendarEx table.ploneCalendar[data-tooltips]')
+            .one('mouseenter', loadTooltips);
+        // replace the @@render-portlet navigation of Plone's calendar
+        $('.portletCalendarEx a.calendarPrev, .portletCalendarEx a.calendarNext')
+            .unbind('click')
+            .click(navigate);
+    });
+}(jQuery));
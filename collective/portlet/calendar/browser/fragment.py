@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from Products.CMFCore.utils import getToolByName
+from Products.Five.browser import BrowserView
+from collective.portlet.calendar.browser.utils import if_none_match
+from collective.portlet.calendar.browser.utils import render_etag
+from collective.portlet.calendar.config import get_setting
+from collective.portlet.calendar.utils import renderer_from_hash
+
+
+class PortletFragment(BrowserView):
+    """The HTML of a calendar portlet alone.
+
+    Expected parameters are the ``portlethash`` of the portlet and the
+    ``year`` and ``month`` to display.
+
+    ETag and Cache-Control headers are based on the portlet cache key, so
+    a caching proxy can keep the calendar apart from the pages showing it
+    and include it with ESI (see the ``esi`` setting). Calendars of
+    authenticated users are only cached privately.
+    """
+
+    def vary(self):
+        """Request headers the calendar depends on: its labels are in the
+        negotiated language, which may be chosen by the I18N_LANGUAGE cookie
+        """
+        ltool = getToolByName(self.context, 'portal_languages', None)
+        if getattr(ltool, 'use_cookie_negotiation', False):
+            return 'Accept-Language, Cookie'
+        return 'Accept-Language'
+
+    def __call__(self):
+        renderer = renderer_from_hash(self,
+                                      self.request.get('portlethash', ''))
+        renderer.update()
+        response = self.request.response
+        etag = render_etag(renderer)
+        if etag is None:
+            response.setHeader('Cache-Control', 'no-cache')
+        else:
+            mtool = getToolByName(self.context, 'portal_membership')
+            if mtool.isAnonymousUser():
+                cache_control = 'public, max-age=0, s-maxage=%d, ' \
+                    'must-revalidate' % get_setting('fragment-max-age')
+            else:
+                cache_control = 'private, max-age=0, must-revalidate'
+            response.setHeader('ETag', '"%s"' % etag)
+            response.setHeader('Cache-Control', cache_control)
+            response.setHeader('Vary', self.vary())
+            if etag in if_none_match(self.request):
+                response.setStatus(304)
+                return ''
+        response.setHeader('Content-Type', 'text/html; charset=utf-8')
+        return renderer.render_calendar()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import time
+from Products.Five.browser import BrowserView
+from collective.portlet.calendar import rendercache
+from collective.portlet.calendar.config import get_setting
+from collective.portlet.calendar.dayindex import rebuild
+from collective.portlet.calendar.warmup import warmup
+
+
+class RebuildDayIndex(BrowserView):
+    """Index all the events of the site by day"""
+
+    def __call__(self):
+        count = rebuild(self.context)
+        self.request.response.setHeader('Content-Type', 'text/plain')
+        return 'Day index rebuilt: %d events' % count
+
+
+class CacheStats(BrowserView):
+    """Occupancy of the cache of rendered calendars in this instance"""
+
+    def __call__(self):
+        occupancy = rendercache.backend().occupancy()
+        lines = [
+            'Backend: %s' % get_setting('cache-backend'),
+            # memcached does not bound the number of entries
+            (occupancy['max_entries'] and
+             'Entries: %(entries)d of %(max_entries)d' or
+             'Entries: %(entries)d') % occupancy,
+            'Bytes: %(bytes)d of %(max_bytes)d' % occupancy,
+            'Coalesced renderings: %d (%d timeouts)' % (
+                rendercache.flights.coalesced, rendercache.flights.timeouts),
+            'Pending refreshes: %d' % rendercache.refresher.pending(),
+            '',
+            'Assignment\tEntries\tBytes\tHits\tMisses\tEvictions',
+        ]
+        assignments = occupancy['assignments']
+        for name in sorted(assignments):
+            stats = assignments[name]
+            lines.append('\t'.join([str(name)] + [
+                str(stats[k]) for k in ('entries', 'bytes', 'hits', 'misses',
+                                        'evictions')]))
+        self.request.response.setHeader('Content-Type', 'text/plain')
+        return '\n'.join(lines)
+
+
+class Warmup(BrowserView):
+    """Render the previous, current and next months of every calendar
+    portlet of the site into the cache, as anonymous
+
+    The ``threads`` parameter overrides the ``warmup-threads`` setting.
+    """
+
+    def __call__(self):
+        threads = int(self.request.get('threads') or
+                      get_setting('warmup-threads'))
+        start = time.time()
+        report = warmup(self.context, self.request, threads=threads)
+        lines = ['%s %04d/%02d %.3fs %s' % line for line in report]
+        outcomes = [line[4] for line in report]
+        lines.append('Warmed up %d calendars over %d months: %d rendered, '
+                     '%d cached, %d errors, in %.3fs (%d threads)' % (
+                         len(set([line[0] for line in report])),
+                         len(set([line[1:3] for line in report])),
+                         outcomes.count('rendered'), outcomes.count('cached'),
+                         len([o for o in outcomes
+                              if o not in ('rendered', 'cached')]),
+                         time.time() - start, threads))
+        self.request.response.setHeader('Content-Type', 'text/plain')
+        return '\n'.join(lines)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import json
+
+from Products.CMFPlone import PloneMessageFactory as PLMF
+from Products.Five.browser import BrowserView
+from collective.portlet.calendar.browser.utils import if_none_match
+from collective.portlet.calendar.browser.utils import render_etag
+from collective.portlet.calendar.utils import renderer_from_hash
+from zope.i18n import translate
+
+
+class MonthData(BrowserView):
+    """A month of a calendar portlet as JSON, used by the portlet to move to
+    the previous or next month without reloading the page.
+
+    Expected parameters are the ``portlethash`` of the portlet and the
+    ``year`` and ``month`` to display.
+
+    Weeks are lists of days, a day being 0 (outside the month), its number
+    (no events) or a list with its number, the events tooltip, the link
+    to the search page and, for calendars showing the event density, the
+    density of the day.
+    """
+
+    def data(self, renderer):
+        weeks = []
+        for week in renderer.getEventsForCalendar(tooltips=True):
+            days = []
+            for day in week:
+                if not day['day']:
+                    days.append(0)
+                elif day.get('density'):
+                    days.append([day['day'], day['eventstring'],
+                                 day['link'], day['density']])
+                elif day['event']:
+                    days.append([day['day'], day['eventstring'],
+                                 day['link']])
+                else:
+                    days.append(day['day'])
+            weeks.append(days)
+        month_name = translate(renderer.monthName, context=self.request)
+        title = PLMF(u'${monthname} ${year}',
+                     mapping={'monthname': month_name,
+                              'year': renderer.year})
+        now = renderer.now
+        if (now[0], now[1]) == (renderer.year, renderer.month):
+            today = now[2]
+        else:
+            today = 0
+        return {
+            'year': renderer.year,
+            'month': renderer.month,
+            'title': translate(title, context=self.request),
+            'today': today,
+            'prev': renderer.showPrevMonth and
+            [renderer.prevMonthYear, renderer.prevMonthMonth] or None,
+            'next': renderer.showNextMonth and
+            [renderer.nextMonthYear, renderer.nextMonthMonth] or None,
+            'weeks': weeks,
+        }
+
+    def __call__(self):
+        renderer = renderer_from_hash(self,
+                                      self.request.get('portlethash', ''))
+        renderer.update()
+        response = self.request.response
+        etag = render_etag(renderer)
+        if etag is not None:
+            response.setHeader('ETag', '"%s"' % etag)
+            response.setHeader('Cache-Control',
+                               'private, max-age=0, must-revalidate')
+            if etag in if_none_match(self.request):
+                response.setStatus(304)
+                return ''
+        response.setHeader('Content-Type', 'application/json')
+        return json.dumps(self.data(renderer), separators=(',', ':'))
+
+
+class DayTooltips(MonthData):
+    """The tooltips of the days with events of a calendar portlet as JSON,
+    by day number, for portlets rendered without them (see the
+    ``lazy-tooltips`` setting).
+
+    Parameters are the ones of @@calendar-month-data.
+    """
+
+    def data(self, renderer):
+        tooltips = {}
+        for week in renderer.getEventsForCalendar(tooltips=True):
+            for day in week:
+                if day['event']:
+                    tooltips[day['day']] = day['eventstring']
+        return tooltips
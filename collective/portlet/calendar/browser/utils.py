@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from collective.portlet.calendar.calendar import _render_cachekey
+from hashlib import md5
+from plone.memoize import ram
+
+
+def if_none_match(request):
+    """ETags listed in the If-None-Match header of the request"""
+    header = request.getHeader('If-None-Match', '')
+    etags = []
+    for etag in header.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        etags.append(etag.strip('"'))
+    return etags
+
+
+def render_etag(renderer):
+    """ETag of a calendar portlet, None when it can not be cached"""
+    try:
+        key = _render_cachekey(renderer.render_calendar, renderer)
+    except ram.DontCache:
+        return None
+    # the title is filled in after the render cache, see render_calendar
+    return md5(key + renderer.name.encode('utf-8')).hexdigest()
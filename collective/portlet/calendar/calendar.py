@@ -1,15 +1,41 @@
 # -*- coding:utf-8 -*-
 
+import re
+from AccessControl import getSecurityManager
+from Acquisition import aq_chain
 from Acquisition import aq_inner
 from DateTime import DateTime
 from Products.ATContentTypes.interfaces import IATTopic
+from Products.CMFCore.permissions import AccessInactivePortalContent
+from Products.CMFCore.utils import _checkPermission
 from Products.CMFCore.utils import getToolByName
+from Products.CMFCore.interfaces import IContentish
 from Products.CMFCore.interfaces import IFolderish
+from Products.CMFCore.interfaces import ISiteRoot
+from Products.CMFPlone import PloneMessageFactory as PLMF
 from Products.ATContentTypes.interfaces.folder import IATFolder
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
+from Products.ZCatalog.Lazy import LazyMap
 from StringIO import StringIO
 from ZTUtils import make_query
+from cgi import escape
+from copy import deepcopy
+from datetime import date
 from collective.portlet.calendar import MessageFactory as _
+from collective.portlet.calendar import rendercache
+from collective.portlet.calendar.config import get_setting
+from collective.portlet.calendar.dayindex import get_dayindex
+from collective.portlet.calendar.invalidation import get_generation
+from collective.portlet.calendar.rangeindex import merge
+from collective.portlet.calendar.rangeindex import overlapping
+from collective.portlet.calendar.recurrence import has_recurring_index
+from collective.portlet.calendar.recurrence import occurrence_days
+from collective.portlet.calendar.recurrence import recurring
+from collective.portlet.calendar.utils import _at_midnight
+from collective.portlet.calendar.utils import _day
+from collective.portlet.calendar.utils import _time
+from collective.portlet.calendar.utils import index_day
+from collective.portlet.calendar.utils import month_days
 from plone.app.collection.interfaces import ICollection
 from plone.app.form.widgets.uberselectionwidget import UberSelectionWidget
 from plone.app.querystring.queryparser import parseFormquery
@@ -20,30 +46,31 @@ from plone.app.vocabularies.catalog import SearchableTextSourceBinder
 from plone.memoize import ram, instance
 from plone.memoize.compress import xhtml_compress
 from plone.portlets.interfaces import IPortletDataProvider
+from plone.uuid.interfaces import IUUID
+from time import time
 from zope import schema
+from zope.annotation.interfaces import IAnnotations
 from zope.component import getMultiAdapter
+from zope.component.hooks import getSite
 from zope.formlib import form
+from zope.i18n import translate
 from zope.interface import implements
 
-
-def add_cachekey(key, brain):
-    key.write(brain.getPath())
-    key.write('\n')
-    key.write(brain.modified)
-    key.write('\n\n')
+MONTH_EVENTS_KEY = 'collective.portlet.calendar.month_events'
+TITLE_MARKER = u'@@calendar-portlet-title@@'
+# 2019/06/15 or 2019-06-15T10:00:00
+DATE_PREFIX = re.compile(r'(\d{4})[/-](\d{1,2})[/-]\d{1,2}(?:[ T]|$)')
 
 
 def _define_search_options(renderer, options):
     """Obtain a proper query to be used in search"""
-    catalog = getToolByName(renderer.context, 'portal_catalog')
-    all_review_states = catalog.uniqueValuesFor('review_state')
     if not options:
         # Folder, or site root.
         options['path'] = renderer.root()
         if renderer.data.kw:
             options['Subject'] = renderer.data.kw
-        options['review_state'] = renderer.data.review_state \
-            if renderer.data.review_state else all_review_states
+        options['review_state'] = renderer.data.review_state or \
+            _review_states(renderer)
     else:
         # Collection
         # Type check: seems that new style collections are returning parameters as tuples
@@ -56,11 +83,518 @@ def _define_search_options(renderer, options):
             renderer._fix_range_criteria('end')
         if not options.get('review_state'):
             # We need to override the calendar default behaviour with review state
-            options['review_state'] = all_review_states
+            options['review_state'] = _review_states(renderer)
     return options
 
 
-def _render_cachekey(fun, self):
+def _review_states(renderer):
+    """All the review states of the site, as compiled with the query (see
+    compile_query) or else looked up in the catalog once per request
+    """
+    compiled = renderer.compiledQuery()
+    if compiled is not None and compiled.get('site_states'):
+        return list(compiled['site_states'])
+    catalog = getToolByName(renderer.context, 'portal_catalog')
+    return _shared(renderer, ('review_states', ), catalog.uniqueValuesFor,
+                   'review_state')
+
+
+def _query_key(query):
+    """Hashable and order independent representation of a catalog query"""
+    if isinstance(query, dict):
+        return tuple(sorted((k, _query_key(v)) for k, v in query.items()))
+    if isinstance(query, (list, tuple)):
+        return tuple(_query_key(v) for v in query)
+    return query
+
+
+def _month_range(calendar, year, month):
+    """First and last moment of a month, as used by portal_calendar"""
+    last_day = calendar._getCalendar().monthrange(year, month)[1]
+    first_date = calendar.getBeginAndEndTimes(1, month, year)[0]
+    last_date = calendar.getBeginAndEndTimes(last_day, month, year)[1]
+    return first_date, last_date
+
+
+def _year_and_month(value):
+    """(year, month) of a DateTime or of a date string such as the ones of
+    collection criteria, read from the string when it starts with them
+    """
+    if isinstance(value, basestring):
+        match = DATE_PREFIX.match(value)
+        if match is not None:
+            return int(match.group(1)), int(match.group(2))
+        value = DateTime(value)
+    return value.year(), value.month()
+
+
+def _shared(renderer, key, function, *args):
+    """function(*args), computed once per request for the portlets of a
+    page having the same key
+    """
+    results = IAnnotations(renderer.request).setdefault(MONTH_EVENTS_KEY, {})
+    if key not in results:
+        results[key] = function(*args)
+    return results[key]
+
+
+def _search_month(renderer, query, year, month):
+    """Run the month query at most once per request.
+
+    Results are kept on the request, keyed by the query, so the cache key and
+    the calendar structure share the same result set.
+
+    When the day index is available the catalog search is restricted to the
+    UIDs of the events of the month, otherwise the events overlapping the
+    month are searched, see rangeindex.overlapping. Recurring events
+    started before are added, see _add_recurring.
+    """
+    results = IAnnotations(renderer.request).setdefault(MONTH_EVENTS_KEY, {})
+    key = (_query_key(query), year, month)
+    brains = results.get(key)
+    if brains is None:
+        catalog = getToolByName(renderer.context, 'portal_catalog')
+        dayindex = get_dayindex(renderer.context)
+        if dayindex is not None and 'UID' not in query:
+            uids = dayindex.month(year, month)
+            if uids:
+                brains = list(catalog(UID=list(uids), **query))
+            else:
+                brains = []
+        else:
+            first_date, last_date = _month_range(renderer.calendar, year, month)
+            brains = merge(overlapping(catalog, query, first_date, last_date))
+        results[key] = brains = _add_recurring(renderer, query, brains,
+                                               year, month)
+    return brains
+
+
+def _add_recurring(renderer, query, brains, year, month):
+    """brains and the recurring events started before the end of a month,
+    whose occurrences are worked out by _events_by_months
+    """
+    catalog = getToolByName(renderer.context, 'portal_catalog')
+    if not has_recurring_index(catalog):
+        return brains
+    last_date = _month_range(renderer.calendar, year, month)[1]
+    recurring_brains = recurring(catalog, query, last_date)
+    if not recurring_brains:
+        return brains
+    return merge([brains, recurring_brains])
+
+
+def _events_by_day(year, month, brains):
+    """Group month events by day, as portal_calendar.catalog_getevents does,
+    but on results we already have instead of running a new search.
+    """
+    return _events_by_months([(year, month)], brains)[year, month]
+
+
+def _events_by_months(months, brains):
+    """Group the events of several months by month and day, see
+    _events_by_day, in a single pass over the brains.
+
+    Days are worked out as ordinals from the dates of the brains, in the
+    time zone of the server like in density mode (see _day_counts), no
+    DateTime is built. Like in the day index, an event ending at midnight
+    does not show up on its last day, nor in its month.
+
+    Recurring events are added on the days of their occurrences within the
+    months, see recurrence.occurrence_days.
+    """
+    result = {}
+    bounds = []
+    for year, month in months:
+        event_days = result[year, month] = {}
+        for daynumber in range(1, 32):
+            event_days[daynumber] = {'eventslist': [],
+                                     'event': 0,
+                                     'day': daynumber}
+        first = date(year, month, 1).toordinal() - 1
+        bounds.append((event_days, first, month_days(year, month)))
+    window_first = bounds[0][1] + 1
+    window_last = bounds[-1][1] + bounds[-1][2]
+    for brain in brains:
+        start = _day(brain.start)
+        # events without end end when they start
+        end_date = brain.end or brain.start
+        end = _day(end_date)
+        end_at_midnight = _at_midnight(end_date)
+        last = end
+        if end_at_midnight and end > start:
+            last -= 1
+        start_time = _time(brain.start)
+        # the end of the day before for events ending at midnight
+        end_time = end_at_midnight and '23:59:59' or _time(end_date)
+        title = brain.Title or brain.getId
+        shifts = (0,)
+        if getattr(brain, 'recurrence', None):
+            # the occurrences overlapping the months
+            shifts = [day - start for day in occurrence_days(
+                brain, window_first - (last - start), window_last)]
+        for shift in shifts:
+            for event_days, first, last_day in bounds:
+                if last + shift <= first or start + shift > first + last_day:
+                    # not this month
+                    continue
+                _add_event(event_days, last_day, start + shift - first,
+                           end + shift - first, start_time, end_time,
+                           end_at_midnight, title)
+    return result
+
+
+def _add_event(event_days, last_day, event_start_day, event_end_day,
+               start_time, end_time, end_at_midnight, title):
+    """Add an event to the days of a month, given its first and last day
+    numbers (out of the month for events of other months too)
+    """
+    event = {'title': title}
+    # events that end next month
+    if event_end_day > last_day:
+        event_end_day = last_day
+        event['end'] = None
+    else:
+        event['end'] = end_time
+    # events that started last month
+    if event_start_day < 1:
+        event_start_day = 1
+        event['start'] = None
+    else:
+        event['start'] = start_time
+
+    if event_start_day != event_end_day:
+        all_event_days = range(event_start_day, event_end_day + 1)
+        event_days[event_start_day]['eventslist'].append(
+            {'end': None,
+             'start': start_time,
+             'title': title})
+        event_days[event_start_day]['event'] = 1
+
+        for eventday in all_event_days[1:-1]:
+            event_days[eventday]['eventslist'].append(
+                {'end': None,
+                 'start': None,
+                 'title': title})
+            event_days[eventday]['event'] = 1
+
+        if end_at_midnight and event['end'] is not None:
+            # ends some day this month at midnight
+            last_days_event = \
+                event_days[all_event_days[-2]]['eventslist'][-1]
+            last_days_event['end'] = event['end']
+        else:
+            event_days[event_end_day]['eventslist'].append(
+                {'end': event['end'],
+                 'start': None,
+                 'title': title})
+            event_days[event_end_day]['event'] = 1
+    else:
+        event_days[event_start_day]['eventslist'].append(event)
+        event_days[event_start_day]['event'] = 1
+
+
+def _result_rids(results):
+    """Record ids of catalog results, without creating their brains"""
+    if isinstance(results, LazyMap):
+        return results._seq
+    return [brain.getRID() for brain in results]
+
+
+def _day_counts(renderer, query, months):
+    """Number of events of each day of consecutive months, by (year, month)
+    and day number (0 being unused), the months being searched at once.
+
+    The search is not sorted and its brains are never created: days are
+    worked out from the record ids of the results and the values of the
+    start and end indexes, with the rules of _events_by_day. Only the
+    brains of recurring events are needed, for their rule.
+    """
+    catalog = getToolByName(renderer.context, 'portal_catalog')
+    first_date = _month_range(renderer.calendar, *months[0])[0]
+    last_date = _month_range(renderer.calendar, *months[-1])[1]
+    query = dict(query)
+    query.pop('sort_on', None)
+    rids = set()
+    for results in overlapping(catalog, query, first_date, last_date):
+        rids.update(_result_rids(results))
+    recurring_brains = {}
+    if has_recurring_index(catalog):
+        for brain in recurring(catalog, query, last_date):
+            recurring_brains[brain.getRID()] = brain
+        rids.update(recurring_brains)
+    start_index = catalog._catalog.getIndex('start')
+    end_index = catalog._catalog.getIndex('end')
+    counts = {}
+    bounds = []
+    for year, month in months:
+        last_day = month_days(year, month)
+        month_counts = counts[year, month] = [0] * (last_day + 1)
+        bounds.append((month_counts, date(year, month, 1).toordinal() - 1,
+                       last_day))
+    window_first = bounds[0][1] + 1
+    window_last = bounds[-1][1] + bounds[-1][2]
+    for rid in rids:
+        start = start_index.getEntryForObject(rid)
+        if start is None:
+            continue
+        start_day = index_day(start)[0]
+        end = end_index.getEntryForObject(rid)
+        end_day = start_day
+        if end is not None:
+            end_day, end_at_midnight = index_day(end)
+            if end_at_midnight and end_day > start_day:
+                end_day -= 1
+        shifts = (0,)
+        if rid in recurring_brains:
+            shifts = [day - start_day for day in occurrence_days(
+                recurring_brains[rid], window_first - (end_day - start_day),
+                window_last)]
+        for shift in shifts:
+            for month_counts, first, last_day in bounds:
+                for daynumber in range(max(start_day + shift - first, 1),
+                                       min(end_day + shift - first,
+                                           last_day) + 1):
+                    month_counts[daynumber] += 1
+    return counts
+
+
+def _depends_on_month(query):
+    """Tell if a query is to be searched month by month: collections with
+    date criteria, or restricted to the UIDs of the day index
+    """
+    return 'start' in query or 'end' in query or 'UID' in query
+
+
+def _adjacent_months(year, month):
+    """Previous, given and next (year, month)"""
+    return [(year - 1, 12) if month == 1 else (year, month - 1),
+            (year, month),
+            (year + 1, 1) if month == 12 else (year, month + 1)]
+
+
+def _search_months(renderer, query, months):
+    """Run a single query for the events of consecutive months, see
+    _events_by_months to group them by month
+    """
+    catalog = getToolByName(renderer.context, 'portal_catalog')
+    dayindex = get_dayindex(renderer.context)
+    if dayindex is not None:
+        uids = set()
+        for year, month in months:
+            uids.update(dayindex.month(year, month))
+        brains = uids and list(catalog(UID=list(uids), **query)) or []
+    else:
+        first_date = _month_range(renderer.calendar, *months[0])[0]
+        last_date = _month_range(renderer.calendar, *months[-1])[1]
+        brains = merge(overlapping(catalog, query, first_date, last_date))
+    return _add_recurring(renderer, query, brains, *months[-1])
+
+
+def _month_events(renderer, query, year, month):
+    """Events of a month by day, see _events_by_day.
+
+    With the ``prefetch-months`` setting, the previous and next months are
+    searched at the same time and the events of the three months are kept
+    in rendercache.months, so navigating to an adjacent month needs no
+    catalog search.
+    """
+    if not get_setting('prefetch-months') or _depends_on_month(query):
+        # collections with date criteria are searched month by month
+        brains = _search_month(renderer, query, year, month)
+        return _events_by_day(year, month, brains)
+    catalog = getToolByName(renderer.context, 'portal_catalog')
+    roles = catalog._listAllowedRolesAndUsers(getSecurityManager().getUser())
+    prefix = repr((_query_key(query), roles))
+    cached = rendercache.months.get(prefix + repr((year, month)))
+    if cached is not None and \
+            cached[0] == _month_stamp(renderer, query, year, month):
+        return cached[1]
+    months = _adjacent_months(year, month)
+    results = _events_by_months(months,
+                                _search_months(renderer, query, months))
+    for other_year, other_month in months:
+        events = results[other_year, other_month]
+        rendercache.months.set(
+            prefix + repr((other_year, other_month)),
+            _month_stamp(renderer, query, other_year, other_month),
+            events, size=len(repr(events)))
+        if (other_year, other_month) == (year, month):
+            result = events
+    return result
+
+
+def _month_stamp(renderer, query, year, month):
+    """What the events of a month found by the current user depend on: the
+    generation of the month and, for users who may not see inactive
+    content, the day and the events published or expired since (see
+    _published_since)
+    """
+    stamp = (get_generation(renderer.context, year, month),)
+    catalog = getToolByName(renderer.context, 'portal_catalog')
+    if not _checkPermission(AccessInactivePortalContent, catalog):
+        stamp += (date.today(),
+                  _published_since(renderer, query, [(year, month)]))
+    return stamp
+
+
+def _month_weeks(calendar, year, month, event_days):
+    """Weeks of the month, each day being a mapping like the ones returned
+    by portal_calendar.getEventsForCalendar
+    """
+    weeks = []
+    for week in calendar._getCalendar().monthcalendar(year, month):
+        days = []
+        for day in week:
+            if day in event_days:
+                # event days may be cached, they are not to be changed
+                days.append(dict(event_days[day]))
+            else:
+                days.append({'day': day, 'event': 0, 'eventslist': []})
+        weeks.append(days)
+    return weeks
+
+
+def _per_user(collection):
+    """Whether the query of a collection has 'current user' criteria"""
+    if IATTopic.providedBy(collection):
+        return bool(collection.objectIds('ATCurrentAuthorCriterion'))
+    return bool([row for row in
+                 collection.getField('query').getRaw(collection) or []
+                 if 'currentUser' in row.get('o', '')])
+
+
+def _collection_cachekey(fun, collection):
+    """Parsed queries change with the collection and its criteria, the day
+    (relative dates) and the user for 'current user' criteria
+    """
+    if IATTopic.providedBy(collection):
+        # criteria are not loaded: they are listed by the topic, and the
+        # topic is cataloged again when they are edited
+        catalog = getToolByName(collection, 'portal_catalog')
+        version = (collection.objectIds(), collection._p_mtime,
+                   catalog.getCounter())
+    else:
+        version = collection.getField('query').getRaw(collection) or []
+    user = _per_user(collection) and \
+        getSecurityManager().getUser().getId() or None
+    return (IUUID(collection, None), '/'.join(collection.getPhysicalPath()),
+            collection.modified(), repr(version), date.today(), user)
+
+
+@ram.cache(_collection_cachekey)
+def _parse_collection(collection):
+    """Catalog query of a collection or topic, parsed once per version"""
+    if IATTopic.providedBy(collection):
+        return collection.buildQuery()
+    return parseFormquery(collection,
+                          collection.getField('query').getRaw(collection))
+
+
+def _root_state_cachekey(fun, catalog, uid, path, collection):
+    return uid, path, collection, catalog.getCounter()
+
+
+@ram.cache(_root_state_cachekey)
+def _root_state(catalog, uid, path, collection):
+    """UID, path and modification date of the root of a portlet, found by
+    uid or else by path, and for collections whether their query depends
+    on the user (see _per_user); None when the root is not cataloged.
+
+    Looked up once per change of the catalog, so rendering a cached
+    calendar neither searches nor loads its root.
+    """
+    if uid:
+        brains = catalog.unrestrictedSearchResults(UID=uid)
+    else:
+        brains = catalog.unrestrictedSearchResults(
+            path={'query': path, 'depth': 0})
+    if not brains:
+        return None
+    brain = brains[0]
+    return {'uid': brain.UID,
+            'path': brain.getPath(),
+            'modified': brain.modified,
+            'per_user': collection and
+            _per_user(brain._unrestrictedGetObject())}
+
+
+def _collection_query_cachekey(fun, renderer, state):
+    catalog = getToolByName(renderer.context, 'portal_catalog')
+    user = state['per_user'] and getSecurityManager().getUser().getId() or None
+    return (state['uid'], state['path'], catalog.getCounter(), date.today(),
+            user)
+
+
+@ram.cache(_collection_query_cachekey)
+def _collection_query(renderer, state):
+    """Parsed query of the collection root of a compiled query, the
+    collection being loaded once per change of the catalog, see _root_state
+    """
+    return _parse_collection(renderer.rootContent())
+
+
+def _day_labels_cachekey(fun, renderer, year, month):
+    context = aq_inner(renderer.context)
+    properties = getToolByName(context, 'portal_properties')
+    return (cache.get_language(context, renderer.request),
+            properties.site_properties.getProperty('localTimeFormat'),
+            year, month)
+
+
+@ram.cache(_day_labels_cachekey)
+def _day_labels(renderer, year, month):
+    """Localized dates of the days of a month, as shown in tooltips, built
+    at once for a language and month
+    """
+    context = aq_inner(renderer.context)
+    return tuple([renderer._ts.ulocalized_time(DateTime(year, month, day),
+                                               context=context,
+                                               request=renderer.request)
+                  for day in range(1, month_days(year, month) + 1)])
+
+
+def _publication_times_cachekey(fun, renderer, query, months):
+    return (_query_key(query), tuple(months), date.today(),
+            tuple([get_generation(renderer.context, year, month)
+                   for year, month in months]))
+
+
+@ram.cache(_publication_times_cachekey)
+def _publication_times(renderer, query, months):
+    """Times (in seconds) at which events of the months get effective or
+    expire today, searched again the next day or when the events change.
+
+    Users who may not see inactive content only find effective events, so
+    their calendars change at these times without any event being edited.
+    """
+    catalog = getToolByName(renderer.context, 'portal_catalog')
+    last_date = _month_range(renderer.calendar, *months[-1])[1]
+    query = dict(query)
+    query.pop('sort_on', None)
+    # events started before, recurring ones included
+    query.setdefault('start', {'query': last_date, 'range': 'max'})
+    today = DateTime().earliestTime()
+    day = {'query': (today, today + 1), 'range': 'min:max'}
+    times = []
+    for index in ('effective', 'expires'):
+        query[index] = day
+        for brain in catalog.unrestrictedSearchResults(**query):
+            times.append(getattr(brain, index).timeTime())
+        del query[index]
+    return sorted(times)
+
+
+def _published_since(renderer, query, months):
+    """Number of events of the months that got effective or expired today
+    until now, see _publication_times
+    """
+    now = time()
+    return len([t for t in _publication_times(renderer, query, months)
+                if t <= now])
+
+
+def _render_identity(self):
+    """What a rendered calendar depends on, apart from invalidation"""
     context = aq_inner(self.context)
     if not self.updated:
         self.update()
@@ -70,43 +604,49 @@ def _render_cachekey(fun, self):
     else:
         portal_state = getMultiAdapter(
             (context, self.request), name=u'plone_portal_state')
+        catalog = getToolByName(context, 'portal_catalog')
+        user = getSecurityManager().getUser()
         key = StringIO()
-        print >> key, [k.encode('utf-8') for k in self.data.kw]
-        print >> key, self.data.review_state
-        print >> key, self.data.name
+        # portlets with the same query share their entries, only the title
+        # differs, see Renderer.render_calendar
+        print >> key, _query_key(self._month_query())
+        print >> key, self.hasName()
+        print >> key, getattr(self.data, 'density', False)
+        print >> key, getattr(self.data, 'months', 1)
         print >> key, portal_state.navigation_root_url()
         print >> key, cache.get_language(context, self.request)
         print >> key, self.calendar.getFirstWeekDay()
+        print >> key, self.calendar.getCalendarTypes()
+        print >> key, self.tooltipsURL()
+        # what the current user is allowed to see
+        print >> key, catalog._listAllowedRolesAndUsers(user)
 
         year, month = self.getYearAndMonthToDisplay()
         print >> key, year
         print >> key, month
-        navigation_root_path = self.root()
-        start = DateTime('%s/%s/1' % (year, month))
-        end = DateTime('%s/%s/1 23:59:59' % self.getNextMonth(year, month)) - 1
 
-        catalog = getToolByName(context, 'portal_catalog')
+        return key.getvalue()
 
-        self.options = {}
-        if navigation_root_path:
-            root_content = self.context.restrictedTraverse(navigation_root_path)
-            if IATTopic.providedBy(root_content):
-                self.options = root_content.buildQuery()
-            elif ICollection.providedBy(root_content):
-                self.options = parseFormquery(root_content,
-                                              root_content.getField('query').getRaw(root_content))
-            print >> key, root_content.modified()
-
-        self.options['start'] = {'query': end, 'range': 'max'}
-        self.options['end'] = {'query': start, 'range': 'min'}
 
-        _define_search_options(self, self.options)
-        brains = catalog(**self.options)
+def _render_freshness(self):
+    """Invalidation state of a rendered calendar"""
+    key = StringIO()
+    # today is highlighted
+    print >> key, self.now[:3]
+    print >> key, self.rootModified()
+    # bumped when events of the months change, see invalidation.py
+    for year, month in self.displayedMonths():
+        print >> key, get_generation(self.context, year, month)
+    catalog = getToolByName(self.context, 'portal_catalog')
+    if not _checkPermission(AccessInactivePortalContent, catalog):
+        # events published or expired since, see _publication_times
+        print >> key, _published_since(self, self._month_query(),
+                                       self.displayedMonths())
+    return key.getvalue()
 
-        for brain in brains:
-            add_cachekey(key, brain)
 
-        return key.getvalue()
+def _render_cachekey(fun, self):
+    return _render_identity(self) + _render_freshness(self)
 
 
 class ICalendarExPortlet(IPortletDataProvider):
@@ -165,6 +705,26 @@ class ICalendarExPortlet(IPortletDataProvider):
         value_type=schema.TextLine()
     )
 
+    density = schema.Bool(
+        title=_(u'label_calendarex_density', default=u'Show event density'),
+        description=_(
+            u'help_calendarex_density',
+            default=u'Show the number of events of each day instead of '
+                    u'their titles. Meant for calendars with many events.'),
+        default=False,
+        required=False)
+
+    months = schema.Int(
+        title=_(u'label_calendarex_months', default=u'Number of months'),
+        description=_(
+            u'help_calendarex_months',
+            default=u'Number of months shown, from the current one on: '
+                    u'3 for a quarter, 12 for a year at a glance.'),
+        default=1,
+        min=1,
+        max=12,
+        required=False)
+
 
 def untuple(options):
     """Seems that catalog only talk well with list, not tuples"""
@@ -182,12 +742,19 @@ class Assignment(base.Assignment):
     root = None
     review_state = ()
     kw = []
+    density = False
+    months = 1
+    # see compile_query
+    compiled = None
 
-    def __init__(self, name='', root=None, review_state=(), kw=[]):
+    def __init__(self, name='', root=None, review_state=(), kw=[],
+                 density=False, months=1):
         self.name = name
         self.root = root
         self.review_state = review_state
         self.kw = kw
+        self.density = density
+        self.months = months
 
     @property
     def title(self):
@@ -196,6 +763,54 @@ class Assignment(base.Assignment):
                  mapping={'name': self.name or 'unnamed'})
 
 
+def _content(obj):
+    """Closest content item in the acquisition chain of obj"""
+    for item in aq_chain(obj):
+        if IContentish.providedBy(item) or ISiteRoot.providedBy(item):
+            return item
+    return getSite()
+
+
+def _site_states(context):
+    """Review states of the workflows of the site and of its content"""
+    wtool = getToolByName(context, 'portal_workflow')
+    catalog = getToolByName(context, 'portal_catalog')
+    states = set([state for title, state in wtool.listWFStatesByTitle()])
+    states.update(catalog.uniqueValuesFor('review_state'))
+    return sorted(states)
+
+
+def compile_query(assignment, context):
+    """Store on the assignment the search criteria that do not change from a
+    render to another: the root found from context, encoded keywords and
+    review states, all the ones of the site when none is selected.
+
+    Renderers use them for contexts with the same navigation root.
+    """
+    portal_state = getMultiAdapter(
+        (context, context.REQUEST), name=u'plone_portal_state')
+    navigation_root = portal_state.navigation_root_path()
+    root_path = '%s%s' % (navigation_root, assignment.root or '')
+    root = portal_state.portal().unrestrictedTraverse(root_path, None)
+    states = _site_states(context)
+    assignment.compiled = {
+        'navigation_root': navigation_root,
+        'root_path': root_path,
+        'root_uid': IUUID(root, None),
+        'collection': IATTopic.providedBy(root) or ICollection.providedBy(root),
+        'Subject': [k.encode('utf-8') if isinstance(k, unicode) else k
+                    for k in assignment.kw or ()],
+        'review_state': list(assignment.review_state or ()) or states,
+        # for collections without review state criteria
+        'site_states': states,
+    }
+
+
+def assignment_modified(assignment, event):
+    """Subscriber compiling the query of edited assignments"""
+    compile_query(assignment, _content(assignment))
+
+
 class Renderer(base.Renderer):
     _template = ViewPageTemplateFile('calendar.pt')
 
@@ -204,13 +819,97 @@ class Renderer(base.Renderer):
         self.updated = False
         self.options = {}
 
-    @ram.cache(_render_cachekey)
     def render(self):
+        if get_setting('esi') and self.fragmentURL():
+            return '<esi:include src="%s" />' % escape(self.fragmentURL(), True)
+        return self.render_calendar()
+
+    def render_calendar(self):
+        html = rendercache.render(self, _render_identity, _render_freshness)
+        # rendered calendars are shared by the portlets having the same query
+        return html.replace(TITLE_MARKER, escape(self.name), 1)
+
+    def _render(self):
         return xhtml_compress(self._template())
 
+    def _viewURL(self, name):
+        """URL of a view of this portlet for the displayed month, None when
+        the portlet is not rendered by a portlet manager
+        """
+        metadata = getattr(self, '__portlet_metadata__', None) or {}
+        if not metadata.get('hash'):
+            return None
+        if not self.updated:
+            self.update()
+        return '%s/@@%s?%s' % (
+            self.context.absolute_url(), name,
+            make_query(portlethash=metadata['hash'],
+                       year=self.year, month=self.month))
+
+    def fragmentURL(self):
+        """URL of the portlet HTML alone, for ESI includes"""
+        return self._viewURL('calendar-portlet-fragment')
+
+    def tooltipsURL(self):
+        """URL the tooltips of the days are loaded from, None when they are
+        part of the HTML (see the lazy-tooltips setting)
+        """
+        if not get_setting('lazy-tooltips') or \
+                getattr(self.data, 'months', 1) > 1:
+            # the tooltips view only has the month to display
+            return None
+        return self._viewURL('calendar-day-tooltips')
+
+    def lazyTooltips(self):
+        return self.tooltipsURL() is not None
+
+    @instance.memoize
+    def compiledQuery(self):
+        """Compiled query of the assignment, None when it has none or when
+        it was compiled for another navigation root
+        """
+        compiled = getattr(self.data, 'compiled', None)
+        if compiled is None:
+            return None
+        portal_state = getMultiAdapter(
+            (self.context, self.request), name=u'plone_portal_state')
+        if compiled['navigation_root'] != portal_state.navigation_root_path():
+            return None
+        return compiled
+
     @instance.memoize
+    def rootContent(self):
+        return self.context.restrictedTraverse(self.root())
+
+    @instance.memoize
+    def rootState(self):
+        """Current path and modification date of the root, see _root_state,
+        found by UID for compiled queries
+        """
+        catalog = getToolByName(self.context, 'portal_catalog')
+        compiled = self.compiledQuery()
+        if compiled is not None:
+            return _root_state(catalog, compiled['root_uid'],
+                               compiled['root_path'], compiled['collection'])
+        return _root_state(catalog, None, self.root(), False)
+
+    def rootModified(self):
+        """Modification date of the root, without loading it when it is
+        cataloged
+        """
+        portal = getToolByName(self.context, 'portal_url').getPortalObject()
+        if self.root() == '/'.join(portal.getPhysicalPath()):
+            return portal.modified()
+        state = self.rootState()
+        if state is not None:
+            return state['modified']
+        return self.rootContent().modified()
+
     def rootTopic(self):
-        topic = self.context.restrictedTraverse(self.root())
+        compiled = self.compiledQuery()
+        if compiled is not None and not compiled['collection']:
+            return None
+        topic = self.rootContent()
         if IATTopic.providedBy(topic) or ICollection.providedBy(topic):
             return topic
         return None
@@ -232,7 +931,19 @@ class Renderer(base.Renderer):
     def name(self):
         return self.data.name or ''
 
+    def titleMarker(self):
+        """Placeholder of the title in the rendered HTML"""
+        return TITLE_MARKER
+
     def root(self):
+        compiled = self.compiledQuery()
+        if compiled is not None:
+            if compiled['root_uid']:
+                # follow the root when it is moved or renamed
+                state = self.rootState()
+                if state is not None:
+                    return state['path']
+            return compiled['root_path']
         portal_state = getMultiAdapter(
             (self.context, self.request), name=u'plone_portal_state')
         if self.data.root:
@@ -258,10 +969,12 @@ class Renderer(base.Renderer):
         if not isinstance(criteria['query'], list):
             criteria['query'] = [criteria['query']]
 
-        # New style collection return a string for date criteria... awful but true
-        criteria['query'] = [DateTime(d) if isinstance(d, basestring) else d for d in criteria['query']]
-        # keep only dates inside the current month
-        criteria['query'] = [d for d in criteria['query'] if d.year() == year and d.month() == month]
+        # keep only dates inside the current month; new style collections
+        # return strings for date criteria, they are only converted for the
+        # catalog once filtered
+        criteria['query'] = [DateTime(d) if isinstance(d, basestring) else d
+                             for d in criteria['query']
+                             if _year_and_month(d) == (year, month)]
 
         if index == 'start':
             last_day = self.calendar._getCalendar().monthrange(year, month)[1]
@@ -276,43 +989,238 @@ class Renderer(base.Renderer):
                 criteria['range'] = 'minmax'
         self.options[index] = criteria
 
-    def getEventsForCalendar(self):
-        navigation_root_path = self.root()
+    def getEventsForCalendar(self, tooltips=None):
+        """Weeks of the month to display. Days with events have their
+        tooltip as ``eventstring``, or None when tooltips are loaded lazily,
+        unless ``tooltips`` is given.
+
+        Portlets showing several months give them all with
+        getCalendarMonths.
+        """
+        if tooltips is None:
+            tooltips = not self.lazyTooltips()
+        weeks = self._get_calendar_structure(tooltips)
+        return weeks
 
+    def _month_query(self):
+        """Catalog query for the month to display, without the month
+        boundaries.
+
+        ``self.options`` is left with the portlet criteria only, as used by
+        the search links; the returned query also has the calendar tool
+        defaults. Criteria compiled when the assignment was saved are used
+        when possible, see compile_query.
+        """
+        query = {'portal_type': self.calendar.getCalendarTypes(),
+                 'review_state': self.calendar.getCalendarStates(),
+                 'sort_on': 'start'}
         self.options = {}
-        if navigation_root_path:
+        compiled = self.compiledQuery()
+        if compiled is not None and not compiled['collection']:
+            self.options['path'] = self.root()
+            if compiled['Subject']:
+                self.options['Subject'] = list(compiled['Subject'])
+            # None for queries compiled by older versions
+            self.options['review_state'] = list(
+                compiled['review_state'] or _review_states(self))
+            query.update(self.options)
+            return query
+
+        # the cached queries are not to be changed by _fix_range_criteria
+        if compiled is not None and compiled['collection'] and \
+                self.rootState() is not None:
+            # the collection is not loaded for cached calendars
+            self.options = deepcopy(_collection_query(self, self.rootState()))
+        else:
             root_content = self.rootTopic()
             if root_content:
-                if IATTopic.providedBy(root_content):
-                    self.options = root_content.buildQuery()
-                elif ICollection.providedBy(root_content):
-                    self.options = parseFormquery(root_content, root_content.getField('query').getRaw(root_content))
+                self.options = deepcopy(_parse_collection(root_content))
 
         _define_search_options(self, self.options)
-        weeks = self._get_calendar_structure()
-        return weeks
-
-    def _get_calendar_structure(self):
-        context = aq_inner(self.context)
-        year = self.year
-        month = self.month
         if self.options.get('Subject', None):
-            self.options['Subject'] = [el.encode('utf-8') for el in self.options['Subject']]
-        weeks = self.calendar.getEventsForCalendar(month, year, **self.options)
+            self.options['Subject'] = [el.encode('utf-8') if isinstance(el, unicode) else el
+                                       for el in self.options['Subject']]
+
+        query.update(self.options)
+        return query
+
+    def getMonthEvents(self):
+        """Catalog results for the month to display, searched once per request
+        """
+        return _search_month(self, self._month_query(), self.year, self.month)
+
+    def getCalendarMonths(self, tooltips=None):
+        """The months shown by the portlet, from the month to display on, as
+        mappings with their ``year``, ``month``, ``monthName`` and ``weeks``
+        (see getEventsForCalendar)
+        """
+        if tooltips is None:
+            tooltips = not self.lazyTooltips()
+        months = []
+        for year, month in self.displayedMonths():
+            months.append({
+                'year': year,
+                'month': month,
+                'monthName': PLMF(self._ts.month_msgid(month),
+                                  default=self._ts.month_english(month)),
+                'weeks': self._get_calendar_structure(tooltips, year, month),
+            })
+        return months
+
+    def displayedMonths(self):
+        """(year, month) of the months shown by the portlet"""
+        months = [(self.year, self.month)]
+        for i in range(1, getattr(self.data, 'months', 1) or 1):
+            year, month = months[-1]
+            months.append(month == 12 and (year + 1, 1) or (year, month + 1))
+        return months
+
+    def _other_month_query(self, year, month):
+        """Catalog query of a month shown after the month to display, which
+        differs for collections with date criteria
+        """
+        saved = self.year, self.month, self.options
+        self.year, self.month = year, month
+        try:
+            return self._month_query()
+        finally:
+            self.year, self.month, self.options = saved
+
+    def _monthQueries(self, query, months):
+        """(year, month) and catalog query of each month, for queries that
+        depend on the month (see _depends_on_month)
+        """
+        for year, month in months:
+            if (year, month) != months[0]:
+                query = self._other_month_query(year, month)
+            yield (year, month), query
+
+    def _monthsEvents(self):
+        """Events of the months shown by the portlet, by month and day.
+
+        Several months are searched with a single query and their events
+        grouped in a single pass, unless the query depends on the month.
+        Portlets of a page with the same query share them.
+        """
+        months = self.displayedMonths()
+        query = self._month_query()
+        return _shared(self, ('events', _query_key(query), tuple(months)),
+                       self._searchMonthsEvents, query, months)
+
+    def _searchMonthsEvents(self, query, months):
+        if len(months) == 1:
+            return {months[0]: _month_events(self, query, *months[0])}
+        if _depends_on_month(query):
+            events = {}
+            for (year, month), query in self._monthQueries(query, months):
+                events[year, month] = _events_by_day(
+                    year, month, _search_month(self, query, year, month))
+            return events
+        return _events_by_months(months, _search_months(self, query, months))
+
+    def _monthsCounts(self):
+        """Number of events of each day of the months shown by the portlet,
+        by month and day (see _day_counts), counted like _monthsEvents
+        """
+        months = self.displayedMonths()
+        query = self._month_query()
+        return _shared(self, ('counts', _query_key(query), tuple(months)),
+                       self._countMonthsEvents, query, months)
+
+    def _countMonthsEvents(self, query, months):
+        if _depends_on_month(query):
+            counts = {}
+            for month, query in self._monthQueries(query, months):
+                counts.update(_day_counts(self, query, [month]))
+            return counts
+        return _day_counts(self, query, months)
+
+    def _get_calendar_structure(self, tooltips=True, year=None, month=None):
+        year = year or self.year
+        month = month or self.month
+        if getattr(self.data, 'density', False):
+            return self._get_density_structure(tooltips, year, month)
+        event_days = self._monthsEvents()[year, month]
+        weeks = _month_weeks(self.calendar, year, month, event_days)
+        labels = tooltips and _day_labels(self, year, month)
         for week in weeks:
             for day in week:
                 daynumber = day['day']
                 if daynumber == 0:
                     continue
-                day['is_today'] = self.isToday(daynumber)
+                day['is_today'] = self.now[:3] == (year, month, daynumber)
                 if day['event']:
-                    cur_date = DateTime(year, month, daynumber)
-                    localized_date = [self._ts.ulocalized_time(cur_date, context=context, request=self.request)]
-                    day['eventstring'] = '\n'.join(
-                        localized_date + [' %s' % self.getEventString(e) for e in day['eventslist']])
+                    if tooltips:
+                        day['eventstring'] = '\n'.join(
+                            [labels[daynumber - 1]] +
+                            [' %s' % self.getEventString(e)
+                             for e in day['eventslist']])
+                    else:
+                        day['eventstring'] = None
                     day['date_string'] = '%s-%s-%s' % (year, month, daynumber)
+                    day['link'] = self.getDayLink(day)
         return weeks
 
+    def _get_density_structure(self, tooltips, year, month):
+        """Like _get_calendar_structure, days having the number of their
+        events and its ``density`` from 1 to 4 (relative to the busiest
+        day) instead of the events, see _day_counts
+        """
+        counts = self._monthsCounts()[year, month]
+        busiest = max(counts)
+        labels = tooltips and _day_labels(self, year, month)
+        weeks = _month_weeks(self.calendar, year, month, {})
+        for week in weeks:
+            for day in week:
+                daynumber = day['day']
+                if daynumber == 0:
+                    continue
+                day['is_today'] = self.now[:3] == (year, month, daynumber)
+                count = counts[daynumber]
+                if not count:
+                    continue
+                day['event'] = 1
+                day['count'] = count
+                day['density'] = -(-4 * count // busiest)
+                if tooltips:
+                    day['eventstring'] = '%s\n %s' % (
+                        labels[daynumber - 1], self.getCountString(count))
+                else:
+                    day['eventstring'] = None
+                day['date_string'] = '%s-%s-%s' % (year, month, daynumber)
+                day['link'] = self.getDayLink(day)
+        return weeks
+
+    def getCountString(self, count):
+        return translate(_(u'label_event_count', default=u'Events: ${count}',
+                           mapping={'count': count}),
+                         context=self.request)
+
+    @instance.memoize
+    def _dayLinkParts(self):
+        """Search URL of the days with events, split around the two
+        occurrences of the date
+        """
+        portal_state = getMultiAdapter(
+            (self.context, self.request), name=u'plone_portal_state')
+        if self.rootTopic():
+            prefix = '%s/@@search?' % portal_state.navigation_root_url()
+            suffix = '&%s' % self.collection_querystring()
+        else:
+            prefix = '%s/@@search?%s' % (portal_state.navigation_root_url(),
+                                         self.getReviewStateString())
+            suffix = '&path=%s' % self.root()
+        return (prefix + 'start.query:record:list:date=',
+                '+23%3A59%3A59&start.range:record=max&'
+                'end.query:record:list:date=',
+                '+00%3A00%3A00&end.range:record=min' + suffix)
+
+    def getDayLink(self, day):
+        """URL of the search page listing the events of a day"""
+        before, between, after = self._dayLinkParts()
+        date = day['date_string']
+        return before + date + between + date + after
+
     def getReviewStateString(self):
         states = self.data.review_state or self.calendar.getCalendarStates()
         return ''.join(map(lambda x: 'review_state=%s&' % self.url_quote_plus(x), states))
@@ -325,7 +1233,9 @@ class AddForm(base_portlet.AddForm):
     description = _(u'This calendar portlet allows choosing a subpath.')
 
     def create(self, data):
-        return Assignment(**data)
+        assignment = Assignment(**data)
+        compile_query(assignment, _content(self.context))
+        return assignment
 
 
 class EditForm(base_portlet.EditForm):
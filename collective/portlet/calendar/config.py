@@ -1,3 +1,54 @@
 # -*- coding: utf-8 -*-
+from App.config import getConfiguration
 
 PROJECTNAME = 'collective.portlet.calendar'
+
+# Settings that can be changed in the instance configuration, e.g.:
+#
+#   <product-config collective.portlet.calendar>
+#       esi on
+#       fragment-max-age 600
+#       max-stale 30
+#   </product-config>
+DEFAULTS = {
+    # render calendar portlets as ESI includes of their HTML fragment
+    'esi': False,
+    # seconds shared caches may keep a calendar fragment (s-maxage)
+    'fragment-max-age': 300,
+    # seconds an invalidated calendar may still be served while it is
+    # rendered again in the background, 0 to always render at once
+    'max-stale': 0,
+    # seconds a request waits for another one rendering the same calendar
+    # before rendering it too
+    'single-flight-timeout': 5,
+    # bounds of the cache of rendered calendars
+    'cache-max-entries': 1000,
+    'cache-max-bytes': 20 * 1024 * 1024,
+    # where rendered calendars are stored: 'memory' for each instance, or
+    # 'memcached' for all the instances using the servers below
+    'cache-backend': 'memory',
+    'memcached-servers': '127.0.0.1:11211',
+    # threads rendering calendars for @@calendar-warmup, each with a ZODB
+    # connection of its own when more than 1
+    'warmup-threads': 1,
+    # search the events of the previous and next months with the ones of
+    # the displayed month, and keep them for navigation
+    'prefetch-months': False,
+    # leave the tooltips of the days out of the portlet HTML, they are
+    # loaded from @@calendar-day-tooltips when the calendar is hovered
+    'lazy-tooltips': False,
+}
+
+
+def get_setting(name):
+    """Value of a setting of the product-config section, or its default"""
+    default = DEFAULTS[name]
+    product_config = getattr(getConfiguration(), 'product_config', None) or {}
+    value = product_config.get(PROJECTNAME, {}).get(name)
+    if value is None:
+        return default
+    if isinstance(default, bool):
+        return value.lower() in ('on', 'true', 'yes', '1')
+    if isinstance(default, int):
+        return int(value)
+    return value
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Events by day, kept up to date by content event subscribers.
+
+The index maps every day ordinal (``date.toordinal()``) to the UIDs of the
+events happening that day, so the events of a month are found with a
+BTree lookup per day instead of a range search on the start and end
+indexes. Filtering by path, review state and the like is left to the
+catalog, restricted to those UIDs.
+
+The index is only used once it has been built, either when the package is
+installed or by the ``@@calendar-rebuild-dayindex`` view on existing
+sites.
+"""
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree
+from BTrees.OOBTree import OOTreeSet
+from Products.CMFCore.utils import getToolByName
+from collective.portlet.calendar.utils import event_days
+from collective.portlet.calendar.utils import is_event
+from collective.portlet.calendar.utils import month_days
+from datetime import date
+from persistent import Persistent
+from plone.uuid.interfaces import IUUID
+from zope.annotation.interfaces import IAnnotations
+from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+
+ANNOTATION_KEY = 'collective.portlet.calendar.dayindex'
+
+
+class DayIndex(Persistent):
+    """Event UIDs by day ordinal"""
+
+    built = False
+
+    def __init__(self):
+        # day ordinal -> OOTreeSet of UIDs
+        self._days = IOBTree()
+        # UID -> (first day ordinal, last day ordinal)
+        self._spans = OOBTree()
+
+    def __len__(self):
+        return len(self._spans)
+
+    def clear(self):
+        self._days.clear()
+        self._spans.clear()
+
+    def index_event(self, uid, span):
+        if self._spans.get(uid) == span:
+            return
+        self.unindex_event(uid)
+        if span is None:
+            return
+        first, last = span
+        for ordinal in range(first, last + 1):
+            uids = self._days.get(ordinal)
+            if uids is None:
+                uids = self._days[ordinal] = OOTreeSet()
+            uids.insert(uid)
+        self._spans[uid] = span
+
+    def unindex_event(self, uid):
+        span = self._spans.get(uid)
+        if span is None:
+            return
+        first, last = span
+        for ordinal in range(first, last + 1):
+            uids = self._days.get(ordinal)
+            if uids is None:
+                continue
+            if uid in uids:
+                uids.remove(uid)
+            if not uids:
+                del self._days[ordinal]
+        del self._spans[uid]
+
+    def uids(self, ordinal):
+        return self._days.get(ordinal, ())
+
+    def month(self, year, month):
+        """UIDs of the events of a month"""
+        first = date(year, month, 1).toordinal()
+        last = first + month_days(year, month) - 1
+        result = set()
+        for ordinal in range(first, last + 1):
+            result.update(self.uids(ordinal))
+        return result
+
+
+def get_dayindex(context):
+    """The day index of the site, or None when it has not been built yet"""
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    dayindex = IAnnotations(portal).get(ANNOTATION_KEY)
+    if dayindex is None or not dayindex.built:
+        return None
+    return dayindex
+
+
+def _dayindex(context):
+    portal_url = getToolByName(context, 'portal_url', None)
+    if portal_url is None:
+        return None
+    annotations = IAnnotations(portal_url.getPortalObject())
+    dayindex = annotations.get(ANNOTATION_KEY)
+    if dayindex is None:
+        dayindex = annotations[ANNOTATION_KEY] = DayIndex()
+    return dayindex
+
+
+def rebuild(context):
+    """Index all events found in the catalog, return their number"""
+    dayindex = _dayindex(context)
+    dayindex.clear()
+    catalog = getToolByName(context, 'portal_catalog')
+    calendar = getToolByName(context, 'portal_calendar')
+    brains = catalog.unrestrictedSearchResults(
+        portal_type=calendar.getCalendarTypes())
+    for brain in brains:
+        # metadata is enough, objects are not loaded
+        if brain.UID:
+            dayindex.index_event(brain.UID, event_days(brain))
+    dayindex.built = True
+    return len(dayindex)
+
+
+def content_changed(obj, event):
+    """Subscriber for content added, modified, moved, removed or
+    transitioned
+    """
+    if not is_event(obj):
+        return
+    uid = IUUID(obj, None)
+    if uid is None:
+        return
+    dayindex = _dayindex(obj)
+    if dayindex is None:
+        return
+    if IObjectRemovedEvent.providedBy(event):
+        dayindex.unindex_event(uid)
+    else:
+        dayindex.index_event(uid, event_days(obj))
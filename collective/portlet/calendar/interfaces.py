@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from zope.interface import Interface
+
+
+class IRenderCacheBackend(Interface):
+    """Storage of rendered calendars, registered as a named utility and
+    chosen with the ``cache-backend`` setting
+    """
+
+    def get(key):
+        """(freshness, html, stale since) stored for key, or None"""
+
+    def set(key, freshness, html, stale_since=None, assignment=None):
+        """Store the HTML of a calendar, rendered for freshness.
+
+        stale_since is the time the entry was first found stale, assignment
+        identifies the portlet assignment for statistics.
+        """
+
+    def count(assignment, name):
+        """Count a 'hits' or 'misses' for an assignment"""
+
+    def occupancy():
+        """Mapping with the entries, bytes, max_entries and max_bytes of the
+        storage and the statistics by assignment
+        """
+
+    def clear():
+        """Forget all entries and statistics"""
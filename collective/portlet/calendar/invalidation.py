@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Invalidation counters for rendered calendars.
+
+Event subscribers bump persistent counters stored on the site whenever
+event-like content changes, so the portlet cache key never has to look at
+the events themselves.
+
+Counters are kept per month: a change only invalidates the months the
+event overlaps, before and after the change. The span last seen for every
+event is recorded for this purpose; when it is unknown (e.g. events created
+before this package was installed) the site wide counter is bumped instead.
+"""
+from BTrees.Length import Length
+from BTrees.OOBTree import OOBTree
+from Products.CMFCore.utils import getToolByName
+from collective.portlet.calendar.recurrence import event_rule
+from collective.portlet.calendar.recurrence import last_occurrence
+from collective.portlet.calendar.utils import event_days
+from collective.portlet.calendar.utils import is_event
+from datetime import date
+from persistent import Persistent
+from plone.uuid.interfaces import IUUID
+from zope.annotation.interfaces import IAnnotations
+from zope.lifecycleevent.interfaces import IObjectAddedEvent
+from zope.lifecycleevent.interfaces import IObjectRemovedEvent
+
+ANNOTATION_KEY = 'collective.portlet.calendar.generations'
+
+
+class Generations(Persistent):
+    """Invalidation counters of a site"""
+
+    def __init__(self):
+        # bumped when the months touched by a change are unknown
+        self.site = Length()
+        # (year, month) -> Length
+        self.months = OOBTree()
+        # event UID -> ((year, month), (year, month)), first and last month
+        self.spans = OOBTree()
+
+    def get(self, year, month):
+        counter = self.months.get((year, month))
+        return (self.site(), counter is None and 0 or counter())
+
+    def invalidate(self, uid, span, removed=False, added=False):
+        """Bump the counters of the months in span and of the ones last
+        recorded for uid
+        """
+        old_span = self.spans.get(uid) if uid else None
+        if old_span is None and not added:
+            # Length resolves write conflicts, concurrent edits do not fail
+            self.site.change(1)
+        months = set(iter_months(span))
+        months.update(iter_months(old_span))
+        for key in months:
+            counter = self.months.get(key)
+            if counter is None:
+                counter = self.months[key] = Length()
+            counter.change(1)
+        if uid:
+            if removed:
+                if old_span is not None:
+                    del self.spans[uid]
+            elif span is not None and span != old_span:
+                self.spans[uid] = span
+
+
+def iter_months(span):
+    """All (year, month) pairs from the first to the last month of span"""
+    if span is None:
+        return
+    (year, month), last = span
+    while (year, month) <= last:
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def event_span(obj):
+    """First and last month of an event, or None. Recurring events span
+    up to their last occurrence, endless ones are None.
+    """
+    days = event_days(obj)
+    if days is None:
+        return None
+    first, last = days
+    rule = event_rule(obj)
+    if rule is not None:
+        last_start = last_occurrence(rule, first)
+        if last_start is None:
+            return None
+        last += last_start - first
+    first, last = date.fromordinal(first), date.fromordinal(last)
+    return (first.year, first.month), (last.year, last.month)
+
+
+def _portal(context):
+    portal_url = getToolByName(context, 'portal_url', None)
+    if portal_url is None:
+        return None
+    return portal_url.getPortalObject()
+
+
+def get_generation(context, year, month):
+    """Current invalidation counters for a month"""
+    generations = IAnnotations(_portal(context)).get(ANNOTATION_KEY)
+    if generations is None:
+        return (0, 0)
+    return generations.get(year, month)
+
+
+def _generations(context):
+    portal = _portal(context)
+    if portal is None:
+        return None
+    annotations = IAnnotations(portal)
+    generations = annotations.get(ANNOTATION_KEY)
+    if generations is None:
+        generations = annotations[ANNOTATION_KEY] = Generations()
+    return generations
+
+
+def bump_generation(context):
+    """Invalidate every rendered calendar of the site"""
+    generations = _generations(context)
+    if generations is not None:
+        generations.site.change(1)
+
+
+def local_roles_changed(obj, event):
+    """Subscriber for sharing changes, which may show or hide the events of
+    a whole folder
+    """
+    bump_generation(obj)
+
+
+def content_changed(obj, event):
+    """Subscriber for content added, modified, moved, removed or
+    transitioned
+    """
+    if not is_event(obj):
+        return
+    generations = _generations(obj)
+    if generations is None:
+        return
+    span = event_span(obj)
+    if span is None and event_rule(obj) is not None:
+        # endless recurring events are in all the months to come
+        generations.site.change(1)
+    generations.invalidate(IUUID(obj, None), span,
+                           removed=IObjectRemovedEvent.providedBy(event),
+                           added=IObjectAddedEvent.providedBy(event))
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Events overlapping a period, found with a DateRangeIndex.
+
+Searching ``start <= last AND end >= first`` on the start and end indexes
+intersects two open ended range searches: every event that ever started
+before the end of the period, and every event ending after its beginning.
+The ``event_range`` DateRangeIndex of the profile (over ``start`` and
+``end``) finds the events running at a given moment in a single lookup, so
+the events overlapping a period are the ones running when it begins and
+the ones starting during it, a range search bounded by the period.
+
+The index is used once it is in the catalog, it is filled when the package
+is installed. It is an EventRangeIndex, which leaves out the content having
+neither start nor end: a DateRangeIndex takes it as always running, and
+would find the pages and folders of the whole site with every event.
+
+Like in the day index, events without end are indexed as ending when they
+start: the DateRangeIndex would take them as running forever otherwise.
+Without the index, they are found from their start too.
+"""
+from App.special_dtml import DTMLFile
+from Products.CMFCore.interfaces import IContentish
+from Products.CMFCore.utils import getToolByName
+from Products.PluginIndexes.DateRangeIndex.DateRangeIndex import \
+    DateRangeIndex
+from Products.PluginIndexes.DateRangeIndex.DateRangeIndex import _dtmldir
+from plone.indexer import indexer
+
+RANGE_INDEX = 'event_range'
+
+
+def has_range_index(catalog):
+    return RANGE_INDEX in catalog.indexes()
+
+
+def _date(obj, name):
+    value = getattr(obj, name, None)
+    if callable(value):
+        value = value()
+    return value or None
+
+
+@indexer(IContentish)
+def event_end(obj):
+    """End of an event for the range index, its start when it has none"""
+    end = _date(obj, 'end') or _date(obj, 'start')
+    if end is None:
+        raise AttributeError('end')
+    return end
+
+
+class EventRangeIndex(DateRangeIndex):
+    """DateRangeIndex of the content having a start or an end only"""
+
+    meta_type = 'EventRangeIndex'
+
+    def index_object(self, documentId, obj, threshold=None):
+        if _date(obj, self._since_field) is None and \
+                _date(obj, self._until_field) is None:
+            # not an event, or no longer one
+            self.unindex_object(documentId)
+            return 0
+        return DateRangeIndex.index_object(self, documentId, obj, threshold)
+
+
+manage_addEventRangeIndexForm = DTMLFile('addDateRangeIndex', _dtmldir)
+
+
+def manage_addEventRangeIndex(self, id, extra=None, REQUEST=None,
+                              RESPONSE=None, URL3=None):
+    """Add an event range index"""
+    return self.manage_addIndex(id, EventRangeIndex.meta_type, extra,
+                                REQUEST, RESPONSE, URL3)
+
+
+class _Dates(object):
+    """Start and end of a catalog brain, as indexed by the range index"""
+
+    def __init__(self, brain):
+        self.start = brain.start
+        self.event_end = brain.end or brain.start
+
+
+def index_events(portal):
+    """Fill the range index with the events of the site, return their
+    number
+    """
+    catalog = getToolByName(portal, 'portal_catalog')
+    calendar = getToolByName(portal, 'portal_calendar')
+    index = catalog._catalog.getIndex(RANGE_INDEX)
+    index.clear()
+    brains = catalog.unrestrictedSearchResults(
+        portal_type=calendar.getCalendarTypes())
+    for brain in brains:
+        # start and end metadata are enough, objects are not loaded
+        index.index_object(brain.getRID(), _Dates(brain))
+    return len(brains)
+
+
+def overlapping(catalog, query, first_date, last_date):
+    """Lazy results of query for the events overlapping first_date to
+    last_date, in start order once concatenated. Events starting exactly
+    at first_date are in both.
+
+    Queries with their own start or end criteria are searched on the start
+    and end indexes at once, so events without end are not found by them.
+    Catalogs without the range index find the running events on the start
+    and end indexes.
+    """
+    if 'start' in query or 'end' in query:
+        query = dict(query)
+        # collections may have their own start or end criteria
+        query.setdefault('start', {'query': last_date, 'range': 'max'})
+        query.setdefault('end', {'query': first_date, 'range': 'min'})
+        return [catalog(**query)]
+    if has_range_index(catalog):
+        running = dict(query)
+        running[RANGE_INDEX] = first_date
+    else:
+        running = dict(query, start={'query': first_date, 'range': 'max'},
+                       end={'query': first_date, 'range': 'min'})
+    starting = dict(query, start={'query': (first_date, last_date),
+                                  'range': 'min:max'})
+    return [catalog(**running), catalog(**starting)]
+
+
+def merge(results):
+    """Brains of the lazy results of overlapping, each one once"""
+    if len(results) == 1:
+        return list(results[0])
+    brains = []
+    seen = set()
+    for result in results:
+        for brain in result:
+            rid = brain.getRID()
+            if rid not in seen:
+                seen.add(rid)
+                brains.append(brain)
+    return brains
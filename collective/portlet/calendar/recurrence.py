@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""Occurrences of recurring events, for the days displayed only.
+
+Events may have a ``recurrence`` attribute holding iCalendar recurrence
+rules, as stored by plone.app.event::
+
+    RRULE:FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE;UNTIL=20191231
+    EXDATE:20190610T100000
+
+The start and end indexes only know the first occurrence of an event.
+Recurring events are indexed by ``is_recurring`` and their rule is catalog
+metadata, so the occurrences of the displayed months are generated from
+the brains: daily and weekly rules jump straight to the first displayed
+day, and an event repeated every day for years costs the days of the
+month.
+
+Supported: FREQ (DAILY, WEEKLY, MONTHLY, YEARLY), INTERVAL, COUNT, UNTIL,
+BYDAY (weekly and monthly rules), WKST and EXDATE. Events with other rules
+show their first occurrence only.
+"""
+import re
+
+from Acquisition import aq_base
+from Products.CMFCore.interfaces import IContentish
+from Products.CMFCore.utils import getToolByName
+from collective.portlet.calendar.utils import _day
+from collective.portlet.calendar.utils import month_days
+from datetime import date
+from plone.indexer import indexer
+from plone.memoize import ram
+
+RECURRING_INDEX = 'is_recurring'
+WEEKDAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+# rule parts supported besides INTERVAL, COUNT and UNTIL
+FREQUENCIES = {'DAILY': (),
+               'WEEKLY': ('BYDAY', 'WKST'),
+               'MONTHLY': ('BYDAY',),
+               'YEARLY': ()}
+BYDAY = re.compile(r'([+-]?\d{1,2})?(MO|TU|WE|TH|FR|SA|SU)$')
+DATE = re.compile(r'(\d{4})(\d{2})(\d{2})')
+
+
+def has_recurring_index(catalog):
+    return RECURRING_INDEX in catalog.indexes()
+
+
+def _recurrence(obj):
+    rule = getattr(aq_base(obj), 'recurrence', None)
+    if callable(rule):
+        rule = rule()
+    return rule or None
+
+
+@indexer(IContentish)
+def is_recurring(obj):
+    """Only recurring content is in the is_recurring index"""
+    if _recurrence(obj) is None:
+        raise AttributeError('recurrence')
+    return True
+
+
+def event_rule(obj):
+    """Recurrence rule of an event, see parse_rule"""
+    return parse_rule(_recurrence(obj))
+
+
+def _parse_date(value):
+    match = DATE.match(value.strip())
+    if match is None:
+        raise ValueError(value)
+    return date(*[int(part) for part in match.groups()]).toordinal()
+
+
+def parse_rule(text):
+    """Recurrence rule as a mapping, with UNTIL and EXDATE as day ordinals,
+    or None when there is none or when it is not supported
+    """
+    if not text:
+        return None
+    parts = None
+    exdates = set()
+    try:
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if ':' in line:
+                name, value = line.split(':', 1)
+                name = name.split(';')[0].upper()
+            else:
+                name, value = 'RRULE', line
+            if name == 'RRULE' and parts is None:
+                parts = dict([(part.split('=', 1) + [''])[:2]
+                              for part in value.upper().split(';') if part])
+            elif name == 'EXDATE':
+                exdates.update([_parse_date(v) for v in value.split(',')])
+            else:
+                # RDATE, several rules
+                return None
+        if parts is None:
+            return None
+        frequency = parts.pop('FREQ', None)
+        if frequency not in FREQUENCIES:
+            return None
+        for name in parts:
+            if name not in ('INTERVAL', 'COUNT', 'UNTIL') + \
+                    FREQUENCIES[frequency]:
+                return None
+        rule = {'freq': frequency,
+                'interval': int(parts.pop('INTERVAL', None) or 1),
+                'count': None,
+                'until': None,
+                'byday': [],
+                'wkst': WEEKDAYS.index(parts.pop('WKST', None) or 'MO'),
+                'exdates': exdates}
+        if 'COUNT' in parts:
+            rule['count'] = int(parts.pop('COUNT'))
+        if 'UNTIL' in parts:
+            rule['until'] = _parse_date(parts.pop('UNTIL'))
+        for value in parts.pop('BYDAY', '').split(','):
+            if not value:
+                continue
+            match = BYDAY.match(value)
+            if match is None:
+                return None
+            rule['byday'].append((int(match.group(1) or 0),
+                                  WEEKDAYS.index(match.group(2))))
+    except ValueError:
+        return None
+    if rule['interval'] < 1 or frequency != 'MONTHLY' and \
+            [n for n, weekday in rule['byday'] if n]:
+        # BYDAY=2TU is for monthly rules only
+        return None
+    return rule
+
+
+def _daily(rule, start, first, last):
+    interval = rule['interval']
+    # the occurrences before the first day are skipped at once
+    index = max(0, -((start - first) // interval))
+    while True:
+        yield index, start + index * interval
+        index += 1
+
+
+def _weekly(rule, start, first, last):
+    interval = rule['interval']
+    weekdays = [weekday for n, weekday in rule['byday']] or \
+        [date.fromordinal(start).weekday()]
+    offsets = sorted(set([(weekday - rule['wkst']) % 7
+                          for weekday in weekdays]))
+    first_week = start - (date.fromordinal(start).weekday() -
+                          rule['wkst']) % 7
+    # occurrences of the first week, which may start before the event
+    in_first_week = len([o for o in offsets if first_week + o >= start])
+    week = max(0, (first - first_week) // (7 * interval))
+    while True:
+        week_start = first_week + 7 * interval * week
+        index = week and in_first_week + (week - 1) * len(offsets) or 0
+        for offset in offsets:
+            if week_start + offset >= start:
+                yield index, week_start + offset
+                index += 1
+        week += 1
+
+
+def _month_days(rule, year, month, start_day):
+    """Day numbers of the occurrences of a monthly rule in a month"""
+    length = month_days(year, month)
+    if not rule['byday']:
+        return start_day <= length and [start_day] or []
+    first_weekday = date(year, month, 1).weekday()
+    days = set()
+    for n, weekday in rule['byday']:
+        matching = range((weekday - first_weekday) % 7 + 1, length + 1, 7)
+        if not n:
+            days.update(matching)
+        elif -len(matching) <= n <= len(matching):
+            days.add(matching[n - 1 if n > 0 else n])
+    return sorted(days)
+
+
+def _monthly(rule, start, first, last):
+    interval = rule['interval']
+    start_date = date.fromordinal(start)
+    period = 0
+    if rule['count'] is None:
+        # occurrences are not counted, the months before are skipped
+        first_date = date.fromordinal(first)
+        months = (first_date.year - start_date.year) * 12 + \
+            first_date.month - start_date.month
+        period = max(0, months // interval)
+    index = 0
+    while True:
+        months = start_date.month - 1 + period * interval
+        year, month = start_date.year + months // 12, months % 12 + 1
+        if date(year, month, 1).toordinal() > last:
+            return
+        for day in _month_days(rule, year, month, start_date.day):
+            ordinal = date(year, month, day).toordinal()
+            if ordinal >= start:
+                yield index, ordinal
+                index += 1
+        period += 1
+
+
+def _yearly(rule, start, first, last):
+    interval = rule['interval']
+    start_date = date.fromordinal(start)
+    period = 0
+    if rule['count'] is None:
+        period = max(0, (date.fromordinal(first).year - start_date.year) //
+                     interval)
+    index = 0
+    while True:
+        year = start_date.year + period * interval
+        if date(year, 1, 1).toordinal() > last:
+            return
+        if start_date.day <= month_days(year, start_date.month):
+            # February 29th only on leap years
+            yield index, date(year, start_date.month,
+                              start_date.day).toordinal()
+            index += 1
+        period += 1
+
+
+SERIES = {'DAILY': _daily,
+          'WEEKLY': _weekly,
+          'MONTHLY': _monthly,
+          'YEARLY': _yearly}
+
+
+def occurrences(rule, start, first, last):
+    """Day ordinals of the occurrences of rule (see parse_rule) between the
+    day ordinals first and last, generated in order, the first occurrence
+    being on day ordinal start
+    """
+    if rule['until'] is not None:
+        last = min(last, rule['until'])
+    count = rule['count']
+    for index, day in SERIES[rule['freq']](rule, start, first, last):
+        if day > last or (count is not None and index >= count):
+            return
+        if day >= first and day not in rule['exdates']:
+            yield day
+
+
+def last_occurrence(rule, start):
+    """Day ordinal of the last occurrence of rule, None when it is endless
+    """
+    if rule['until'] is not None:
+        return max(start, rule['until'])
+    if rule['count'] is None:
+        return None
+    last = start
+    try:
+        for last in occurrences(rule, start, start, date.max.toordinal()):
+            pass
+    except ValueError:
+        # no occurrence left before year 9999
+        return None
+    return last
+
+
+def _occurrence_days_cachekey(fun, brain, first, last):
+    return brain.UID or brain.getPath(), str(brain.modified), first, last
+
+
+@ram.cache(_occurrence_days_cachekey)
+def occurrence_days(brain, first, last):
+    """Day ordinals of the occurrences of a recurring event (a catalog
+    brain) starting between first and last, computed once per
+    modification of the event
+    """
+    start = _day(brain.start)
+    rule = parse_rule(brain.recurrence)
+    if rule is None:
+        return first <= start <= last and (start,) or ()
+    return tuple(occurrences(rule, start, first, last))
+
+
+def recurring(catalog, query, last_date):
+    """Results of query for the recurring events starting before last_date,
+    none for queries with their own start or end criteria. The catalog is
+    to have the is_recurring index.
+    """
+    if 'start' in query or 'end' in query:
+        return []
+    return catalog(**dict(query, is_recurring=True,
+                          start={'query': last_date, 'range': 'max'}))
+
+
+def index_recurring(portal):
+    """Catalog the recurring events of the site again, so they are in the
+    is_recurring index and have their rule as metadata, return their number
+    """
+    catalog = getToolByName(portal, 'portal_catalog')
+    calendar = getToolByName(portal, 'portal_calendar')
+    count = 0
+    for brain in catalog.unrestrictedSearchResults(
+            portal_type=calendar.getCalendarTypes()):
+        obj = brain._unrestrictedGetObject()
+        if _recurrence(obj) is not None:
+            catalog.catalog_object(obj, brain.getPath(),
+                                   idxs=[RECURRING_INDEX])
+            count += 1
+    return count
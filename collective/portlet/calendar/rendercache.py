@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+"""Cache of rendered calendar portlets.
+
+The last HTML rendered for a calendar is kept together with the
+invalidation state it was rendered for, in a cache bounded by number of
+entries and by size (see the ``cache-max-entries`` and ``cache-max-bytes``
+settings).
+
+With the ``max-stale`` setting, once that state changes the old HTML is
+still served for up to that many seconds while a single background thread
+renders the calendar again in its own ZODB connection, so visitors never
+wait for the template after an event edit or at month rollover.
+
+Only portlets rendered by a portlet manager can be refreshed in the
+background, as the portlet hash is needed to find the assignment again.
+Other calendars are rendered at once when they are stale.
+"""
+import logging
+import sys
+import threading
+import time
+import transaction
+from AccessControl import getSecurityManager
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from AccessControl.SpecialUsers import nobody
+from Acquisition import aq_inner
+from Acquisition import aq_parent
+from Products.Five.browser import BrowserView
+from Queue import Queue
+from Testing.makerequest import makerequest
+from collective.portlet.calendar.config import get_setting
+from collective.portlet.calendar.interfaces import IRenderCacheBackend
+from collective.portlet.calendar.utils import renderer_from_hash
+from plone.memoize import ram
+from zope.interface import directlyProvidedBy
+from zope.interface import directlyProvides
+from zope.interface import implements
+from zope.component import queryUtility
+from zope.component.hooks import setSite
+
+logger = logging.getLogger('collective.portlet.calendar')
+
+# environment copied to the requests of background renderings
+ENVIRON_KEYS = ('SERVER_NAME', 'SERVER_PORT', 'HTTP_HOST', 'HTTPS',
+                'SERVER_URL', 'HTTP_ACCEPT_LANGUAGE', 'HTTP_X_FORWARDED_HOST',
+                'wsgi.url_scheme')
+
+# fields of the links of the LRU list
+PREV, NEXT, KEY, VALUE, SIZE, ASSIGNMENT = range(6)
+
+
+class RenderCache(object):
+    """Rendered calendars by identity: (freshness, html, stale since)
+
+    The cache is bounded by number of entries and by size in bytes, the
+    least recently used entries are dropped first. Hits, misses and
+    evictions are counted by portlet assignment.
+    """
+    implements(IRenderCacheBackend)
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            # sentinel of a circular doubly linked list, oldest link first
+            self._root = root = []
+            root[:] = [root, root, None, None, 0, None]
+            self.bytes = 0
+            # assignment -> {'hits': int, 'misses': int, 'evictions': int}
+            self.stats = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def limits(self):
+        max_entries, max_bytes = self._max_entries, self._max_bytes
+        if max_entries is None:
+            max_entries = get_setting('cache-max-entries')
+        if max_bytes is None:
+            max_bytes = get_setting('cache-max-bytes')
+        return max_entries, max_bytes
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _append(self, link):
+        last = self._root[PREV]
+        link[PREV], link[NEXT] = last, self._root
+        last[NEXT] = self._root[PREV] = link
+
+    def _stats(self, assignment):
+        stats = self.stats.get(assignment)
+        if stats is None:
+            stats = self.stats[assignment] = dict(hits=0, misses=0,
+                                                  evictions=0)
+        return stats
+
+    def count(self, assignment, name):
+        """Count a hit or a miss"""
+        with self._lock:
+            self._stats(assignment)[name] += 1
+
+    def get(self, key):
+        with self._lock:
+            link = self._entries.get(key)
+            if link is None:
+                return None
+            self._unlink(link)
+            self._append(link)
+            return link[VALUE]
+
+    def set(self, key, freshness, html, stale_since=None, assignment=None,
+            size=None):
+        if size is None:
+            size = sys.getsizeof(html)
+        size += sys.getsizeof(key)
+        with self._lock:
+            link = self._entries.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+                self.bytes -= link[SIZE]
+                if assignment is None:
+                    assignment = link[ASSIGNMENT]
+            link = [None, None, key, (freshness, html, stale_since), size,
+                    assignment]
+            self._entries[key] = link
+            self._append(link)
+            self.bytes += size
+            max_entries, max_bytes = self.limits()
+            while self._entries and (len(self._entries) > max_entries or
+                                     self.bytes > max_bytes):
+                oldest = self._root[NEXT]
+                self._unlink(oldest)
+                del self._entries[oldest[KEY]]
+                self.bytes -= oldest[SIZE]
+                self._stats(oldest[ASSIGNMENT])['evictions'] += 1
+
+    def occupancy(self):
+        """Size of the cache and statistics by assignment"""
+        with self._lock:
+            assignments = {}
+            for assignment, stats in self.stats.items():
+                assignments[assignment] = dict(stats, entries=0, bytes=0)
+            for link in self._entries.values():
+                stats = assignments.setdefault(
+                    link[ASSIGNMENT],
+                    dict(hits=0, misses=0, evictions=0, entries=0, bytes=0))
+                stats['entries'] += 1
+                stats['bytes'] += link[SIZE]
+            max_entries, max_bytes = self.limits()
+            return dict(entries=len(self._entries), bytes=self.bytes,
+                        max_entries=max_entries, max_bytes=max_bytes,
+                        assignments=assignments)
+
+
+def assignment_id(renderer):
+    """Readable identifier of the portlet assignment of a renderer"""
+    metadata = getattr(renderer, '__portlet_metadata__', None) or {}
+    if metadata.get('name'):
+        return '%s [%s] %s' % (metadata.get('key'), metadata.get('manager'),
+                               metadata['name'])
+    return getattr(renderer.data, '__name__', None) or '-'
+
+
+class Refresher(object):
+    """Single background thread running refresh jobs, at most one per key"""
+
+    def __init__(self):
+        self._queue = Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def schedule(self, key, job):
+        """Run job in the background unless one is pending for key"""
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+            if self._thread is None or not self._thread.isAlive():
+                self._thread = threading.Thread(
+                    target=self._run, name='calendar-refresher')
+                self._thread.setDaemon(True)
+                self._thread.start()
+        self._queue.put((key, job))
+        return True
+
+    def pending(self):
+        return len(self._pending)
+
+    def _run(self):
+        while True:
+            key, job = self._queue.get()
+            try:
+                job()
+            except Exception:
+                logger.exception('Cannot refresh calendar %r', key)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+
+class _Flight(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = True
+
+
+class SingleFlight(object):
+    """Run a function once for concurrent callers asking for the same key
+
+    The first caller runs it, the others wait for its result. Callers that
+    time out waiting, or whose leader failed, run the function themselves.
+    """
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        # callers served the result of another thread
+        self.coalesced = 0
+        # callers that gave up waiting
+        self.timeouts = 0
+
+    def do(self, key, fun, timeout):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if leader:
+            try:
+                flight.result = fun()
+                flight.failed = False
+                return flight.result
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        flight.done.wait(timeout)
+        with self._lock:
+            if flight.done.isSet() and not flight.failed:
+                self.coalesced += 1
+                return flight.result
+            self.timeouts += 1
+        return fun()
+
+
+store = RenderCache()
+# events of months by day, see calendar._month_events
+months = RenderCache()
+refresher = Refresher()
+flights = SingleFlight()
+
+
+def backend():
+    """The render cache backend chosen by the ``cache-backend`` setting"""
+    return queryUtility(IRenderCacheBackend,
+                        name=get_setting('cache-backend')) or store
+
+
+def render_once(key, renderer):
+    """Render a calendar missing from the cache, once for concurrent
+    requests of the same key
+    """
+    return flights.do(key, renderer._render,
+                      get_setting('single-flight-timeout'))
+
+
+class RefreshJob(object):
+    """Render a calendar again, in a connection of its own, as the user of
+    the request that found it stale or as anonymous
+
+    Another month than the one of the renderer may be given.
+    """
+
+    def __init__(self, renderer, identity, freshness, year=None, month=None,
+                 anonymous=False):
+        context = aq_inner(renderer.context)
+        request = renderer.request
+        self.db = context._p_jar.db()
+        self.path = context.getPhysicalPath()
+        self.portlethash = renderer.__portlet_metadata__['hash']
+        self.identity = identity
+        self.freshness = freshness
+        self.year = year or renderer.year
+        self.month = month or renderer.month
+        self.environ = dict([(k, request.environ[k]) for k in ENVIRON_KEYS
+                             if k in request.environ])
+        self.other = dict([(k, request.other[k])
+                           for k in ('SERVER_URL', 'VirtualRootPhysicalPath',
+                                     'LANGUAGE')
+                           if k in request.other])
+        self.script = list(getattr(request, '_script', ()))
+        self.layers = directlyProvidedBy(request)
+        user = getSecurityManager().getUser()
+        acl_users = aq_parent(aq_inner(user))
+        self.userid = None if anonymous else user.getId()
+        self.acl_path = None
+        if self.userid is not None and acl_users is not None:
+            self.acl_path = acl_users.getPhysicalPath()
+
+    def _setup_request(self, request):
+        request._script = list(self.script)
+        request.other.update(self.other)
+        directlyProvides(request, self.layers)
+        if hasattr(request, 'setupLocale'):
+            request.setupLocale()
+        request.form.update({'year': str(self.year),
+                             'month': str(self.month)})
+
+    def _login(self, app, request):
+        user = None
+        if self.acl_path is not None:
+            acl_users = app.unrestrictedTraverse(self.acl_path)
+            user = acl_users.getUserById(self.userid)
+            if user is not None and not hasattr(user, 'aq_base'):
+                user = user.__of__(acl_users)
+        newSecurityManager(request, user or nobody)
+
+    def __call__(self):
+        """Render the calendar unless it is cached already, tell whether
+        it was rendered
+        """
+        connection = self.db.open()
+        try:
+            environ = dict(self.environ, REQUEST_METHOD='GET')
+            app = makerequest(connection.root()['Application'],
+                              environ=environ)
+            request = app.REQUEST
+            self._setup_request(request)
+            context = app.unrestrictedTraverse(self.path)
+            self._login(app, request)
+            setSite(context)
+            renderer = renderer_from_hash(BrowserView(context, request),
+                                          self.portlethash)
+            renderer.update()
+            key = self.identity(renderer)
+            current = self.freshness(renderer)
+            cache = backend()
+            entry = cache.get(key)
+            if entry is not None and entry[0] == current:
+                return False
+            cache.set(key, current, renderer._render(),
+                      assignment=assignment_id(renderer))
+            return True
+        finally:
+            transaction.abort()
+            noSecurityManager()
+            setSite(None)
+            connection.close()
+
+
+def _refresh_job(renderer, identity, freshness):
+    metadata = getattr(renderer, '__portlet_metadata__', None) or {}
+    context = aq_inner(renderer.context)
+    if not metadata.get('hash') or getattr(context, '_p_jar', None) is None:
+        return None
+    return RefreshJob(renderer, identity, freshness)
+
+
+def render(renderer, identity, freshness):
+    """HTML of a calendar portlet, from the cache when possible
+
+    identity and freshness are functions of the renderer: the first tells
+    what is rendered, the second the invalidation state it is rendered for.
+    With the ``max-stale`` setting, stale HTML may be served while it is
+    refreshed in the background.
+    """
+    try:
+        key = identity(renderer)
+    except ram.DontCache:
+        return renderer._render()
+    assignment = assignment_id(renderer)
+    current = freshness(renderer)
+    cache = backend()
+    entry = cache.get(key)
+    if entry is not None:
+        rendered_for, html, stale_since = entry
+        if rendered_for == current:
+            cache.count(assignment, 'hits')
+            return html
+        max_stale = get_setting('max-stale')
+        if max_stale:
+            now = time.time()
+            if stale_since is None:
+                stale_since = now
+                cache.set(key, rendered_for, html, stale_since, assignment)
+            job = None
+            if now - stale_since <= max_stale:
+                job = _refresh_job(renderer, identity, freshness)
+            if job is not None:
+                refresher.schedule(key, job)
+                cache.count(assignment, 'hits')
+                return html
+    cache.count(assignment, 'misses')
+    html = render_once((key, current), renderer)
+    cache.set(key, current, html, assignment=assignment)
+    return html
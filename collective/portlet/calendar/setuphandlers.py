@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from collective.portlet.calendar.dayindex import rebuild
+from collective.portlet.calendar.rangeindex import index_events
+from collective.portlet.calendar.recurrence import index_recurring
+
+logger = logging.getLogger('collective.portlet.calendar')
+
+
+def setupDayIndex(context):
+    if context.readDataFile('collective.portlet.calendar-dayindex.txt') is None:
+        return
+    count = rebuild(context.getSite())
+    logger.info('Day index built: %d events' % count)
+
+
+def setupRangeIndex(context):
+    if context.readDataFile('collective.portlet.calendar-rangeindex.txt') is None:
+        return
+    count = index_events(context.getSite())
+    logger.info('Event range index filled: %d events' % count)
+
+
+def setupRecurringIndex(context):
+    if context.readDataFile('collective.portlet.calendar-recurrence.txt') is None:
+        return
+    count = index_recurring(context.getSite())
+    logger.info('Recurring events cataloged: %d events' % count)
@@ -1,8 +1,22 @@
 # -*- coding: utf-8 -*-
+from App.config import getConfiguration
+from DateTime import DateTime
+from OFS.Traversable import Traversable
+from Products.ZCatalog.Catalog import Catalog
+from Products.ZCatalog.CatalogBrains import AbstractCatalogBrain
+from collective.portlet.calendar import calendar
+from collective.portlet.calendar.config import PROJECTNAME
+from contextlib import contextmanager
 from plone.app.testing import PloneSandboxLayer
 from plone.app.testing import PLONE_FIXTURE
 from plone.app.testing import IntegrationTesting
 from plone.app.testing import FunctionalTesting
+from plone.portlets.interfaces import IPortletManager
+from plone.portlets.interfaces import IPortletRenderer
+from plone.testing import z2
+from zope.annotation.interfaces import IAnnotations
+from zope.component import getMultiAdapter
+from zope.component import getUtility
 
 
 class Fixture(PloneSandboxLayer):
@@ -13,6 +27,7 @@ class Fixture(PloneSandboxLayer):
         # Load ZCML
         import collective.portlet.calendar
         self.loadZCML(package=collective.portlet.calendar)
+        z2.installProduct(app, 'collective.portlet.calendar')
 
     def setUpPloneSite(self, portal):
         # Install into Plone site using portal_setup
@@ -28,3 +43,86 @@ FUNCTIONAL_TESTING = FunctionalTesting(
     bases=(FIXTURE,),
     name='collective.portlet.calendar:Functional',
 )
+
+
+@contextmanager
+def product_config(settings):
+    """Use other product-config settings, e.g. {'esi': 'on'}"""
+    config = getConfiguration()
+    saved = getattr(config, 'product_config', None)
+    product_configs = dict(saved or {})
+    product_configs[PROJECTNAME] = settings
+    config.product_config = product_configs
+    try:
+        yield
+    finally:
+        config.product_config = saved
+
+
+def calendar_renderer(portal, assignment=None, view=None, new_request=True,
+                      update=True, **form):
+    """Renderer of a calendar portlet (by default a new assignment) in the
+    right column of the site.
+
+    The request form is updated with form, e.g. year='2019', month='6'.
+    With new_request the events found for the portlets rendered before are
+    forgotten, as in a new request.
+    """
+    request = portal.REQUEST
+    request.form.update(form)
+    if new_request:
+        IAnnotations(request).pop(calendar.MONTH_EVENTS_KEY, None)
+    view = view or portal.restrictedTraverse('@@plone')
+    manager = getUtility(IPortletManager, name='plone.rightcolumn',
+                         context=portal)
+    renderer = getMultiAdapter(
+        (portal, request, view, manager, assignment or calendar.Assignment()),
+        IPortletRenderer)
+    if update:
+        renderer.update()
+    return renderer
+
+
+# counted calls: name, class and method
+COUNTED = [
+    # portal_catalog(), searchResults and unrestrictedSearchResults
+    ('searches', Catalog, 'searchResults'),
+    ('unique_values', Catalog, 'uniqueValuesFor'),
+    ('objects', AbstractCatalogBrain, 'getObject'),
+    ('objects', AbstractCatalogBrain, '_unrestrictedGetObject'),
+    # restrictedTraverse too, and getObject
+    ('traversals', Traversable, 'unrestrictedTraverse'),
+    ('datetimes', DateTime, '__init__'),
+]
+
+
+def _counting(calls, name, method):
+    def counting(*args, **kw):
+        calls[name] += 1
+        return method(*args, **kw)
+    return counting
+
+
+@contextmanager
+def count_calls():
+    """Count the catalog searches, uniqueValuesFor calls, objects woken up
+    from brains, traversals and DateTime built in the block::
+
+        with count_calls() as calls:
+            renderer.render()
+        self.assertEqual(calls['searches'], 1)
+    """
+    calls = dict([(name, 0) for name, cls, method in COUNTED])
+    saved = []
+    for name, cls, method in COUNTED:
+        saved.append((cls, method, cls.__dict__.get(method)))
+        setattr(cls, method,
+                _counting(calls, name, getattr(cls, method)))
+    try:
+        yield calls
+    finally:
+        for cls, method, original in reversed(saved):
+            if original is None:
+                delattr(cls, method)
+            else:
+                setattr(cls, method, original)
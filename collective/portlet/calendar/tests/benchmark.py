@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the calendar.
+
+Microbenchmarks of the hot paths need no Plone site, run them with the
+interpreter of the buildout::
+
+    bin/zopepy -m collective.portlet.calendar.tests.benchmark
+
+Each one times the current code against the DateTime based code it
+replaced.
+
+The renderer benchmark fills a site of the testing FIXTURE with events and
+times the renderer of several portlets, with cold and warm caches. It is
+not part of the test suite, run it with the test runner::
+
+    CALENDAR_BENCHMARK_EVENTS=10000 bin/test -s collective.portlet.calendar \
+        --test-file-pattern=^benchmark$
+
+It is set up with environment variables:
+
+``CALENDAR_BENCHMARK_EVENTS``
+    number of events, 1000 by default. One in ten lasts one to three
+    months, the others one hour, spread over the year around the current
+    month.
+``CALENDAR_BENCHMARK_DEPTH``
+    depth of the folder tree the events are spread in, 4 by default (three
+    subfolders a folder).
+``CALENDAR_BENCHMARK_REPEAT``
+    runs of each timing, 5 by default.
+``CALENDAR_BENCHMARK_OUTPUT``
+    JSON file the results are written to, ``calendar-benchmark.json`` by
+    default.
+"""
+import json
+import os
+import pkg_resources
+import time
+import timeit
+import unittest2 as unittest
+from DateTime import DateTime
+from calendar import monthrange
+from collective.portlet.calendar import rendercache
+from collective.portlet.calendar.calendar import Assignment
+from collective.portlet.calendar.calendar import MONTH_EVENTS_KEY
+from collective.portlet.calendar.calendar import compile_query
+from collective.portlet.calendar.calendar import _events_by_day
+from collective.portlet.calendar.calendar import _render_cachekey
+from collective.portlet.calendar.calendar import _year_and_month
+from collective.portlet.calendar.testing import FIXTURE
+from collective.portlet.calendar.testing import calendar_renderer
+from plone.app.testing import IntegrationTesting
+from plone.app.testing import PloneSandboxLayer
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import TEST_USER_NAME
+from plone.app.testing import login
+from plone.app.testing import logout
+from plone.app.testing import setRoles
+from zope.annotation.interfaces import IAnnotations
+from zope.component import queryUtility
+from zope.ramcache.interfaces.ram import IRAMCache
+
+YEAR, MONTH = 2019, 6
+
+
+class Brain(object):
+
+    def __init__(self, id, start, end):
+        self.getId = id
+        self.Title = id.upper()
+        self.start = start
+        self.end = end
+
+
+def month_brains(count):
+    """Events of the month: one hour long, all day ones ending at midnight
+    and some starting the month before or ending the month after
+    """
+    brains = []
+    for i in range(count):
+        day = i % 30 + 1
+        if i % 10 == 0:
+            start = DateTime(YEAR, MONTH - 1, 25, 10, 0)
+            end = DateTime(YEAR, MONTH, day, 12, 0)
+        elif i % 10 == 1:
+            start = DateTime(YEAR, MONTH, day, 10, 0)
+            end = DateTime(YEAR, MONTH + 1, 5, 12, 0)
+        elif i % 10 == 2:
+            start = DateTime(YEAR, MONTH, day)
+            end = start + 1
+        else:
+            start = DateTime(YEAR, MONTH, day, 10, 0)
+            end = DateTime(YEAR, MONTH, day, 11, 0)
+        brains.append(Brain('event%d' % i, start, end))
+    return brains
+
+
+def datetime_events_by_day(year, month, brains):
+    """_events_by_day as it was, on DateTime comparisons"""
+    last_day = monthrange(year, month)[1]
+    first_date = DateTime('%d/%02d/01 00:00:00' % (year, month))
+    last_date = DateTime('%d/%02d/%02d 23:59:59' % (year, month, last_day))
+    event_days = {}
+    for daynumber in range(1, 32):
+        event_days[daynumber] = {'eventslist': [], 'event': 0,
+                                 'day': daynumber}
+    for brain in brains:
+        event = {}
+        if brain.end.greaterThan(last_date):
+            event_end_day = last_day
+            event['end'] = None
+        else:
+            event_end_day = brain.end.day()
+            if brain.end == brain.end.earliestTime():
+                event['end'] = (brain.end - 1).latestTime().Time()
+            else:
+                event['end'] = brain.end.Time()
+        if brain.start.lessThan(first_date):
+            event_start_day = 1
+            event['start'] = None
+        else:
+            event_start_day = brain.start.day()
+            event['start'] = brain.start.Time()
+        event['title'] = brain.Title or brain.getId
+        if event_start_day != event_end_day:
+            all_event_days = range(event_start_day, event_end_day + 1)
+            event_days[event_start_day]['eventslist'].append(
+                {'end': None, 'start': brain.start.Time(),
+                 'title': event['title']})
+            event_days[event_start_day]['event'] = 1
+            for eventday in all_event_days[1:-1]:
+                event_days[eventday]['eventslist'].append(
+                    {'end': None, 'start': None, 'title': event['title']})
+                event_days[eventday]['event'] = 1
+            if brain.end == brain.end.earliestTime() and \
+                    event['end'] is not None:
+                last_days_event = \
+                    event_days[all_event_days[-2]]['eventslist'][-1]
+                last_days_event['end'] = \
+                    (brain.end - 1).latestTime().Time()
+            else:
+                event_days[event_end_day]['eventslist'].append(
+                    {'end': event['end'], 'start': None,
+                     'title': event['title']})
+                event_days[event_end_day]['event'] = 1
+        else:
+            event_days[event_start_day]['eventslist'].append(event)
+            event_days[event_start_day]['event'] = 1
+    return event_days
+
+
+def criteria_dates(count):
+    """Date strings as returned by new style collections"""
+    return ['%d/%02d/%02d' % (YEAR, month, month * 2)
+            for month in range(1, 13)] * (count / 12)
+
+
+def _best(function, number, repeat=3):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def bench_events_by_day(count=1000, number=10):
+    """Seconds per bucketing of count events, (DateTime, current)"""
+    brains = month_brains(count)
+    assert datetime_events_by_day(YEAR, MONTH, brains) == \
+        _events_by_day(YEAR, MONTH, brains)
+    return (
+        _best(lambda: datetime_events_by_day(YEAR, MONTH, brains), number),
+        _best(lambda: _events_by_day(YEAR, MONTH, brains), number))
+
+
+def bench_range_criteria(count=1200, number=10):
+    """Seconds per month filter of count criteria dates, (DateTime, current)
+    """
+    dates = criteria_dates(count)
+
+    def datetime_filter():
+        return [d for d in [DateTime(d) for d in dates]
+                if d.year() == YEAR and d.month() == MONTH]
+
+    def current_filter():
+        return [DateTime(d) for d in dates
+                if _year_and_month(d) == (YEAR, MONTH)]
+
+    assert datetime_filter() == current_filter()
+    return _best(datetime_filter, number), _best(current_filter, number)
+
+
+def main():
+    for name, bench in [('events by day', bench_events_by_day),
+                        ('range criteria', bench_range_criteria)]:
+        before, after = bench()
+        print '%-16s %8.2f ms %8.2f ms  x%.1f' % (
+            name, before * 1000, after * 1000, before / after)
+
+
+def setting(name, default):
+    return os.environ.get('CALENDAR_BENCHMARK_' + name, default)
+
+
+def fill_site(portal, count, depth):
+    """Add count events to a folder tree of the given depth, and a
+    collection of the events tagged ``Meeting``. Two events in three are
+    published.
+    """
+    workflow = portal.portal_workflow
+    workflow.setChainForPortalTypes(['Folder', 'Event'],
+                                    ['simple_publication_workflow'])
+    portal.invokeFactory('Folder', 'bench')
+    folders = [portal['bench']]
+    level = folders[:]
+    for i in range(depth):
+        children = []
+        for folder in level:
+            for j in range(3):
+                folder.invokeFactory('Folder', 'f%d' % j)
+                children.append(folder['f%d' % j])
+        folders.extend(children)
+        level = children
+    for folder in folders:
+        workflow.doActionFor(folder, 'publish')
+    now = DateTime()
+    month = DateTime('%d/%02d/01 00:00:00' % (now.year(), now.month()))
+    for i in range(count):
+        # deterministic spread over the year around the current month
+        start = month + (i * 7919) % 365 - 182 + (i % 12) / 24.0 + 8 / 24.0
+        if i % 10 == 9:
+            end = start + 30 + i % 60
+        else:
+            end = start + 1 / 24.0
+        folder = folders[i % len(folders)]
+        id = 'event%d' % i
+        folder.invokeFactory('Event', id, title='Event %d' % i,
+                             startDate=start, endDate=end,
+                             subject=[('Meeting', 'Party')[i % 2]])
+        if i % 3:
+            workflow.doActionFor(folder[id], 'publish')
+    portal.invokeFactory('Collection', 'bench-collection')
+    portal['bench-collection'].setQuery([
+        {'i': 'portal_type',
+         'o': 'plone.app.querystring.operation.selection.is',
+         'v': ['Event']},
+        {'i': 'Subject',
+         'o': 'plone.app.querystring.operation.selection.is',
+         'v': ['Meeting']}])
+    return folders
+
+
+class BenchmarkFixture(PloneSandboxLayer):
+    """Site of the testing FIXTURE filled with events, see fill_site"""
+
+    defaultBases = (FIXTURE,)
+
+    def setUpPloneSite(self, portal):
+        setRoles(portal, TEST_USER_ID, ['Manager'])
+        login(portal, TEST_USER_NAME)
+        fill_site(portal, int(setting('EVENTS', 1000)),
+                  int(setting('DEPTH', 4)))
+        logout()
+        setRoles(portal, TEST_USER_ID, ['Member'])
+
+
+BENCHMARK_FIXTURE = BenchmarkFixture()
+BENCHMARK_TESTING = IntegrationTesting(
+    bases=(BENCHMARK_FIXTURE,),
+    name='collective.portlet.calendar:Benchmark',
+)
+
+# portlets benchmarked, by name
+SCENARIOS = [
+    ('site', lambda depth: {}),
+    ('folder', lambda depth: {'root': '/bench' + '/f0' * depth}),
+    ('keywords', lambda depth: {'kw': [u'Meeting']}),
+    ('collection', lambda depth: {'root': '/bench-collection'}),
+    ('quarter', lambda depth: {'months': 3}),
+    ('density', lambda depth: {'density': True}),
+]
+
+OPERATIONS = [
+    ('_render_cachekey', lambda renderer: _render_cachekey(renderer.render,
+                                                           renderer)),
+    ('getEventsForCalendar', lambda renderer: renderer.getEventsForCalendar()),
+    ('_get_calendar_structure',
+     lambda renderer: renderer._get_calendar_structure()),
+    ('render', lambda renderer: renderer.render()),
+]
+
+
+def clear_caches(request):
+    """Forget the rendered calendars, month events and memoized values"""
+    rendercache.store.clear()
+    rendercache.months.clear()
+    ramcache = queryUtility(IRAMCache)
+    if ramcache is not None:
+        ramcache.invalidateAll()
+    IAnnotations(request).pop(MONTH_EVENTS_KEY, None)
+
+
+def _assignment(portal, data):
+    """Assignment of a portlet added to the site, see AddForm.create"""
+    assignment = Assignment(**data)
+    compile_query(assignment, portal)
+    return assignment
+
+
+def _timings(seconds):
+    seconds = sorted(seconds)
+    return {'min': round(seconds[0] * 1000, 3),
+            'median': round(seconds[len(seconds) // 2] * 1000, 3),
+            'max': round(seconds[-1] * 1000, 3)}
+
+
+def bench_renderer(portal, request, repeat, depth):
+    """Milliseconds taken by the operations of the renderer of each
+    scenario, by scenario, operation and cold or warm cache.
+
+    Cold runs start with empty caches; warm runs are new requests after a
+    first render, the caches of the process being kept.
+    """
+    results = {}
+    for name, data in SCENARIOS:
+        results[name] = operations = {}
+        assignment = _assignment(portal, data(depth))
+        for operation, function in OPERATIONS:
+            cold = []
+            for i in range(repeat):
+                clear_caches(request)
+                # a new renderer, with nothing memoized, for every run
+                renderer = calendar_renderer(portal, assignment)
+                started = time.time()
+                function(renderer)
+                cold.append(time.time() - started)
+            warm = []
+            calendar_renderer(portal, assignment).render()
+            for i in range(repeat):
+                renderer = calendar_renderer(portal, assignment)
+                started = time.time()
+                function(renderer)
+                warm.append(time.time() - started)
+            operations[operation] = {'cold': _timings(cold),
+                                     'warm': _timings(warm)}
+    clear_caches(request)
+    return results
+
+
+class TestRendererBenchmark(unittest.TestCase):
+
+    layer = BENCHMARK_TESTING
+
+    def test_renderer(self):
+        portal = self.layer['portal']
+        depth = int(setting('DEPTH', 4))
+        repeat = int(setting('REPEAT', 5))
+        now = DateTime()
+        results = {
+            'version': pkg_resources.get_distribution(
+                'collective.portlet.calendar').version,
+            'events': int(setting('EVENTS', 1000)),
+            'depth': depth,
+            'repeat': repeat,
+            'month': [now.year(), now.month()],
+            'unit': 'ms',
+            'timings': bench_renderer(portal, self.layer['request'], repeat,
+                                      depth),
+        }
+        output = open(setting('OUTPUT', 'calendar-benchmark.json'), 'w')
+        try:
+            json.dump(results, output, indent=2, sort_keys=True)
+        finally:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
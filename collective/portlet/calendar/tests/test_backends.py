@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import SocketServer
+import threading
+import unittest2 as unittest
+from DateTime import DateTime
+from collective.portlet.calendar import backends
+from collective.portlet.calendar import rendercache
+from collective.portlet.calendar.backends import MemcachedBackend
+from collective.portlet.calendar.backends import memcache
+from collective.portlet.calendar.testing import INTEGRATION_TESTING
+from collective.portlet.calendar.testing import calendar_renderer
+from collective.portlet.calendar.testing import product_config
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import setRoles
+
+
+class MemcachedHandler(SocketServer.StreamRequestHandler):
+    """The part of the memcached text protocol used by python-memcached"""
+
+    def handle(self):
+        data = self.server.data
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.split()
+            if command[0] == 'get':
+                for key in command[1:]:
+                    if key in data:
+                        flags, value = data[key]
+                        self.wfile.write('VALUE %s %s %d\r\n%s\r\n' % (
+                            key, flags, len(value), value))
+                self.wfile.write('END\r\n')
+            elif command[0] == 'set':
+                key, flags, exptime, size = command[1:5]
+                value = self.rfile.read(int(size) + 2)[:-2]
+                data[key] = (flags, value)
+                self.wfile.write('STORED\r\n')
+            elif command[0] == 'stats':
+                size = sum([len(value) for flags, value in data.values()])
+                self.wfile.write('STAT curr_items %d\r\nSTAT bytes %d\r\n'
+                                 'STAT limit_maxbytes 67108864\r\nEND\r\n' % (
+                                     len(data), size))
+            else:
+                self.wfile.write('ERROR\r\n')
+            self.wfile.flush()
+
+
+class MemcachedServer(SocketServer.ThreadingTCPServer):
+    """In-process stand-in for a memcached server"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(
+            self, ('127.0.0.1', 0), MemcachedHandler)
+        self.data = {}
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def address(self):
+        return '%s:%d' % self.server_address
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+@unittest.skipIf(memcache is None, 'python-memcached is not installed')
+class TestMemcachedBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MemcachedServer()
+        self.backend = MemcachedBackend([self.server.address()])
+
+    def tearDown(self):
+        self.backend.client().disconnect_all()
+        self.server.stop()
+
+    def test_get_set(self):
+        self.assertEqual(self.backend.get('key'), None)
+        self.backend.set('key', 'fresh', u'<p>caf\xe9</p>', assignment='one')
+        self.assertEqual(self.backend.get('key'),
+                         ('fresh', u'<p>caf\xe9</p>', None))
+        self.backend.set('key', 'fresh', u'<p>caf\xe9</p>', stale_since=1.5)
+        self.assertEqual(self.backend.get('key')[2], 1.5)
+        # keys are hashed, identities may be long and contain spaces
+        self.assertEqual(len(self.server.data), 1)
+
+    def test_shared(self):
+        other = MemcachedBackend([self.server.address()])
+        self.backend.set('key', 'fresh', u'html')
+        self.assertEqual(other.get('key'), ('fresh', u'html', None))
+        other.client().disconnect_all()
+
+    def test_occupancy(self):
+        self.backend.set('key', 'fresh', u'html', assignment='one')
+        self.backend.count('one', 'misses')
+        occupancy = self.backend.occupancy()
+        self.assertEqual(occupancy['entries'], 1)
+        self.assertTrue(occupancy['bytes'] > 0)
+        self.assertEqual(occupancy['assignments']['one']['misses'], 1)
+
+
+@unittest.skipIf(memcache is None, 'python-memcached is not installed')
+class TestMemcachedRendering(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        self.server = MemcachedServer()
+        self.settings = {'cache-backend': 'memcached',
+                         'memcached-servers': self.server.address()}
+        rendercache.store.clear()
+        backends.memcached.clear()
+
+    def tearDown(self):
+        with product_config(self.settings):
+            backends.memcached.client().disconnect_all()
+        self.server.stop()
+
+    def test_render(self):
+        with product_config(self.settings):
+            html = calendar_renderer(self.portal).render()
+            self.assertEqual(len(self.server.data), 1)
+            self.assertEqual(calendar_renderer(self.portal).render(), html)
+            occupancy = backends.memcached.occupancy()
+        stats = occupancy['assignments'].values()[0]
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        # nothing was stored by this instance
+        self.assertEqual(len(rendercache.store), 0)
+
+    def test_invalidated(self):
+        with product_config(self.settings):
+            html = calendar_renderer(self.portal).render()
+            now = DateTime()
+            start = DateTime('%s/%s/2 10:00' % (now.year(), now.month()))
+            self.portal.invokeFactory('Event', 'e1', title='Meeting',
+                                      startDate=start,
+                                      endDate=start + 1 / 24.0)
+            self.assertNotEqual(calendar_renderer(self.portal).render(), html)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+import unittest2 as unittest
+from DateTime import DateTime
+from collective.portlet.calendar import calendar
+from collective.portlet.calendar import rendercache
+from collective.portlet.calendar.testing import INTEGRATION_TESTING
+from collective.portlet.calendar.testing import calendar_renderer
+from collective.portlet.calendar.testing import count_calls
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import TEST_USER_NAME
+from plone.app.testing import login
+from plone.app.testing import logout
+from plone.app.testing import setRoles
+
+# most calls allowed for a render of a portlet added with the add form,
+# whatever the number of events
+MISS = {'searches': 3, 'unique_values': 0, 'objects': 0, 'traversals': 0,
+        'datetimes': 10}
+HIT = {'searches': 0, 'unique_values': 0, 'objects': 0, 'traversals': 0,
+       'datetimes': 1}
+# anonymous visitors also search the events published or expired today
+# (see calendar._publication_times), and their searches build the DateTime
+# of the effective range
+ANONYMOUS_MISS = dict(MISS, searches=MISS['searches'] + 2,
+                      datetimes=MISS['datetimes'] + MISS['searches'] + 3)
+
+
+class TestCountCalls(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def test_count_calls(self):
+        portal = self.layer['portal']
+        catalog = portal.portal_catalog
+        with count_calls() as calls:
+            catalog(portal_type='Document')
+            catalog.unrestrictedSearchResults(portal_type='Document')
+            catalog.uniqueValuesFor('review_state')
+            portal.restrictedTraverse('portal_catalog')
+            DateTime() + 1
+        self.assertEqual(calls, {'searches': 2, 'unique_values': 1,
+                                 'objects': 0, 'traversals': 1,
+                                 'datetimes': 2})
+        # no longer counted
+        catalog(portal_type='Document')
+        self.assertEqual(calls['searches'], 2)
+
+
+class TestRenderBudgets(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        rendercache.store.clear()
+        now = DateTime()
+        self.start = DateTime('%s/%s/1 10:00' % (now.year(), now.month()))
+        self.count = 0
+        self.addEvents(10)
+
+    def tearDown(self):
+        rendercache.store.clear()
+
+    def addEvents(self, count):
+        for i in range(count):
+            self.count += 1
+            start = self.start + self.count % 28
+            self.portal.invokeFactory('Event', 'e%d' % self.count,
+                                      startDate=start,
+                                      endDate=start + self.count % 3 +
+                                      1 / 24.0)
+
+    def assignment(self, **kw):
+        assignment = calendar.Assignment(**kw)
+        # as done by the add form
+        calendar.compile_query(assignment, self.portal)
+        return assignment
+
+    def render(self, assignment):
+        """Calls made to render the portlet in a new request"""
+        view = self.portal.restrictedTraverse('@@plone')
+        with count_calls() as calls:
+            renderer = calendar_renderer(self.portal, assignment, view=view)
+            self.assertTrue('portletCalendar' in renderer.render())
+        return calls
+
+    def assertBudget(self, calls, budget):
+        for name, most in budget.items():
+            self.assertTrue(calls[name] <= most,
+                            '%d %s, %d at most' % (calls[name], name, most))
+
+    def test_cache_miss(self):
+        assignment = self.assignment()
+        # the localized dates of the days are built once
+        self.render(assignment)
+        self.addEvents(1)
+        self.assertBudget(self.render(assignment), MISS)
+
+    def test_cache_hit(self):
+        assignment = self.assignment()
+        self.render(assignment)
+        self.assertBudget(self.render(assignment), HIT)
+
+    def test_anonymous_cache_miss(self):
+        assignment = self.assignment()
+        logout()
+        self.render(assignment)
+        login(self.portal, TEST_USER_NAME)
+        self.addEvents(1)
+        logout()
+        self.assertBudget(self.render(assignment), ANONYMOUS_MISS)
+
+    def test_anonymous_cache_hit(self):
+        assignment = self.assignment()
+        logout()
+        self.render(assignment)
+        self.assertBudget(self.render(assignment), HIT)
+
+    def test_cache_hit_folder(self):
+        self.portal.invokeFactory('Folder', 'folder1')
+        assignment = self.assignment(root='/folder1')
+        self.render(assignment)
+        self.assertBudget(self.render(assignment), HIT)
+
+    def test_cache_hit_collection(self):
+        self.portal.invokeFactory('Collection', 'collection1')
+        self.portal.collection1.setQuery([
+            {'i': 'portal_type',
+             'o': 'plone.app.querystring.operation.selection.is',
+             'v': ['Event']}])
+        self.portal.collection1.reindexObject()
+        assignment = self.assignment(root='/collection1')
+        self.render(assignment)
+        self.assertBudget(self.render(assignment), HIT)
+
+    def test_more_events(self):
+        assignment = self.assignment(months=2)
+        self.render(assignment)
+        self.addEvents(1)
+        calls = self.render(assignment)
+        self.addEvents(20)
+        self.assertEqual(self.render(assignment), calls)
+
+    def test_density(self):
+        assignment = self.assignment(density=True)
+        self.render(assignment)
+        self.addEvents(1)
+        self.assertBudget(self.render(assignment), MISS)
+
+    def test_density_year(self):
+        # the months are counted at once
+        assignment = self.assignment(density=True, months=12)
+        self.render(assignment)
+        self.addEvents(1)
+        self.assertBudget(self.render(assignment), MISS)
+
+    def test_review_states(self):
+        # the review states of the site are only needed without the ones of
+        # the portlet
+        assignment = calendar.Assignment(review_state=('published', ))
+        self.assertEqual(self.render(assignment)['unique_values'], 0)
+        assignment = calendar.Assignment()
+        self.assertEqual(self.render(assignment)['unique_values'], 1)
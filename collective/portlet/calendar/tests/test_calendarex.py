@@ -2,9 +2,14 @@
 import unittest2 as unittest
 from DateTime import DateTime
 from Products.GenericSetup.utils import _getDottedName
+from Products.ZCatalog.Catalog import Catalog
 from collective.portlet.calendar import calendar
+from collective.portlet.calendar import rendercache
 from collective.portlet.calendar.calendar import Renderer
 from collective.portlet.calendar.testing import INTEGRATION_TESTING
+from collective.portlet.calendar.testing import product_config
+from collective.portlet.calendar.utils import index_day
+from datetime import date
 from plone.app.testing import TEST_USER_ID
 from plone.app.testing import setRoles
 from plone.portlets.interfaces import IPortletAssignment
@@ -12,7 +17,11 @@ from plone.portlets.interfaces import IPortletDataProvider
 from plone.portlets.interfaces import IPortletManager
 from plone.portlets.interfaces import IPortletRenderer
 from plone.portlets.interfaces import IPortletType
+from plone.uuid.interfaces import IUUID
+from zope.annotation.interfaces import IAnnotations
 from zope.component import getUtility, getMultiAdapter
+from zope.event import notify
+from zope.lifecycleevent import ObjectModifiedEvent
 
 
 class TestPortlet(unittest.TestCase):
@@ -143,6 +152,27 @@ class TestRendererBase(unittest.TestCase):
                          {'start': {'query': [d1, self.last_date],
                                     'range': 'minmax'}})
 
+    def test_fix_range_criteria_strings_outside_month(self):
+        renderer = self.renderer
+        renderer.options = {'start': {
+            'query': ['2014-04-30T22:00:00', '2014-05-01T10:00:00+02:00',
+                      '2014/06/01'],
+            'range': 'minmax'}}
+        renderer._fix_range_criteria('start')
+        self.assertEqual(renderer.options['start']['query'],
+                         [DateTime('2014-05-01T10:00:00+02:00'),
+                          self.last_date])
+
+    def test_year_and_month(self):
+        self.assertEqual(calendar._year_and_month('2014/05/10'), (2014, 5))
+        self.assertEqual(calendar._year_and_month('2014-5-10 10:00'),
+                         (2014, 5))
+        self.assertEqual(calendar._year_and_month(DateTime('2014/05/10')),
+                         (2014, 5))
+        # other formats are left to DateTime
+        self.assertEqual(calendar._year_and_month('May 10, 2014'),
+                         (2014, 5))
+
     def test_fix_range_criteria_end(self):
         renderer = self.renderer
         d1 = DateTime('2014/05/20')
@@ -315,10 +345,29 @@ class TestRenderer(unittest.TestCase):
         # Make sure to publish this event
         self.portal.portal_workflow.doActionFor(self.portal.e1, 'publish')
 
+        # Month results are kept for the whole request: drop them to act
+        # like a new request
+        IAnnotations(self.portal.REQUEST).pop(calendar.MONTH_EVENTS_KEY, None)
+
         # Try to render the calendar portlet again, it must be different now
         r = self.renderer(assignment=calendar.Assignment())
         self.assertNotEqual(html, r.render(), "Cache key wasn't invalidated")
 
+    def testMonthEventsSearchedOncePerRequest(self):
+        self.createEvents()
+        r = self.renderer(assignment=calendar.Assignment())
+        r.update()
+        brains = r.getMonthEvents()
+        self.assertEqual(len(brains), 5)
+
+        # The result set is reused by the calendar structure: an event added
+        # later in the same request is not seen
+        start, end = self.genDates(delta=3)
+        self.portal.invokeFactory('Event', 'e6', startDate=start, endDate=end)
+        self.assertTrue(r.getMonthEvents() is brains)
+        self.assertEqual(
+            self.countEventsInPortlet(r.getEventsForCalendar()), 5)
+
     def testEventsPathSearch(self):
         # Create the events
         self.createEvents()
@@ -449,3 +498,330 @@ class TestRenderer(unittest.TestCase):
         self.assertEqual(
             self.countEventsInPortlet(r.getEventsForCalendar()), 1)
         self.assertEqual(r.root(), '%s%s' % (self.portal_path, path))
+
+    def compiled(self, **kw):
+        assignment = calendar.Assignment(**kw)
+        calendar.compile_query(assignment, self.portal)
+        return assignment
+
+    def testCompiledQuery(self):
+        self.createEvents()
+        assignment = self.compiled(root='/folder1', kw=[u'Meeting'],
+                                   review_state=('published', ))
+        compiled = assignment.compiled
+        self.assertEqual(compiled['root_path'],
+                         '%s/folder1' % self.portal_path)
+        self.assertEqual(compiled['root_uid'],
+                         IUUID(self.portal.folder1))
+        self.assertEqual(compiled['Subject'], ['Meeting'])
+        self.assertTrue(isinstance(compiled['Subject'][0], str))
+        self.assertEqual(compiled['review_state'], ['published'])
+        self.assertFalse(compiled['collection'])
+        self.assertTrue('private' in self.compiled().compiled['review_state'])
+
+        r = self.renderer(assignment=assignment)
+        r.update()
+        query = r._month_query()
+        self.assertEqual(query['path'], compiled['root_path'])
+        self.assertEqual(query['Subject'], ['Meeting'])
+        self.assertEqual(
+            self.countEventsInPortlet(r.getEventsForCalendar()), 1)
+
+    def testCompiledQuerySameEvents(self):
+        self.createEvents()
+        for kw in [{}, {'root': '/folder1'}, {'kw': [u'Meeting']},
+                   {'review_state': ('private', )}]:
+            r = self.renderer(assignment=calendar.Assignment(**kw))
+            r.update()
+            expected = self.countEventsInPortlet(r.getEventsForCalendar())
+            IAnnotations(self.portal.REQUEST).pop(calendar.MONTH_EVENTS_KEY)
+            r = self.renderer(assignment=self.compiled(**kw))
+            r.update()
+            self.assertEqual(
+                self.countEventsInPortlet(r.getEventsForCalendar()), expected)
+            IAnnotations(self.portal.REQUEST).pop(calendar.MONTH_EVENTS_KEY)
+
+    def testCompiledQueryStatelessEvents(self):
+        self.createEvents()
+        self.portal.portal_workflow.setChainForPortalTypes(['Event'], ())
+        start, end = self.genDates(delta=0)
+        self.portal.invokeFactory('Event', 'e7', startDate=start, endDate=end)
+        r = self.renderer(assignment=calendar.Assignment())
+        r.update()
+        expected = self.countEventsInPortlet(r.getEventsForCalendar())
+        IAnnotations(self.portal.REQUEST).pop(calendar.MONTH_EVENTS_KEY)
+        r = self.renderer(assignment=self.compiled())
+        r.update()
+        self.assertEqual(
+            self.countEventsInPortlet(r.getEventsForCalendar()), expected)
+
+    def testCompiledQueryOtherNavigationRoot(self):
+        self.createEvents()
+        assignment = self.compiled()
+        assignment.compiled['navigation_root'] = '/elsewhere'
+        r = self.renderer(assignment=assignment)
+        r.update()
+        self.assertEqual(r.compiledQuery(), None)
+        self.assertEqual(r.root(), self.portal_path)
+
+    def testCompiledQueryOnSave(self):
+        mapping = self.portal.restrictedTraverse(
+            '++contextportlets++plone.leftcolumn')
+        for m in mapping.keys():
+            del mapping[m]
+        addview = mapping.restrictedTraverse('+/portlets.CalendarEx')
+        addview.createAndAdd(data={'name': u'My Calendar', 'root': u'',
+                                   'kw': (u'Meeting', )})
+        assignment = mapping.values()[0]
+        self.assertEqual(assignment.compiled['Subject'], ['Meeting'])
+        assignment.kw = (u'Party', )
+        notify(ObjectModifiedEvent(assignment))
+        self.assertEqual(assignment.compiled['Subject'], ['Party'])
+
+    def testCollectionQueryParsedOnce(self):
+        self.createEvents()
+        self.createCollection()
+        collection = self.portal['example-events']
+        parsed = []
+        parseFormquery = calendar.parseFormquery
+
+        def parse(*args, **kw):
+            parsed.append(args)
+            return parseFormquery(*args, **kw)
+        calendar.parseFormquery = parse
+        try:
+            for i in range(2):
+                IAnnotations(self.portal.REQUEST).pop(
+                    calendar.MONTH_EVENTS_KEY, None)
+                r = self.renderer(assignment=calendar.Assignment(
+                    root='/example-events'))
+                r.update()
+                self.assertEqual(
+                    self.countEventsInPortlet(r.getEventsForCalendar()), 5)
+            self.assertEqual(len(parsed), 1)
+            # the cached query is left as parsed
+            self.assertEqual(calendar._parse_collection(collection),
+                             parseFormquery(collection,
+                                            collection.getQuery(raw=True)))
+            new_filter = [{'i': 'review_state',
+                           'o': 'plone.app.querystring.operation.selection.is',
+                           'v': ['published']}]
+            collection.setQuery(collection.getQuery(raw=True) + new_filter)
+            self.assertEqual(
+                self.countEventsInPortlet(r.getEventsForCalendar()), 3)
+            self.assertEqual(len(parsed), 2)
+        finally:
+            calendar.parseFormquery = parseFormquery
+
+    def testTopicCacheKey(self):
+        self.createTopicEvents()
+        self.createTopic()
+        topic = self.portal['example-events']
+        # criteria are not loaded
+        topic.listCriteria = lambda: self.fail('criteria loaded')
+        key = calendar._collection_cachekey(None, topic)
+        self.assertEqual(key, calendar._collection_cachekey(None, topic))
+        topic.addCriterion('review_state', 'ATListCriterion')
+        self.assertNotEqual(key, calendar._collection_cachekey(None, topic))
+        del topic.listCriteria
+
+    def testRootByUID(self):
+        self.createEvents()
+        assignment = self.compiled(root='/folder1')
+        r = self.renderer(assignment=assignment)
+        r.update()
+        # cache keys read the root modification date from the catalog
+        r.rootContent = lambda: self.fail('root loaded')
+        calendar._render_freshness(r)
+        self.assertEqual(r.rootModified(), self.portal.folder1.modified())
+
+        # the root is followed when renamed
+        self.portal.manage_renameObject('folder1', 'renamed')
+        r = self.renderer(assignment=assignment)
+        r.update()
+        self.assertEqual(r.root(), '%s/renamed' % self.portal_path)
+        self.assertEqual(
+            self.countEventsInPortlet(r.getEventsForCalendar()), 2)
+
+    def testSiteRootModified(self):
+        r = self.renderer(assignment=self.compiled())
+        r.update()
+        r.rootContent = lambda: self.fail('root traversed')
+        self.assertEqual(r.rootModified(), self.portal.modified())
+
+    def testDayLinks(self):
+        self.createEvents()
+        r = self.renderer(assignment=calendar.Assignment(root='/folder1'))
+        r.update()
+        calls = []
+        getReviewStateString = r.getReviewStateString
+
+        def reviewStateString():
+            calls.append(1)
+            return getReviewStateString()
+        r.getReviewStateString = reviewStateString
+        days = [day for week in r.getEventsForCalendar() for day in week
+                if day['event']]
+        self.assertEqual(len(days), 2)
+        # the link prefix is built once for all the days
+        self.assertEqual(len(calls), 1)
+        date = days[0]['date_string']
+        self.assertEqual(
+            days[0]['link'],
+            'http://nohost/plone/@@search?review_state=published&'
+            'start.query:record:list:date=%s+23%%3A59%%3A59&'
+            'start.range:record=max&'
+            'end.query:record:list:date=%s+00%%3A00%%3A00&'
+            'end.range:record=min&path=%s/folder1' % (
+                date, date, self.portal_path))
+        rendercache.store.clear()
+        self.assertTrue(days[0]['link'] in r.render().replace('&amp;', '&'))
+
+    def testDayLabels(self):
+        self.createEvents()
+        r = self.renderer(assignment=calendar.Assignment())
+        r.update()
+        localized = []
+        ulocalized_time = r._ts.ulocalized_time
+
+        def localize(*args, **kw):
+            localized.append(args)
+            return ulocalized_time(*args, **kw)
+        r._ts.ulocalized_time = localize
+        try:
+            # a month nobody displayed yet
+            r.year, r.month = 2003, 2
+            labels = calendar._day_labels(r, 2003, 2)
+            self.assertEqual(len(labels), 28)
+            self.assertEqual(labels[9], ulocalized_time(
+                DateTime(2003, 2, 10), context=self.portal,
+                request=self.portal.REQUEST))
+            calendar._day_labels(r, 2003, 2)
+            # the month is localized at once
+            self.assertEqual(len(localized), 28)
+        finally:
+            del r._ts.ulocalized_time
+        r.year, r.month = DateTime().year(), DateTime().month()
+        day = [day for week in r.getEventsForCalendar() for day in week
+               if day['event']][0]
+        self.assertTrue(day['eventstring'].startswith(
+            calendar._day_labels(r, r.year, r.month)[day['day'] - 1]))
+
+    def testLazyTooltips(self):
+        self.createEvents()
+        r = self.renderer(assignment=calendar.Assignment())
+        r.__portlet_metadata__ = {'hash': 'portlethash'}
+        r.update()
+        rendercache.store.clear()
+        self.assertFalse('data-tooltips' in r.render())
+        with product_config({'lazy-tooltips': 'on'}):
+            days = [day for week in r.getEventsForCalendar() for day in week
+                    if day['event']]
+            self.assertEqual(set([day['eventstring'] for day in days]),
+                             set([None]))
+            html = r.render()
+            self.assertTrue('@@calendar-day-tooltips?' in r.tooltipsURL())
+        self.assertTrue('data-tooltips="http://nohost/plone/'
+                        '@@calendar-day-tooltips?' in html)
+        self.assertFalse('title="' in html.split('<tbody>')[1])
+
+    def testIndexDay(self):
+        index = self.portal.portal_catalog._catalog.getIndex('start')
+        for value in ['2019/12/31 23:30', '2020/02/29 00:00',
+                      '2019/01/31 10:00']:
+            value = DateTime(value)
+            self.assertEqual(
+                index_day(index._convert(value)),
+                (date(value.year(), value.month(), value.day()).toordinal(),
+                 value.hour() == 0))
+
+    def testDensity(self):
+        self.createEvents()
+        self.portal.invokeFactory('Event', 'long', startDate=DateTime() - 40,
+                                  endDate=DateTime() + 40)
+        r = self.renderer(assignment=calendar.Assignment())
+        r.update()
+        expected = dict([(day['day'], len(day['eventslist']))
+                         for week in r.getEventsForCalendar()
+                         for day in week if day['event']])
+        r = self.renderer(assignment=calendar.Assignment(density=True))
+        r.update()
+        getitem = Catalog.__getitem__
+        Catalog.__getitem__ = lambda *args: self.fail('brain created')
+        try:
+            days = [day for week in r.getEventsForCalendar() for day in week
+                    if day['event']]
+        finally:
+            Catalog.__getitem__ = getitem
+        self.assertEqual(dict([(day['day'], day['count']) for day in days]),
+                         expected)
+        self.assertEqual(max([day['density'] for day in days]), 4)
+        self.assertEqual(min([day['density'] for day in days]), 2)
+        self.assertEqual(days[0]['day'], 1)
+        self.assertTrue(days[0]['eventstring'].endswith('\n Events: 3'))
+        rendercache.store.clear()
+        self.assertTrue(' density4"' in r.render())
+
+    def testDensityTimeZone(self):
+        # events entered in another time zone are on the same day of the
+        # time zone of the server in both modes
+        now = DateTime()
+        if now.tzoffset() == -12 * 3600:
+            start = DateTime('%s/%s/15 00:30 GMT+12' % (now.year(),
+                                                        now.month()))
+        else:
+            start = DateTime('%s/%s/15 23:30 GMT-12' % (now.year(),
+                                                        now.month()))
+        day = start.toZone(now.localZone()).day()
+        self.assertNotEqual(day, 15)
+        self.portal.invokeFactory('Event', 'late', startDate=start,
+                                  endDate=start + 1 / 96.0)
+        r = self.renderer(assignment=calendar.Assignment())
+        r.update()
+        self.assertEqual([(d['day'], len(d['eventslist']))
+                          for week in r.getEventsForCalendar()
+                          for d in week if d['event']], [(day, 1)])
+        r = self.renderer(assignment=calendar.Assignment(density=True))
+        r.update()
+        self.assertEqual([(d['day'], d['count'])
+                          for week in r.getEventsForCalendar()
+                          for d in week if d['event']], [(day, 1)])
+
+    def testSeveralMonths(self):
+        self.createEvents()
+        now = DateTime()
+        start = DateTime('%s/%s/1 10:00' % (now.year(), now.month())) + 40
+        self.portal.invokeFactory('Event', 'later', startDate=start,
+                                  endDate=start + 1 / 24.0)
+        searches = []
+        search_months = calendar._search_months
+
+        def search(renderer, query, months):
+            searches.append(months)
+            return search_months(renderer, query, months)
+        calendar._search_months = search
+        try:
+            r = self.renderer(assignment=calendar.Assignment(months=3))
+            r.update()
+            months = r.getCalendarMonths()
+        finally:
+            calendar._search_months = search_months
+        self.assertEqual([(m['year'], m['month']) for m in months],
+                         r.displayedMonths())
+        self.assertEqual(len(searches), 1)
+        self.assertEqual(len(searches[0]), 3)
+        counts = [self.countEventsInPortlet(m['weeks']) for m in months]
+        self.assertEqual(sum(counts), 6)
+        self.assertEqual(counts[0], 5)
+        # months are grouped as they are one by one
+        brains = search_months(r, r._month_query(), r.displayedMonths())
+        by_months = calendar._events_by_months(r.displayedMonths(), brains)
+        for year, month in r.displayedMonths():
+            self.assertEqual(by_months[year, month],
+                             calendar._events_by_day(year, month, brains))
+        rendercache.store.clear()
+        self.assertEqual(r.render().count('<table class="ploneCalendar"'), 3)
+        # the portlet is invalidated by changes of any of its months
+        freshness = calendar._render_freshness(r)
+        self.portal.manage_delObjects(['later'])
+        self.assertNotEqual(calendar._render_freshness(r), freshness)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import unittest2 as unittest
+from DateTime import DateTime
+from collective.portlet.calendar import calendar
+from collective.portlet.calendar.dayindex import get_dayindex
+from collective.portlet.calendar.dayindex import rebuild
+from collective.portlet.calendar.testing import INTEGRATION_TESTING
+from collective.portlet.calendar.testing import calendar_renderer
+from datetime import date
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import setRoles
+from plone.uuid.interfaces import IUUID
+from zope.event import notify
+from zope.lifecycleevent import ObjectModifiedEvent
+
+
+def ordinal(value):
+    return date(value.year(), value.month(), value.day()).toordinal()
+
+
+class TestDayIndex(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        self.portal.portal_workflow.setChainForPortalTypes(
+            ['Folder', 'Event'], ['simple_publication_workflow'])
+        self.now = DateTime()
+        self.start = DateTime('%s/%s/1 10:00' % (self.now.year(),
+                                                   self.now.month()))
+
+    def addEvent(self, id, start, days=0, container=None):
+        container = container or self.portal
+        end = start + days + 1 / 24.0
+        container.invokeFactory('Event', id, startDate=start, endDate=end)
+        return container[id]
+
+    def countEvents(self, assignment):
+        r = calendar_renderer(self.portal, assignment)
+        return sum([len(d['eventslist'])
+                    for week in r.getEventsForCalendar()
+                    for d in week if d['day'] > 0])
+
+    def test_built_on_install(self):
+        self.assertFalse(get_dayindex(self.portal) is None)
+
+    def test_event_days(self):
+        event = self.addEvent('e1', self.start, days=2)
+        dayindex = get_dayindex(self.portal)
+        uid = IUUID(event)
+        first = ordinal(self.start)
+        self.assertTrue(uid in dayindex.uids(first))
+        self.assertTrue(uid in dayindex.uids(first + 2))
+        self.assertFalse(uid in dayindex.uids(first + 3))
+        self.assertTrue(uid in dayindex.month(self.start.year(),
+                                              self.start.month()))
+
+    def test_event_moved_and_removed(self):
+        event = self.addEvent('e1', self.start)
+        dayindex = get_dayindex(self.portal)
+        uid = IUUID(event)
+        first = ordinal(self.start)
+        event.setStartDate(self.start + 5)
+        event.setEndDate(self.start + 5 + 1 / 24.0)
+        notify(ObjectModifiedEvent(event))
+        self.assertFalse(uid in dayindex.uids(first))
+        self.assertTrue(uid in dayindex.uids(first + 5))
+        self.portal.manage_delObjects(['e1'])
+        self.assertFalse(uid in dayindex.uids(first + 5))
+        self.assertEqual(len(dayindex), 0)
+
+    def test_rebuild(self):
+        self.addEvent('e1', self.start)
+        self.addEvent('e2', self.start + 3, days=1)
+        self.assertEqual(rebuild(self.portal), 2)
+        view = self.portal.restrictedTraverse('@@calendar-rebuild-dayindex')
+        self.assertEqual(view(), 'Day index rebuilt: 2 events')
+
+    def test_same_results_without_index(self):
+        self.portal.invokeFactory('Folder', 'folder1')
+        self.addEvent('e1', self.start)
+        self.addEvent('e2', self.start + 3, days=1,
+                      container=self.portal.folder1)
+        self.addEvent('e3', self.start - 40, days=60)
+        self.portal.portal_workflow.doActionFor(self.portal.e1, 'publish')
+        assignments = [calendar.Assignment(),
+                       calendar.Assignment(root='/folder1'),
+                       calendar.Assignment(review_state=('published', ))]
+        indexed = [self.countEvents(a) for a in assignments]
+        get_dayindex(self.portal).built = False
+        self.assertEqual(indexed, [self.countEvents(a) for a in assignments])
+        self.assertEqual(indexed[1], 2)
+        self.assertEqual(indexed[2], 1)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import unittest2 as unittest
+from DateTime import DateTime
+from collective.portlet.calendar import calendar
+from collective.portlet.calendar.invalidation import ANNOTATION_KEY
+from collective.portlet.calendar.invalidation import get_generation
+from collective.portlet.calendar.invalidation import iter_months
+from collective.portlet.calendar.testing import INTEGRATION_TESTING
+from collective.portlet.calendar.testing import calendar_renderer
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import logout
+from plone.app.testing import setRoles
+from plone.app.workflow.events import LocalrolesModifiedEvent
+from plone.uuid.interfaces import IUUID
+from zope.annotation.interfaces import IAnnotations
+from zope.event import notify
+from zope.lifecycleevent import ObjectModifiedEvent
+
+
+class TestIterMonths(unittest.TestCase):
+
+    def test_iter_months(self):
+        self.assertEqual(list(iter_months(((2019, 3), (2019, 3)))),
+                         [(2019, 3)])
+        self.assertEqual(list(iter_months(((2019, 11), (2020, 2)))),
+                         [(2019, 11), (2019, 12), (2020, 1), (2020, 2)])
+        self.assertEqual(list(iter_months(None)), [])
+
+
+class TestInvalidation(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        self.portal.portal_workflow.setChainForPortalTypes(
+            ['Event'], ['simple_publication_workflow'])
+        self.now = DateTime()
+
+    def addEvent(self, id='e1', start=None):
+        start = start or self.now
+        end = start + 1 / 24.0
+        self.portal.invokeFactory('Event', id, startDate=start, endDate=end)
+        event = self.portal[id]
+        notify(ObjectModifiedEvent(event))
+        return event
+
+    def generation(self, date=None):
+        date = date or self.now
+        return get_generation(self.portal, date.year(), date.month())
+
+    def test_event_added(self):
+        generation = self.generation()
+        self.addEvent()
+        self.assertTrue(self.generation() > generation)
+
+    def test_event_modified(self):
+        event = self.addEvent()
+        generation = self.generation()
+        event.setTitle('Changed')
+        notify(ObjectModifiedEvent(event))
+        self.assertTrue(self.generation() > generation)
+
+    def test_event_transition(self):
+        event = self.addEvent()
+        generation = self.generation()
+        self.portal.portal_workflow.doActionFor(event, 'publish')
+        self.assertTrue(self.generation() > generation)
+
+    def test_event_removed(self):
+        self.addEvent()
+        generation = self.generation()
+        self.portal.manage_delObjects(['e1'])
+        self.assertTrue(self.generation() > generation)
+
+    def test_other_content_ignored(self):
+        generation = self.generation()
+        self.portal.invokeFactory('Document', 'd1')
+        notify(ObjectModifiedEvent(self.portal['d1']))
+        self.assertEqual(self.generation(), generation)
+
+    def test_other_months_untouched(self):
+        past = DateTime('2010/03/10 10:00')
+        generation = self.generation()
+        event = self.addEvent(start=past)
+        event.setTitle('Changed')
+        notify(ObjectModifiedEvent(event))
+        self.assertEqual(self.generation(), generation)
+        self.assertNotEqual(self.generation(past), (0, 0))
+
+    def test_old_and_new_months(self):
+        past = DateTime('2010/03/10 10:00')
+        event = self.addEvent(start=past)
+        generation = self.generation(past)
+        other = DateTime('2010/06/10 10:00')
+        other_generation = self.generation(other)
+        event.setStartDate(other)
+        event.setEndDate(other + 1 / 24.0)
+        notify(ObjectModifiedEvent(event))
+        self.assertTrue(self.generation(past) > generation)
+        self.assertTrue(self.generation(other) > other_generation)
+
+    def test_local_roles_modified(self):
+        self.portal.invokeFactory('Folder', 'f1')
+        generation = self.generation()
+        # sharing changes reindex security only
+        notify(LocalrolesModifiedEvent(self.portal['f1'], self.portal.REQUEST))
+        self.assertTrue(self.generation() > generation)
+
+    def test_unknown_span(self):
+        event = self.addEvent()
+        generations = IAnnotations(self.portal)[ANNOTATION_KEY]
+        del generations.spans[IUUID(event)]
+        past = DateTime('2010/03/10 10:00')
+        generation = self.generation(past)
+        notify(ObjectModifiedEvent(event))
+        # old dates are unknown: every month is invalidated
+        self.assertTrue(self.generation(past) > generation)
+
+    def test_cachekey(self):
+        r = calendar_renderer(self.portal)
+        key = calendar._render_cachekey(r.render, r)
+        self.assertEqual(key, calendar._render_cachekey(r.render, r))
+        self.addEvent()
+        self.assertNotEqual(key, calendar._render_cachekey(r.render, r))
+
+    def test_cachekey_assignment(self):
+        r1 = calendar_renderer(self.portal,
+                               calendar.Assignment(kw=[u'Meeting']))
+        r2 = calendar_renderer(self.portal,
+                               calendar.Assignment(kw=[u'Party']))
+        self.assertNotEqual(calendar._render_cachekey(r1.render, r1),
+                            calendar._render_cachekey(r2.render, r2))
+
+    def test_cachekey_effective(self):
+        # anonymous visitors see an event effective later today from then on
+        event = self.addEvent()
+        self.portal.portal_workflow.doActionFor(event, 'publish')
+        effective = DateTime().latestTime()
+        event.setEffectiveDate(effective)
+        notify(ObjectModifiedEvent(event))
+        logout()
+        r = calendar_renderer(self.portal)
+        key = calendar._render_cachekey(r.render, r)
+        self.assertEqual(key, calendar._render_cachekey(r.render, r))
+        saved = calendar.time
+        calendar.time = lambda: effective.timeTime() + 1
+        try:
+            self.assertNotEqual(key, calendar._render_cachekey(r.render, r))
+        finally:
+            calendar.time = saved
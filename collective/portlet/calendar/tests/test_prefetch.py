@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import unittest2 as unittest
+from DateTime import DateTime
+from collective.portlet.calendar import calendar
+from collective.portlet.calendar import rendercache
+from collective.portlet.calendar.dayindex import get_dayindex
+from collective.portlet.calendar.testing import INTEGRATION_TESTING
+from collective.portlet.calendar.testing import calendar_renderer
+from collective.portlet.calendar.testing import product_config
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import logout
+from plone.app.testing import setRoles
+
+PREFETCH = {'prefetch-months': 'on'}
+
+
+class TestAdjacentMonths(unittest.TestCase):
+
+    def test_adjacent_months(self):
+        self.assertEqual(calendar._adjacent_months(2019, 1),
+                         [(2018, 12), (2019, 1), (2019, 2)])
+        self.assertEqual(calendar._adjacent_months(2019, 12),
+                         [(2019, 11), (2019, 12), (2020, 1)])
+
+
+class TestPrefetch(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        self.request = self.layer['request']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        rendercache.months.clear()
+        self.searches = []
+        self._search_months = calendar._search_months
+
+        def search_months(renderer, query, months):
+            self.searches.append(months)
+            return self._search_months(renderer, query, months)
+        calendar._search_months = search_months
+
+        self.year, self.month = 2019, 6
+        for id, start in [('e1', '2019/05/31 22:00'),
+                          ('e2', '2019/06/10 10:00'),
+                          ('e3', '2019/07/01 10:00'),
+                          ('e4', '2019/08/01 10:00')]:
+            start = DateTime(start)
+            self.portal.invokeFactory('Event', id, startDate=start,
+                                      endDate=start + 1 / 24.0)
+
+    def tearDown(self):
+        calendar._search_months = self._search_months
+        rendercache.months.clear()
+
+    def events(self, year, month):
+        """Titles of the events of a month, by day, as a new request"""
+        renderer = calendar_renderer(self.portal, year=str(year),
+                                     month=str(month))
+        return [(day['day'], [e['title'] for e in day['eventslist']])
+                for week in renderer.getEventsForCalendar()
+                for day in week if day['event']]
+
+    def test_one_search(self):
+        with product_config(PREFETCH):
+            self.events(self.year, self.month)
+            self.assertEqual(self.searches,
+                             [[(2019, 5), (2019, 6), (2019, 7)]])
+            self.assertEqual(len(rendercache.months), 3)
+            # next and previous months need no search
+            self.events(2019, 7)
+            self.events(2019, 5)
+            self.assertEqual(len(self.searches), 1)
+            # unlike the month after
+            self.events(2019, 8)
+            self.assertEqual(len(self.searches), 2)
+
+    def test_same_events(self):
+        months = [(2019, 5), (2019, 6), (2019, 7)]
+        expected = [self.events(year, month) for year, month in months]
+        self.assertEqual(self.searches, [])
+        with product_config(PREFETCH):
+            self.events(self.year, self.month)
+            self.assertEqual(
+                [self.events(year, month) for year, month in months],
+                expected)
+
+    def test_same_events_without_dayindex(self):
+        get_dayindex(self.portal).built = False
+        self.test_same_events()
+
+    def test_invalidated(self):
+        with product_config(PREFETCH):
+            self.events(self.year, self.month)
+            start = DateTime('2019/07/15 10:00')
+            self.portal.invokeFactory('Event', 'e5', startDate=start,
+                                      endDate=start + 1 / 24.0)
+            self.assertTrue(
+                (15, ['e5']) in self.events(2019, 7))
+            self.assertEqual(len(self.searches), 2)
+
+    def test_effective(self):
+        # anonymous visitors find an event effective later today from then
+        # on, although the month was prefetched before
+        now = DateTime()
+        self.portal.invokeFactory('Event', 'e5', startDate=now,
+                                  endDate=now + 1 / 24.0)
+        event = self.portal['e5']
+        self.portal.portal_workflow.doActionFor(event, 'publish')
+        effective = now.latestTime()
+        event.setEffectiveDate(effective)
+        event.reindexObject()
+        logout()
+        with product_config(PREFETCH):
+            self.events(now.year(), now.month())
+            self.events(now.year(), now.month())
+            self.assertEqual(len(self.searches), 1)
+            saved = calendar.time
+            calendar.time = lambda: effective.timeTime() + 1
+            try:
+                self.events(now.year(), now.month())
+            finally:
+                calendar.time = saved
+            self.assertEqual(len(self.searches), 2)
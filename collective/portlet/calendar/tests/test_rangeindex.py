@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import unittest2 as unittest
+from DateTime import DateTime
+from collective.portlet.calendar.dayindex import get_dayindex
+from collective.portlet.calendar.rangeindex import RANGE_INDEX
+from collective.portlet.calendar.rangeindex import index_events
+from collective.portlet.calendar.rangeindex import merge
+from collective.portlet.calendar.rangeindex import overlapping
+from collective.portlet.calendar.testing import INTEGRATION_TESTING
+from collective.portlet.calendar.testing import calendar_renderer
+from collective.portlet.calendar.upgrades import add_range_index
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import setRoles
+
+# events overlapping June 2019, in start order
+JUNE = ['long', 'running', 'first', 'during', 'june-no-end']
+
+
+class TestRangeIndex(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        self.catalog = self.portal.portal_catalog
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        self.first = DateTime('2019/06/01 00:00:00')
+        self.last = DateTime('2019/06/30 23:59:59')
+        for id, start, days in [('before', '2019/05/20 10:00', 1),
+                                ('running', '2019/05/20 10:00', 20),
+                                ('first', '2019/06/01 00:00', 0),
+                                ('during', '2019/06/10 10:00', 0),
+                                ('next', '2019/07/01 10:00', 0),
+                                ('long', '2018/01/01 10:00', 1000)]:
+            start = DateTime(start)
+            self.portal.invokeFactory('Event', id, startDate=start,
+                                      endDate=start + days + 1 / 24.0)
+        # no end: not running after its start day
+        self.portal.invokeFactory('Event', 'no-end',
+                                  startDate=DateTime('2019/05/25 10:00'))
+        self.portal.invokeFactory('Event', 'june-no-end',
+                                  startDate=DateTime('2019/06/20 10:00'))
+        for id in ('no-end', 'june-no-end'):
+            self.portal[id].setEndDate(None)
+            self.portal[id].reindexObject()
+        # not events
+        self.portal.invokeFactory('Document', 'page')
+        self.portal.invokeFactory('Folder', 'folder')
+
+    def search(self):
+        query = {'portal_type': 'Event', 'sort_on': 'start'}
+        return [brain.getId for brain in merge(
+            overlapping(self.catalog, query, self.first, self.last))]
+
+    def test_installed(self):
+        self.assertTrue(RANGE_INDEX in self.catalog.indexes())
+        self.assertEqual(self.catalog(event_range=DateTime('2019/06/10 11:00'),
+                                      portal_type='Event', sort_on='start',
+                                      sort_order='reverse')[0].getId,
+                         'during')
+
+    def test_overlapping(self):
+        results = overlapping(self.catalog, {}, self.first, self.last)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(set([brain.portal_type for brain in merge(results)]),
+                         set(['Event']))
+        self.assertEqual(self.search(), JUNE)
+
+    def test_same_results_without_index(self):
+        expected = self.search()
+        self.catalog.delIndex(RANGE_INDEX)
+        results = overlapping(self.catalog, {}, self.first, self.last)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(set([brain.portal_type for brain in merge(results)]),
+                         set(['Event']))
+        self.assertEqual(self.search(), expected)
+
+    def test_no_end(self):
+        self.assertEqual(self.catalog(event_range=DateTime('2019/05/25 11:00'),
+                                      getId='no-end')[0].getId, 'no-end')
+        self.assertEqual(len(self.catalog(event_range=self.first,
+                                          getId='no-end')), 0)
+
+    def test_not_events(self):
+        index = self.catalog._catalog.getIndex(RANGE_INDEX)
+        self.assertEqual(index.meta_type, 'EventRangeIndex')
+        self.assertEqual(len(index._always), 0)
+        rid = self.catalog.getrid('/'.join(self.portal.page.getPhysicalPath()))
+        self.assertFalse(rid in index._unindex)
+
+    def test_collection_criteria(self):
+        # start and end criteria of collections are kept
+        query = {'start': {'query': [DateTime('2019/06/05'), self.last],
+                           'range': 'min:max'}}
+        results = overlapping(self.catalog, query, self.first, self.last)
+        self.assertEqual(len(results), 1)
+        self.assertEqual([brain.getId for brain in results[0]], ['during'])
+
+    def test_calendar(self):
+        get_dayindex(self.portal).built = False
+        renderer = calendar_renderer(self.portal, year='2019', month='6')
+        self.assertEqual([brain.getId for brain in renderer.getMonthEvents()],
+                         JUNE)
+
+    def test_upgrade(self):
+        self.catalog.delIndex(RANGE_INDEX)
+        add_range_index(self.portal.portal_setup)
+        self.assertTrue(RANGE_INDEX in self.catalog.indexes())
+        self.assertEqual(index_events(self.portal), 8)
+        self.assertEqual(self.search(), JUNE)
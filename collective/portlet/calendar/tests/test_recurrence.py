@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import unittest2 as unittest
+from DateTime import DateTime
+from collective.portlet.calendar import calendar
+from collective.portlet.calendar.invalidation import event_span
+from collective.portlet.calendar.invalidation import get_generation
+from collective.portlet.calendar.recurrence import RECURRING_INDEX
+from collective.portlet.calendar.recurrence import last_occurrence
+from collective.portlet.calendar.recurrence import occurrences
+from collective.portlet.calendar.recurrence import parse_rule
+from collective.portlet.calendar.testing import INTEGRATION_TESTING
+from collective.portlet.calendar.testing import calendar_renderer
+from collective.portlet.calendar.upgrades import add_recurring_index
+from datetime import date
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import setRoles
+from zope.event import notify
+from zope.lifecycleevent import ObjectModifiedEvent
+
+
+def days(rule, start, year=2019, month=6):
+    """Day numbers of the occurrences of rule in a month"""
+    first = date(year, month, 1).toordinal()
+    last = date(year, month + 1, 1).toordinal() - 1
+    return [date.fromordinal(day).day for day in occurrences(
+        parse_rule(rule), date(*start).toordinal(), first, last)]
+
+
+class TestRules(unittest.TestCase):
+
+    def test_parse(self):
+        rule = parse_rule('RRULE:FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE;'
+                          'UNTIL=20191231T235959Z\n'
+                          'EXDATE;TZID=Europe/Paris:20190610T100000')
+        self.assertEqual(rule['freq'], 'WEEKLY')
+        self.assertEqual(rule['interval'], 2)
+        self.assertEqual(rule['byday'], [(0, 0), (0, 2)])
+        self.assertEqual(rule['until'], date(2019, 12, 31).toordinal())
+        self.assertEqual(rule['exdates'], set([date(2019, 6, 10).toordinal()]))
+
+    def test_unsupported(self):
+        self.assertEqual(parse_rule(''), None)
+        self.assertEqual(parse_rule('FREQ=HOURLY'), None)
+        self.assertEqual(parse_rule('FREQ=MONTHLY;BYMONTHDAY=1,15'), None)
+        self.assertEqual(parse_rule('FREQ=WEEKLY;BYDAY=2TU'), None)
+        self.assertEqual(parse_rule('RRULE:FREQ=DAILY\nRDATE:20190101'), None)
+        self.assertEqual(parse_rule('FREQ=DAILY;COUNT=many'), None)
+
+    def test_daily(self):
+        self.assertEqual(days('FREQ=DAILY;INTERVAL=3', (2015, 3, 10)),
+                         [2, 5, 8, 11, 14, 17, 20, 23, 26, 29])
+        self.assertEqual(days('FREQ=DAILY;UNTIL=20190603', (2019, 5, 1)),
+                         [1, 2, 3])
+        self.assertEqual(days('FREQ=DAILY;COUNT=33', (2019, 5, 1)),
+                         [1, 2])
+        self.assertEqual(days('FREQ=DAILY\nEXDATE:20190602,20190603',
+                              (2019, 5, 31))[:3], [1, 4, 5])
+
+    def test_daily_jump(self):
+        # the occurrences of the years before are skipped
+        rule = parse_rule('FREQ=DAILY')
+        first = date(2019, 6, 1).toordinal()
+        series = occurrences(rule, date(1900, 1, 1).toordinal(), first,
+                             first + 29)
+        self.assertEqual(series.next(), first)
+
+    def test_weekly(self):
+        self.assertEqual(days('FREQ=WEEKLY;INTERVAL=2;BYDAY=MO,WE,SU',
+                              (2018, 12, 5)), [3, 5, 9, 17, 19, 23])
+        # 1 occurrence the first week, then 2 a week
+        self.assertEqual(days('FREQ=WEEKLY;BYDAY=TU,TH;COUNT=150',
+                              (2018, 1, 4)), [4, 6, 11])
+        self.assertEqual(days('FREQ=WEEKLY;WKST=SU;INTERVAL=2;BYDAY=MO,SA',
+                              (2018, 3, 7)), [1, 10, 15, 24, 29])
+
+    def test_monthly(self):
+        self.assertEqual(days('FREQ=MONTHLY;BYDAY=2TU,-1FR', (2017, 1, 10)),
+                         [11, 28])
+        self.assertEqual(days('FREQ=MONTHLY', (2019, 1, 31)), [])
+        self.assertEqual(days('FREQ=MONTHLY', (2019, 1, 30)), [30])
+        self.assertEqual(days('FREQ=MONTHLY;INTERVAL=2', (2019, 3, 5)), [])
+        self.assertEqual(days('FREQ=MONTHLY;COUNT=18;BYDAY=1MO',
+                              (2018, 1, 1)), [3])
+        self.assertEqual(days('FREQ=MONTHLY;COUNT=17;BYDAY=1MO',
+                              (2018, 1, 1)), [])
+
+    def test_yearly(self):
+        self.assertEqual(days('FREQ=YEARLY', (2010, 6, 10)), [10])
+        self.assertEqual(days('FREQ=YEARLY', (2016, 2, 29), month=2), [])
+        self.assertEqual(days('FREQ=YEARLY', (2016, 2, 29), 2020, 2), [29])
+
+    def test_last_occurrence(self):
+        start = date(2019, 1, 1).toordinal()
+        self.assertEqual(last_occurrence(parse_rule('FREQ=DAILY;COUNT=10'),
+                                         start), start + 9)
+        self.assertEqual(
+            last_occurrence(parse_rule('FREQ=DAILY;UNTIL=20190301'), start),
+            date(2019, 3, 1).toordinal())
+        self.assertEqual(last_occurrence(parse_rule('FREQ=DAILY'), start),
+                         None)
+
+
+class TestRecurringEvents(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        self.catalog = self.portal.portal_catalog
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        start = DateTime('2019/01/07 10:00')
+        self.portal.invokeFactory('Event', 'weekly', title='Weekly',
+                                  startDate=start, endDate=start + 1 / 24.0)
+        self.event = self.portal['weekly']
+        self.event.recurrence = 'RRULE:FREQ=WEEKLY;BYDAY=MO\n' \
+                                'EXDATE:20190610T100000'
+        self.event.reindexObject()
+
+    def renderer(self, assignment=None):
+        return calendar_renderer(self.portal, assignment, year='2019',
+                                 month='6')
+
+    def event_days(self, renderer):
+        return [day['day'] for week in renderer.getEventsForCalendar()
+                for day in week if day['event']]
+
+    def test_indexed(self):
+        brain = self.catalog(**{RECURRING_INDEX: True})[0]
+        self.assertEqual(brain.getId, 'weekly')
+        self.assertTrue(brain.recurrence.startswith('RRULE'))
+
+    def test_occurrences(self):
+        # Mondays of June, but the 10th
+        self.assertEqual(self.event_days(self.renderer()), [3, 17, 24])
+
+    def test_several_months(self):
+        renderer = self.renderer(calendar.Assignment(months=2))
+        months = renderer.getCalendarMonths()
+        self.assertEqual([day['day'] for week in months[1]['weeks']
+                          for day in week if day['event']], [1, 8, 15, 22, 29])
+
+    def test_density(self):
+        weeks = self.renderer(calendar.Assignment(density=True)) \
+            .getEventsForCalendar()
+        self.assertEqual([(day['day'], day['count']) for week in weeks
+                          for day in week if day['event']],
+                         [(3, 1), (17, 1), (24, 1)])
+
+    def test_invalidation(self):
+        self.assertEqual(event_span(self.event), None)
+        generation = get_generation(self.portal, 2019, 9)
+        notify(ObjectModifiedEvent(self.event))
+        self.assertTrue(get_generation(self.portal, 2019, 9) > generation)
+        self.event.recurrence = 'FREQ=WEEKLY;COUNT=5'
+        self.assertEqual(event_span(self.event), ((2019, 1), (2019, 2)))
+
+    def test_upgrade(self):
+        self.catalog.delIndex(RECURRING_INDEX)
+        self.catalog.delColumn('recurrence')
+        add_recurring_index(self.portal.portal_setup)
+        self.assertEqual(len(self.catalog(**{RECURRING_INDEX: True})), 1)
+        self.assertEqual(self.event_days(self.renderer()), [3, 17, 24])
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest2 as unittest
+from DateTime import DateTime
+from collective.portlet.calendar import calendar
+from collective.portlet.calendar import rendercache
+from collective.portlet.calendar.testing import INTEGRATION_TESTING
+from collective.portlet.calendar.testing import calendar_renderer
+from collective.portlet.calendar.testing import product_config
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import setRoles
+
+
+class TestRefresher(unittest.TestCase):
+
+    def test_schedule(self):
+        refresher = rendercache.Refresher()
+        done = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def job():
+            release.wait(5)
+            calls.append(1)
+            done.set()
+
+        self.assertTrue(refresher.schedule('key', job))
+        # a refresh is pending for that key already
+        self.assertFalse(refresher.schedule('key', job))
+        release.set()
+        done.wait(5)
+        self.assertEqual(calls, [1])
+
+
+class TestRenderCache(unittest.TestCase):
+
+    def test_max_entries(self):
+        store = rendercache.RenderCache(max_entries=2, max_bytes=10000)
+        store.set('a', 1, 'A', assignment='one')
+        store.set('b', 1, 'B', assignment='one')
+        store.get('a')
+        store.set('c', 1, 'C', assignment='two')
+        # b was the least recently used
+        self.assertEqual(store.get('b'), None)
+        self.assertEqual(store.get('a'), (1, 'A', None))
+        self.assertEqual(store.get('c'), (1, 'C', None))
+        self.assertEqual(store.stats['one']['evictions'], 1)
+
+    def test_max_bytes(self):
+        store = rendercache.RenderCache(max_entries=100, max_bytes=1000)
+        for key in 'abcdefghij':
+            store.set(key, 1, key * 200)
+        self.assertTrue(store.bytes <= 1000)
+        self.assertTrue(0 < len(store) < 10)
+        self.assertFalse(store.get('j') is None)
+
+    def test_occupancy(self):
+        store = rendercache.RenderCache(max_entries=10, max_bytes=10000)
+        store.set('a', 1, 'A', assignment='one')
+        store.set('a', 2, 'AA')
+        store.count('one', 'hits')
+        store.count('one', 'misses')
+        occupancy = store.occupancy()
+        self.assertEqual(occupancy['entries'], 1)
+        self.assertEqual(occupancy['max_entries'], 10)
+        stats = occupancy['assignments']['one']
+        self.assertEqual((stats['entries'], stats['hits'], stats['misses']),
+                         (1, 1, 1))
+        self.assertEqual(stats['bytes'], occupancy['bytes'])
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.flights = rendercache.SingleFlight()
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def slow(self):
+        self.started.set()
+        self.release.wait(5)
+        return 'leader'
+
+    def leader(self):
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(self.flights.do('key', self.slow, 5)))
+        thread.start()
+        self.started.wait(5)
+        return thread, results
+
+    def test_coalesced(self):
+        thread, results = self.leader()
+        waiter = threading.Thread(target=lambda: results.append(
+            self.flights.do('key', lambda: 'waiter', 5)))
+        waiter.start()
+        # let the waiter join the flight
+        time.sleep(0.1)
+        self.assertEqual(results, [])
+        self.release.set()
+        thread.join(5)
+        waiter.join(5)
+        self.assertEqual(results, ['leader', 'leader'])
+        self.assertEqual(self.flights.coalesced, 1)
+
+    def test_timeout(self):
+        thread, results = self.leader()
+        self.assertEqual(self.flights.do('key', lambda: 'waiter', 0.01),
+                         'waiter')
+        self.assertEqual(self.flights.timeouts, 1)
+        self.release.set()
+        thread.join(5)
+        self.assertEqual(self.flights.coalesced, 0)
+
+    def test_other_keys(self):
+        thread, results = self.leader()
+        self.assertEqual(self.flights.do('other', lambda: 'other', 5),
+                         'other')
+        self.release.set()
+        thread.join(5)
+        self.assertEqual(self.flights.timeouts, 0)
+
+
+class TestStaleWhileRevalidate(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        self.now = DateTime()
+        rendercache.store.clear()
+        self.scheduled = []
+        self._schedule = rendercache.refresher.schedule
+        rendercache.refresher.schedule = \
+            lambda key, job: self.scheduled.append(job)
+
+    def tearDown(self):
+        rendercache.refresher.schedule = self._schedule
+        rendercache.store.clear()
+
+    def renderer(self, hash='abc'):
+        renderer = calendar_renderer(self.portal, update=False)
+        renderer.__portlet_metadata__ = {'hash': hash}
+        renderer.update()
+        return renderer
+
+    def addEvent(self):
+        start = DateTime('%s/%s/2 10:00' % (self.now.year(), self.now.month()))
+        self.portal.invokeFactory('Event', 'e1', title='Meeting',
+                                  startDate=start, endDate=start + 1 / 24.0)
+
+    def test_stale_served(self):
+        with product_config({'max-stale': '60'}):
+            html = self.renderer().render()
+            self.addEvent()
+            self.assertEqual(self.renderer().render(), html)
+            self.assertEqual(len(self.scheduled), 1)
+        self.assertFalse('Meeting' in html)
+
+    def test_too_stale(self):
+        with product_config({'max-stale': '60'}):
+            renderer = self.renderer()
+            html = renderer.render()
+            self.addEvent()
+            key = calendar._render_identity(renderer)
+            freshness, html, stale_since = rendercache.store.get(key)
+            rendercache.store.set(key, freshness, html, stale_since=1)
+            self.assertNotEqual(self.renderer().render(), html)
+            self.assertEqual(self.scheduled, [])
+
+    def test_no_portlet_hash(self):
+        with product_config({'max-stale': '60'}):
+            html = self.renderer(hash=None).render()
+            self.addEvent()
+            self.assertNotEqual(self.renderer(hash=None).render(), html)
+            self.assertEqual(self.scheduled, [])
+
+    def test_hits_and_misses(self):
+        self.renderer().render()
+        self.renderer().render()
+        self.addEvent()
+        self.renderer().render()
+        stats = rendercache.store.occupancy()['assignments']
+        self.assertEqual(len(stats), 1)
+        stats = stats.values()[0]
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']),
+                         (1, 2, 1))
+
+    def test_stats_view(self):
+        self.renderer().render()
+        view = self.portal.restrictedTraverse('@@calendar-cache-stats')
+        self.assertTrue('Entries: 1 of ' in view())
+
+    def test_disabled(self):
+        self.renderer().render()
+        self.addEvent()
+        self.renderer().render()
+        self.assertEqual(self.scheduled, [])
+
+
+class TestSharedQuery(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        rendercache.store.clear()
+
+    def tearDown(self):
+        rendercache.store.clear()
+
+    def renderer(self, assignment):
+        # portlets of the same page
+        return calendar_renderer(self.portal, assignment, new_request=False)
+
+    def test_same_query(self):
+        meetings = self.renderer(calendar.Assignment(name=u'Meetings'))
+        agenda = self.renderer(calendar.Assignment(name=u'Agenda & news'))
+        self.assertEqual(calendar._render_identity(meetings),
+                         calendar._render_identity(agenda))
+        html = meetings.render()
+        self.assertTrue('Meetings' in html)
+        html = agenda.render()
+        self.assertTrue('Agenda &amp; news' in html)
+        self.assertFalse('Meetings' in html)
+        self.assertEqual(len(rendercache.store), 1)
+        # the events were searched and grouped for the first portlet only
+        self.assertTrue(agenda._monthsEvents() is meetings._monthsEvents())
+
+    def test_other_query(self):
+        meetings = self.renderer(calendar.Assignment(name=u'Calendar',
+                                                     kw=[u'Meeting']))
+        parties = self.renderer(calendar.Assignment(name=u'Calendar',
+                                                    kw=[u'Party']))
+        self.assertNotEqual(calendar._render_identity(meetings),
+                            calendar._render_identity(parties))
+        self.assertFalse(parties._monthsEvents() is meetings._monthsEvents())
+
+    def test_with_and_without_title(self):
+        titled = self.renderer(calendar.Assignment(name=u'Calendar'))
+        untitled = self.renderer(calendar.Assignment())
+        self.assertNotEqual(calendar._render_identity(titled),
+                            calendar._render_identity(untitled))
@@ -5,10 +5,14 @@ import unittest2 as unittest
 from plone.app.testing import TEST_USER_ID
 from plone.app.testing import setRoles
 
+from plone.app.portlets.utils import assignment_mapping_from_key
 from plone.browserlayer.utils import registered_layers
+from plone.portlets.constants import CONTEXT_CATEGORY
 
+from collective.portlet.calendar.calendar import Assignment
 from collective.portlet.calendar.config import PROJECTNAME
 from collective.portlet.calendar.testing import INTEGRATION_TESTING
+from collective.portlet.calendar.upgrades import compile_queries
 
 
 class InstallTestCase(unittest.TestCase):
@@ -32,6 +36,11 @@ class InstallTestCase(unittest.TestCase):
         resources = portal_css.getResourceIds()
         self.assertTrue('++resource++calendar_styles/calendar.css' in resources)
 
+    def test_js_registry(self):
+        portal_javascripts = self.portal.portal_javascripts
+        resources = portal_javascripts.getResourceIds()
+        self.assertTrue('++resource++calendar_styles/calendar.js' in resources)
+
 
 class UninstallTest(unittest.TestCase):
 
@@ -55,3 +64,36 @@ class UninstallTest(unittest.TestCase):
         portal_css = self.portal.portal_css
         resources = portal_css.getResourceIds()
         self.assertFalse('++resource++calendar_styles/calendar.css' in resources)
+
+    def test_range_index_removed(self):
+        self.assertFalse('event_range' in self.portal.portal_catalog.indexes())
+
+    def test_recurring_index_removed(self):
+        catalog = self.portal.portal_catalog
+        self.assertFalse('is_recurring' in catalog.indexes())
+        # other add-ons, like plone.app.event, have this column too
+        self.assertTrue('recurrence' in catalog.schema())
+
+    def test_js_registry_removed(self):
+        portal_javascripts = self.portal.portal_javascripts
+        resources = portal_javascripts.getResourceIds()
+        self.assertFalse('++resource++calendar_styles/calendar.js' in resources)
+
+
+class UpgradeTest(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+
+    def test_compile_queries(self):
+        mapping = assignment_mapping_from_key(
+            self.portal, 'plone.rightcolumn', CONTEXT_CATEGORY,
+            '/'.join(self.portal.getPhysicalPath()))
+        mapping['calendar'] = Assignment(kw=[u'Meeting'])
+        self.assertEqual(mapping['calendar'].compiled, None)
+        compile_queries(self.portal.portal_setup)
+        self.assertEqual(mapping['calendar'].compiled['Subject'],
+                         ['Meeting'])
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest2 as unittest
+from DateTime import DateTime
+from collective.portlet.calendar import calendar
+from collective.portlet.calendar.testing import INTEGRATION_TESTING
+from collective.portlet.calendar.testing import calendar_renderer
+from collective.portlet.calendar.testing import product_config
+from plone.app.portlets.utils import assignment_mapping_from_key
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import logout
+from plone.app.testing import setRoles
+from plone.portlets.constants import CONTEXT_CATEGORY
+from plone.portlets.utils import hashPortletInfo
+from zExceptions import NotFound
+
+
+class ViewTestCase(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        self.request = self.layer['request']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        key = '/'.join(self.portal.getPhysicalPath())
+        mapping = assignment_mapping_from_key(
+            self.portal, 'plone.rightcolumn', CONTEXT_CATEGORY, key)
+        mapping['calendar'] = calendar.Assignment()
+        self.portlethash = hashPortletInfo({'manager': 'plone.rightcolumn',
+                                            'category': CONTEXT_CATEGORY,
+                                            'key': key,
+                                            'name': 'calendar'})
+        self.now = DateTime()
+        start = DateTime('%s/%s/2 10:00' % (self.now.year(), self.now.month()))
+        self.portal.invokeFactory('Event', 'e1', title='Meeting',
+                                  startDate=start, endDate=start + 1 / 24.0)
+
+    def view(self, name, **form):
+        self.request.form.update(form)
+        self.request.form.setdefault('portlethash', self.portlethash)
+        return self.portal.restrictedTraverse(name)
+
+
+class TestMonthData(ViewTestCase):
+
+    def test_month_data(self):
+        view = self.view('@@calendar-month-data',
+                         year=str(self.now.year()),
+                         month=str(self.now.month()))
+        data = json.loads(view())
+        self.assertEqual(data['year'], self.now.year())
+        self.assertEqual(data['month'], self.now.month())
+        self.assertEqual(data['today'], self.now.day())
+        self.assertTrue(data['prev'])
+        self.assertTrue(data['next'])
+        days = [d for week in data['weeks'] for d in week if d]
+        events = [d for d in days if isinstance(d, list)]
+        self.assertEqual(len(events), 1)
+        number, title, link = events[0]
+        self.assertEqual(number, 2)
+        self.assertTrue('Meeting' in title)
+        self.assertTrue('/@@search?' in link)
+        self.assertEqual(self.request.response.getHeader('Content-Type'),
+                         'application/json')
+
+    def test_other_month(self):
+        view = self.view('@@calendar-month-data', year='2010', month='3')
+        data = json.loads(view())
+        self.assertEqual((data['year'], data['month']), (2010, 3))
+        self.assertEqual(data['today'], 0)
+        self.assertFalse([d for week in data['weeks'] for d in week
+                          if isinstance(d, list)])
+
+    def test_not_modified(self):
+        view = self.view('@@calendar-month-data')
+        view()
+        etag = self.request.response.getHeader('ETag')
+        self.assertTrue(etag)
+        self.request.environ['HTTP_IF_NONE_MATCH'] = etag
+        self.assertEqual(view(), '')
+        self.assertEqual(self.request.response.getStatus(), 304)
+
+    def test_bad_hash(self):
+        view = self.view('@@calendar-month-data', portlethash='foo')
+        self.assertRaises(NotFound, view)
+
+
+class TestDayTooltips(ViewTestCase):
+
+    def test_tooltips(self):
+        view = self.view('@@calendar-day-tooltips',
+                         year=str(self.now.year()),
+                         month=str(self.now.month()))
+        with product_config({'lazy-tooltips': 'on'}):
+            tooltips = json.loads(view())
+        self.assertEqual(tooltips.keys(), ['2'])
+        self.assertTrue(' 10:00-11:00 Meeting' in tooltips['2'])
+
+
+class TestPortletFragment(ViewTestCase):
+
+    def test_fragment(self):
+        view = self.view('@@calendar-portlet-fragment')
+        html = view()
+        self.assertTrue('portletCalendarEx' in html)
+        response = self.request.response
+        self.assertTrue(response.getHeader('ETag'))
+        self.assertTrue(
+            response.getHeader('Cache-Control').startswith('private'))
+
+    def test_fragment_anonymous(self):
+        self.portal.portal_workflow.doActionFor(self.portal.e1, 'publish')
+        logout()
+        view = self.view('@@calendar-portlet-fragment')
+        with product_config({'fragment-max-age': '600'}):
+            view()
+        self.assertEqual(self.request.response.getHeader('Cache-Control'),
+                         'public, max-age=0, s-maxage=600, must-revalidate')
+
+    def test_vary(self):
+        # calendars are translated
+        view = self.view('@@calendar-portlet-fragment')
+        view()
+        self.assertEqual(self.request.response.getHeader('Vary'),
+                         'Accept-Language')
+        self.portal.portal_languages.use_cookie_negotiation = True
+        view()
+        self.assertEqual(self.request.response.getHeader('Vary'),
+                         'Accept-Language, Cookie')
+
+    def test_not_modified(self):
+        view = self.view('@@calendar-portlet-fragment')
+        view()
+        self.request.environ['HTTP_IF_NONE_MATCH'] = \
+            self.request.response.getHeader('ETag')
+        self.assertEqual(view(), '')
+        self.assertEqual(self.request.response.getStatus(), 304)
+
+    def test_renamed(self):
+        view = self.view('@@calendar-portlet-fragment')
+        view()
+        etag = self.request.response.getHeader('ETag')
+        assignment = assignment_mapping_from_key(
+            self.portal, 'plone.rightcolumn', CONTEXT_CATEGORY,
+            '/'.join(self.portal.getPhysicalPath()))['calendar']
+        assignment.name = u'Agenda'
+        self.request.environ['HTTP_IF_NONE_MATCH'] = etag
+        self.assertTrue('Agenda' in view())
+        self.assertNotEqual(self.request.response.getHeader('ETag'), etag)
+
+    def test_esi(self):
+        renderer = calendar_renderer(self.portal, update=False)
+        renderer.__portlet_metadata__ = {'hash': self.portlethash}
+        self.assertFalse(renderer.render().startswith('<esi:include'))
+        with product_config({'esi': 'on'}):
+            html = renderer.render()
+        self.assertTrue(html.startswith('<esi:include src="'))
+        self.assertTrue('@@calendar-portlet-fragment?' in html)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import transaction
+import unittest2 as unittest
+from DateTime import DateTime
+from collective.portlet.calendar import calendar
+from collective.portlet.calendar import rendercache
+from collective.portlet.calendar.testing import FUNCTIONAL_TESTING
+from collective.portlet.calendar.testing import INTEGRATION_TESTING
+from collective.portlet.calendar.testing import count_calls
+from collective.portlet.calendar.warmup import find_assignments
+from collective.portlet.calendar.warmup import warmup
+from collective.portlet.calendar.warmup import warmup_months
+from plone.app.portlets.utils import assignment_mapping_from_key
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import setRoles
+from plone.portlets.constants import CONTEXT_CATEGORY
+from plone.portlets.constants import GROUP_CATEGORY
+from plone.portlets.utils import unhashPortletInfo
+
+
+def assign_calendars(portal):
+    """A calendar portlet of a folder and one of a group"""
+    setRoles(portal, TEST_USER_ID, ['Manager'])
+    portal.portal_workflow.setChainForPortalTypes(
+        ['Folder'], ['simple_publication_workflow'])
+    portal.invokeFactory('Folder', 'folder1')
+    portal.portal_workflow.doActionFor(portal.folder1, 'publish')
+    mapping = assignment_mapping_from_key(
+        portal, 'plone.rightcolumn', CONTEXT_CATEGORY,
+        '/'.join(portal.folder1.getPhysicalPath()))
+    mapping['calendar'] = calendar.Assignment()
+    mapping = assignment_mapping_from_key(
+        portal, 'plone.leftcolumn', GROUP_CATEGORY, 'Reviewers')
+    mapping['calendar'] = calendar.Assignment(name=u'Reviewers')
+
+
+class TestWarmupMonths(unittest.TestCase):
+
+    def test_warmup_months(self):
+        self.assertEqual(warmup_months(DateTime('2019/06/15')),
+                         [(2019, 5), (2019, 6), (2019, 7)])
+        self.assertEqual(warmup_months(DateTime('2019/01/15')),
+                         [(2018, 12), (2019, 1), (2019, 2)])
+        self.assertEqual(warmup_months(DateTime('2019/12/15')),
+                         [(2019, 11), (2019, 12), (2020, 1)])
+
+
+class TestWarmup(unittest.TestCase):
+
+    layer = INTEGRATION_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        self.request = self.layer['request']
+        assign_calendars(self.portal)
+        rendercache.store.clear()
+
+    def test_find_assignments(self):
+        found = [(context.getId(), unhashPortletInfo(portlethash))
+                 for context, portlethash in find_assignments(self.portal)]
+        self.assertEqual(len(found), 2)
+        categories = dict([(info['category'], (id, info['manager']))
+                           for id, info in found])
+        self.assertEqual(categories[CONTEXT_CATEGORY],
+                         ('folder1', 'plone.rightcolumn'))
+        self.assertEqual(categories[GROUP_CATEGORY],
+                         (self.portal.getId(), 'plone.leftcolumn'))
+
+    def test_items_not_loaded(self):
+        self.portal.invokeFactory('Document', 'd1')
+        with count_calls() as calls:
+            self.assertEqual(len(list(find_assignments(self.portal))), 2)
+        # folder1 only
+        self.assertEqual(calls['objects'], 1)
+
+    def test_warmup(self):
+        report = warmup(self.portal, self.request)
+        self.assertEqual(len(report), 6)
+        self.assertEqual(set([line[4] for line in report]), set(['rendered']))
+        self.assertEqual(len(rendercache.store), 6)
+        report = warmup(self.portal, self.request)
+        self.assertEqual(set([line[4] for line in report]), set(['cached']))
+
+    def test_view(self):
+        view = self.portal.restrictedTraverse('@@calendar-warmup')
+        output = view()
+        self.assertTrue('Warmed up 2 calendars over 3 months: 6 rendered, '
+                        '0 cached, 0 errors' in output)
+        self.assertTrue('(1 threads)' in output)
+
+
+class TestThreadedWarmup(unittest.TestCase):
+
+    # threads render in connections of their own, which only see committed
+    # content
+    layer = FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        self.request = self.layer['request']
+        assign_calendars(self.portal)
+        transaction.commit()
+        rendercache.store.clear()
+
+    def tearDown(self):
+        rendercache.store.clear()
+
+    def test_warmup(self):
+        report = warmup(self.portal, self.request, threads=3)
+        self.assertEqual(len(report), 6)
+        self.assertEqual(set([line[4] for line in report]), set(['rendered']))
+        self.assertEqual(len(rendercache.store), 6)
+        report = warmup(self.portal, self.request, threads=3)
+        self.assertEqual(set([line[4] for line in report]), set(['cached']))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from Products.CMFCore.utils import getToolByName
+from collective.portlet.calendar.calendar import compile_query
+from collective.portlet.calendar.dayindex import rebuild
+from collective.portlet.calendar.rangeindex import index_events
+from collective.portlet.calendar.recurrence import index_recurring
+from collective.portlet.calendar.warmup import find_assignments
+from plone.app.portlets.utils import assignment_mapping_from_key
+from plone.portlets.utils import unhashPortletInfo
+
+logger = logging.getLogger('collective.portlet.calendar')
+PROFILE_ID = 'profile-collective.portlet.calendar:default'
+
+
+def build_dayindex(context):
+    """Index the events of existing sites by day"""
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    count = rebuild(portal)
+    logger.info('Day index built: %d events' % count)
+
+
+def register_javascript(context):
+    """Register the JavaScript used for month navigation"""
+    context.runImportStepFromProfile(PROFILE_ID, 'jsregistry')
+
+
+def add_range_index(context):
+    """Add the event range index to the catalog, or update its settings,
+    and fill it
+    """
+    context.runImportStepFromProfile(PROFILE_ID, 'catalog')
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    count = index_events(portal)
+    logger.info('Event range index filled: %d events' % count)
+
+
+def add_recurring_index(context):
+    """Add the is_recurring index and the recurrence metadata to the
+    catalog and catalog the recurring events again
+    """
+    context.runImportStepFromProfile(PROFILE_ID, 'catalog')
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    count = index_recurring(portal)
+    logger.info('Recurring events cataloged: %d events' % count)
+
+
+def compile_queries(context):
+    """Compile the query of existing calendar portlets, the ones of
+    non folderish items are compiled when they are edited
+    """
+    portal = getToolByName(context, 'portal_url').getPortalObject()
+    count = 0
+    for content, portlethash in find_assignments(portal):
+        info = unhashPortletInfo(portlethash)
+        mapping = assignment_mapping_from_key(
+            content, info['manager'], info['category'], info['key'])
+        compile_query(mapping[info['name']], content)
+        count += 1
+    logger.info('Calendar portlet queries compiled: %d' % count)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import binascii
+import time
+
+from Products.CMFCore.utils import getToolByName
+from datetime import date
+from datetime import datetime
+from plone.app.portlets.utils import assignment_mapping_from_key
+from plone.portlets.interfaces import IPortletManager
+from plone.portlets.interfaces import IPortletRenderer
+from plone.portlets.utils import unhashPortletInfo
+from zExceptions import NotFound
+from zope.component import getMultiAdapter
+from zope.component import getUtility
+from zope.component.interfaces import ComponentLookupError
+
+
+def is_event(obj):
+    """Tell if obj is a content type shown by calendars"""
+    calendar = getToolByName(obj, 'portal_calendar', None)
+    if calendar is None:
+        return False
+    return getattr(obj, 'portal_type', None) in calendar.getCalendarTypes()
+
+
+def month_days(year, month):
+    """Number of days of a month"""
+    if month == 12:
+        return 31
+    return (date(year, month + 1, 1) - date(year, month, 1)).days
+
+
+def _local(value):
+    """Time tuple of a date, DateTime ones being in the time zone of the
+    server like the days of the calendar and the DateIndex values (see
+    index_day), whatever the time zone they were entered in
+    """
+    if callable(value.year):
+        # DateTime, cheaper than its accessors and toZone()
+        return time.localtime(value.timeTime())
+    return value.timetuple()
+
+
+def _day(value):
+    if callable(value):
+        value = value()
+    if not value:
+        # None or Missing.Value
+        return None
+    return date(*_local(value)[:3]).toordinal()
+
+
+def _at_midnight(value):
+    if callable(value):
+        value = value()
+    return _local(value)[3:6] == (0, 0, 0)
+
+
+def _time(value):
+    """Time of the day of a date, as DateTime.Time() in the time zone of
+    the server
+    """
+    return '%02d:%02d:%02d' % _local(value)[3:6]
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def index_day(value):
+    """Local day ordinal of a DateIndex value, and whether it is midnight
+
+    DateIndex stores UTC minutes as
+    ((((year * 12 + month) * 31 + day) * 24 + hour) * 60 + minute).
+    """
+    value, minute = divmod(value, 60)
+    value, hour = divmod(value, 24)
+    value, day = divmod(value, 31)
+    if not day:
+        value, day = value - 1, 31
+    year, month = divmod(value, 12)
+    if not month:
+        year, month = year - 1, 12
+    utc = datetime(year, month, day, hour, minute) - EPOCH
+    local = time.localtime(utc.days * 86400 + utc.seconds)
+    return date(*local[:3]).toordinal(), local[3:5] == (0, 0)
+
+
+def event_days(obj):
+    """First and last day ordinal of an event (or a catalog brain), or None
+
+    Like portal_calendar, an event ending at midnight does not show up on
+    its last day.
+    """
+    first = _day(getattr(obj, 'start', None))
+    if first is None:
+        return None
+    end = getattr(obj, 'end', None)
+    last = _day(end)
+    if last is None:
+        return first, first
+    if last > first and _at_midnight(end):
+        last -= 1
+    return first, max(first, last)
+
+
+def renderer_from_hash(view, portlethash):
+    """Portlet renderer of a portlet hash, as used by @@render-portlet"""
+    context = view.context
+    try:
+        info = unhashPortletInfo(portlethash)
+        manager = getUtility(IPortletManager, name=info['manager'],
+                             context=context)
+        mapping = assignment_mapping_from_key(
+            context=context,
+            manager_name=info['manager'],
+            category=info['category'],
+            key=info['key'],
+        )
+        assignment = mapping[info['name']]
+    except (binascii.Error, ValueError, KeyError, ComponentLookupError):
+        raise NotFound('No portlet found for %s' % portlethash)
+    renderer = getMultiAdapter(
+        (context, view.request, view, manager, assignment), IPortletRenderer)
+    renderer.__portlet_metadata__ = dict(info, hash=portlethash)
+    return renderer.__of__(context)
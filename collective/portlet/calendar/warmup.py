@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Render calendar portlets ahead of visitors, e.g. after a restart.
+
+Every calendar assignment of the site is found, in all portlet managers:
+the ones of the site and of folderish content items, of groups and of
+content types (user dashboards are left out). Other content items are not
+looked at, so that the whole site is not loaded. The previous, current and
+next months of each of them are rendered as anonymous into the render
+cache.
+
+Renderings run in the connection of the calling request, or with
+``threads`` greater than 1 in that many threads with connections of their
+own, which only see committed content.
+"""
+import threading
+import time
+from AccessControl import getSecurityManager
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import setSecurityManager
+from AccessControl.SpecialUsers import nobody
+from Acquisition import aq_base
+from DateTime import DateTime
+from Products.CMFCore.utils import getToolByName
+from Products.Five.browser import BrowserView
+from Queue import Queue, Empty
+from collective.portlet.calendar.calendar import ICalendarExPortlet
+from collective.portlet.calendar.calendar import MONTH_EVENTS_KEY
+from collective.portlet.calendar.calendar import _render_freshness
+from collective.portlet.calendar.calendar import _render_identity
+from collective.portlet.calendar.rendercache import RefreshJob
+from collective.portlet.calendar.rendercache import assignment_id
+from collective.portlet.calendar.rendercache import backend
+from collective.portlet.calendar.utils import renderer_from_hash
+from functools import partial
+from plone.portlets.constants import CONTENT_TYPE_CATEGORY
+from plone.portlets.constants import CONTEXT_ASSIGNMENT_KEY
+from plone.portlets.constants import CONTEXT_CATEGORY
+from plone.portlets.constants import GROUP_CATEGORY
+from plone.portlets.interfaces import IPortletManager
+from plone.portlets.utils import hashPortletInfo
+from zope.annotation.interfaces import IAnnotations
+from zope.component import getUtilitiesFor
+
+
+def _calendars(mapping):
+    for name, assignment in mapping.items():
+        if ICalendarExPortlet.providedBy(assignment):
+            yield name
+
+
+def _contents(portal):
+    """The site and its folderish content items, the ones calendar portlets
+    are assigned to
+    """
+    yield portal
+    catalog = getToolByName(portal, 'portal_catalog')
+    for brain in catalog.unrestrictedSearchResults(is_folderish=True):
+        try:
+            yield brain._unrestrictedGetObject()
+        except (AttributeError, KeyError):
+            continue
+
+
+def find_assignments(portal):
+    """(context, portlet hash) of every calendar assignment of the site"""
+    for name, manager in getUtilitiesFor(IPortletManager, context=portal):
+        for category in (GROUP_CATEGORY, CONTENT_TYPE_CATEGORY):
+            for key, mapping in manager.get(category, {}).items():
+                for portlet in _calendars(mapping):
+                    yield portal, hashPortletInfo(dict(
+                        manager=name, category=category, key=key,
+                        name=portlet))
+    for context in _contents(portal):
+        if getattr(aq_base(context), '__annotations__', None) is None:
+            continue
+        mappings = IAnnotations(context).get(CONTEXT_ASSIGNMENT_KEY, {})
+        key = '/'.join(context.getPhysicalPath())
+        for name, mapping in mappings.items():
+            for portlet in _calendars(mapping):
+                yield context, hashPortletInfo(dict(
+                    manager=name, category=CONTEXT_CATEGORY, key=key,
+                    name=portlet))
+
+
+def warmup_months(now=None):
+    """Previous, current and next (year, month)"""
+    now = now or DateTime()
+    year, month = now.year(), now.month()
+    return [(year - 1, 12) if month == 1 else (year, month - 1),
+            (year, month),
+            (year + 1, 1) if month == 12 else (year, month + 1)]
+
+
+def _prerender(context, request, portlethash, year, month):
+    """Render a calendar as anonymous in the current connection"""
+    form = request.form
+    saved = dict(form)
+    security_manager = getSecurityManager()
+    form.update({'year': str(year), 'month': str(month)})
+    newSecurityManager(request, nobody)
+    try:
+        renderer = renderer_from_hash(BrowserView(context, request),
+                                      portlethash)
+        renderer.update()
+        key = _render_identity(renderer)
+        current = _render_freshness(renderer)
+        cache = backend()
+        entry = cache.get(key)
+        if entry is not None and entry[0] == current:
+            return False
+        cache.set(key, current, renderer._render(),
+                  assignment=assignment_id(renderer))
+        return True
+    finally:
+        setSecurityManager(security_manager)
+        form.clear()
+        form.update(saved)
+        # events found as anonymous are not for the calling user
+        IAnnotations(request).pop(MONTH_EVENTS_KEY, None)
+
+
+def _job(context, request, portlethash, year, month):
+    renderer = renderer_from_hash(BrowserView(context, request), portlethash)
+    return RefreshJob(renderer, _render_identity, _render_freshness,
+                      year=year, month=month, anonymous=True)
+
+
+def warmup(portal, request, threads=1, months=None):
+    """Render the calendars of the site, return a report of what was done
+
+    The report lists (portlet hash, year, month, seconds, outcome) tuples,
+    outcome being 'rendered', 'cached' or an error message.
+    """
+    tasks = Queue()
+    for context, portlethash in find_assignments(portal):
+        for year, month in months or warmup_months():
+            if threads > 1:
+                task = _job(context, request, portlethash, year, month)
+            else:
+                task = partial(_prerender, context, request, portlethash,
+                               year, month)
+            tasks.put((portlethash, year, month, task))
+    report = []
+
+    def work():
+        while True:
+            try:
+                portlethash, year, month, task = tasks.get_nowait()
+            except Empty:
+                return
+            start = time.time()
+            try:
+                outcome = task() and 'rendered' or 'cached'
+            except Exception as e:
+                outcome = 'error: %s' % e
+            report.append((portlethash, year, month, time.time() - start,
+                           outcome))
+
+    if threads > 1:
+        workers = [threading.Thread(target=work) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    else:
+        work()
+    return report
@@ -51,10 +51,14 @@ setup(name='collective.portlet.calendar',
           'zope.schema',
       ],
       extras_require={
+          'memcached': [
+              'python-memcached',
+          ],
           'test': [
               'plone.app.testing',
               'plone.browserlayer',
               'plone.testing',
+              'python-memcached',
               'unittest2',
           ],
       },